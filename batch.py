@@ -0,0 +1,583 @@
+"""
+Turn-synchronous evaluation of many examples through batch inference.
+
+`WaveScheduler` moves all examples forward in lockstep: the candidate requests
+of round k of every example go out together, one batch per candidate model, then
+the judge requests of every example as one batch, then round k + 1. Each batch is
+sent through a `BatchTransport`:
+- `OpenAIBatchTransport` submits an OpenAI Batch API job and polls it;
+- `AnthropicBatchTransport` submits an Anthropic message batch and polls it;
+- `ServerBatchTransport` sends the whole batch at once to an endpoint, e.g. a
+  self-hosted OpenAI-compatible server that batches concurrent requests itself;
+- `LocalBatchTransport` is a file-based stand-in for testing, it writes the batch
+  as an OpenAI Batch API input file, serves it with `utils.achat_completion` and
+  reads the results back from an output file in the Batch API format.
+
+Batch jobs may take hours to finish, a wave-based run trades latency for the
+throughput and the lower price of batch inference. Requests sent through the
+OpenAI and Anthropic batch APIs bypass the response cache.
+"""
+import os
+import json
+import time
+import asyncio
+import itertools
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+from load_balancer import get_endpoint_label, get_model_endpoints
+from telemetry import labels, record_usage, track_call
+from utils import (
+    achat_completion,
+    fix_anthropic_message,
+    get_client,
+    get_model_endpoint_pool,
+    judger_response_problem,
+    num_message_tokens,
+    num_tokens,
+    run_sync,
+    CandidatesStep,
+    JudgeError,
+    API_ERROR_OUTPUT,
+    ANTHROPIC_HUMAN_PROMPT,
+    DEFAULT_MAX_TOKENS,
+    JUDGE_MAX_RETRY,
+    JUDGE_STATS,
+)
+
+BATCH_TRANSPORTS = ("auto", "server", "local")
+DEFAULT_BATCH_DIR = "cache/batches"
+DEFAULT_POLL_INTERVAL = 30
+
+_BATCH_COUNTER = itertools.count()
+
+
+class BatchRequest:
+    """One chat request of a batch."""
+
+    def __init__(
+        self,
+        messages,
+        temperature=1.0,
+        max_tokens=None,
+        seed=None,
+        json_mode=False,
+        stop_at_json=False,
+        refresh_cache=False,
+    ):
+        self.messages = messages
+        self.temperature = temperature
+        self.max_tokens = max_tokens
+        self.seed = seed
+        self.json_mode = json_mode
+        self.stop_at_json = stop_at_json
+        self.refresh_cache = refresh_cache
+
+
+def _custom_id(index):
+    return f"request-{index}"
+
+
+def _request_index(custom_id):
+    return int(custom_id.rsplit("-", 1)[1])
+
+
+class BatchTransport:
+    """Runs a batch of requests to one model and returns their response texts.
+
+    The responses are returned in the order of the requests, failed requests get
+    `utils.API_ERROR_OUTPUT`.
+    """
+
+    def run(self, model, requests):
+        raise NotImplementedError
+
+
+class ServerBatchTransport(BatchTransport):
+    """Sends all requests of a batch at once through `utils.achat_completion`."""
+
+    def run(self, model, requests):
+        async def run_all():
+            return await asyncio.gather(
+                *[
+                    achat_completion(
+                        model,
+                        request.messages,
+                        temperature=request.temperature,
+                        max_tokens=request.max_tokens,
+                        json_mode=request.json_mode,
+                        seed=request.seed,
+                        stop_at_json=request.stop_at_json,
+                        refresh_cache=request.refresh_cache,
+                    )
+                    for request in requests
+                ]
+            )
+
+        return run_sync(run_all())
+
+
+def openai_batch_lines(model, requests):
+    """Lines of the OpenAI Batch API input file of `requests`."""
+    lines = []
+    for i, request in enumerate(requests):
+        body = {
+            "model": model["model_name"],
+            "messages": request.messages,
+            "temperature": request.temperature,
+            "max_tokens": request.max_tokens
+            or model.get("max_tokens")
+            or DEFAULT_MAX_TOKENS,
+        }
+        if request.seed is not None:
+            body["seed"] = request.seed
+        if request.json_mode:
+            body["response_format"] = {"type": "json_object"}
+        lines.append(
+            {
+                "custom_id": _custom_id(i),
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": body,
+            }
+        )
+    return lines
+
+
+def read_openai_batch_output(model, lines, num_requests, record=True):
+    """Response texts of the lines of an OpenAI Batch API output file.
+
+    With `record`, the usage of every request is recorded in the telemetry.
+    """
+    outputs = [API_ERROR_OUTPUT] * num_requests
+    for line in lines:
+        if not line.strip():
+            continue
+        result = json.loads(line)
+        index = _request_index(result["custom_id"])
+        response = result.get("response") or {}
+        if response.get("status_code") != 200:
+            print(
+                f"Warning: batch request {result['custom_id']} failed: "
+                f"{result.get('error') or response.get('body')}"
+            )
+            if record:
+                with track_call(model) as call:
+                    call.error = True
+            continue
+        body = response["body"]
+        outputs[index] = body["choices"][0]["message"]["content"]
+        if record:
+            with track_call(model):
+                usage = body.get("usage") or {}
+                record_usage(
+                    usage.get("prompt_tokens"),
+                    usage.get("completion_tokens"),
+                    (usage.get("prompt_tokens_details") or {}).get("cached_tokens")
+                    or 0,
+                )
+    return outputs
+
+
+class OpenAIBatchTransport(BatchTransport):
+    """Runs a batch as an OpenAI Batch API job, polling it every `poll_interval`
+    seconds until it is done."""
+
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL, completion_window="24h"):
+        self.poll_interval = poll_interval
+        self.completion_window = completion_window
+
+    def run(self, model, requests):
+        # a batch job runs on one endpoint
+        api_dict = get_model_endpoint_pool(model).pick().config
+        client = get_client(
+            "openai", api_base=api_dict.get("api_base"), api_key=api_dict.get("api_key")
+        )
+        data = "".join(
+            json.dumps(line, ensure_ascii=False) + "\n"
+            for line in openai_batch_lines(model, requests)
+        )
+        input_file = client.files.create(
+            file=("batch.jsonl", data.encode("utf-8")), purpose="batch"
+        )
+        batch = client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=self.completion_window,
+        )
+        print(
+            f"Submitted OpenAI batch {batch.id} of {len(requests)} requests "
+            f"to `{model['model_name']}`"
+        )
+        while batch.status not in ("completed", "failed", "expired", "cancelled"):
+            time.sleep(self.poll_interval)
+            batch = client.batches.retrieve(batch.id)
+        if batch.status != "completed":
+            print(f"Warning: OpenAI batch {batch.id} ended as {batch.status}")
+
+        lines = []
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if file_id:
+                lines.extend(client.files.content(file_id).text.splitlines())
+        return read_openai_batch_output(model, lines, len(requests))
+
+
+class AnthropicBatchTransport(BatchTransport):
+    """Runs a batch as an Anthropic message batch, polling it every
+    `poll_interval` seconds until it has ended."""
+
+    def __init__(self, poll_interval=DEFAULT_POLL_INTERVAL):
+        self.poll_interval = poll_interval
+
+    def run(self, model, requests):
+        api_dict = get_model_endpoint_pool(model).pick().config
+        client = get_client(
+            "anthropic",
+            api_base=api_dict.get("api_base"),
+            api_key=api_dict.get("api_key") or os.environ["ANTHROPIC_API_KEY"],
+        )
+        batch_requests = []
+        for i, request in enumerate(requests):
+            messages = fix_anthropic_message(list(request.messages))
+            system = ""
+            if messages[0]["role"] == "system":
+                system = messages[0]["content"]
+                messages = messages[1:]
+            batch_requests.append(
+                {
+                    "custom_id": _custom_id(i),
+                    "params": {
+                        "model": model["model_name"],
+                        "messages": messages,
+                        "system": system,
+                        "max_tokens": request.max_tokens
+                        or model.get("max_tokens")
+                        or DEFAULT_MAX_TOKENS,
+                        "temperature": request.temperature,
+                        "stop_sequences": [ANTHROPIC_HUMAN_PROMPT],
+                    },
+                }
+            )
+        batch = client.messages.batches.create(requests=batch_requests)
+        print(
+            f"Submitted Anthropic message batch {batch.id} of {len(requests)} "
+            f"requests to `{model['model_name']}`"
+        )
+        while batch.processing_status != "ended":
+            time.sleep(self.poll_interval)
+            batch = client.messages.batches.retrieve(batch.id)
+
+        outputs = [API_ERROR_OUTPUT] * len(requests)
+        for entry in client.messages.batches.results(batch.id):
+            with track_call(model) as call:
+                if entry.result.type != "succeeded":
+                    print(
+                        f"Warning: batch request {entry.custom_id} ended as "
+                        f"{entry.result.type}"
+                    )
+                    call.error = True
+                    continue
+                message = entry.result.message
+                outputs[_request_index(entry.custom_id)] = message.content[0].text
+                record_usage(message.usage.input_tokens, message.usage.output_tokens)
+        return outputs
+
+
+class LocalBatchTransport(BatchTransport):
+    """File-based stand-in for a batch API, for testing.
+
+    Every batch is written to `directory` as an OpenAI Batch API input file,
+    served line by line with `utils.achat_completion` and written to an output
+    file in the Batch API format, which is then read back. The files are kept
+    for inspection.
+    """
+
+    def __init__(self, directory=DEFAULT_BATCH_DIR):
+        self.directory = directory
+
+    def run(self, model, requests):
+        os.makedirs(self.directory, exist_ok=True)
+        name = (
+            f"{time.strftime('%Y%m%d-%H%M%S')}_{next(_BATCH_COUNTER)}_"
+            f"{model['model_name'].replace('/', '_')}"
+        )
+        input_path = os.path.join(self.directory, f"{name}_input.jsonl")
+        output_path = os.path.join(self.directory, f"{name}_output.jsonl")
+        with open(input_path, "w") as f:
+            for line in openai_batch_lines(model, requests):
+                f.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+        with open(input_path, "r") as f:
+            input_lines = [json.loads(line) for line in f]
+
+        async def serve(line, request):
+            body = line["body"]
+            output = await achat_completion(
+                model,
+                body["messages"],
+                temperature=body["temperature"],
+                max_tokens=body["max_tokens"],
+                json_mode="response_format" in body,
+                seed=body.get("seed"),
+                stop_at_json=request.stop_at_json,
+                refresh_cache=request.refresh_cache,
+            )
+            if output == API_ERROR_OUTPUT:
+                return {
+                    "custom_id": line["custom_id"],
+                    "response": None,
+                    "error": {"message": "request failed"},
+                }
+            return {
+                "custom_id": line["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "model": body["model"],
+                        "choices": [
+                            {
+                                "index": 0,
+                                "message": {"role": "assistant", "content": output},
+                                "finish_reason": "stop",
+                            }
+                        ],
+                    },
+                },
+                "error": None,
+            }
+
+        async def serve_all():
+            return await asyncio.gather(*[
+                    serve(line, request)
+                    for line, request in zip(input_lines, requests)
+                ])
+
+        with open(output_path, "w") as f:
+            for result in run_sync(serve_all()):
+                f.write(json.dumps(result, ensure_ascii=False) + "\n")
+
+        with open(output_path, "r") as f:
+            # the calls were recorded by achat_completion
+            return read_openai_batch_output(
+                model, f.readlines(), len(requests), record=False
+            )
+
+
+def make_batch_transport(
+    model, mode="auto", batch_dir=DEFAULT_BATCH_DIR, poll_interval=DEFAULT_POLL_INTERVAL
+):
+    """The transport of `model` for `mode`, one of `BATCH_TRANSPORTS`.
+
+    In "auto" mode, models of the OpenAI and Anthropic APIs use their batch APIs
+    and all other endpoints get the whole batch at once.
+    """
+    if mode == "local":
+        return LocalBatchTransport(batch_dir)
+    if mode == "server":
+        return ServerBatchTransport()
+    api_base = get_endpoint_label(model)
+    if model["api_type"] == "openai" and not api_base:
+        return OpenAIBatchTransport(poll_interval)
+    if model["api_type"] == "anthropic" and not api_base:
+        return AnthropicBatchTransport(poll_interval)
+    return ServerBatchTransport()
+
+
+class WaveScheduler:
+    """Answers the steps of many examples in lockstep waves of batches.
+
+    `transport`, `batch_dir` and `poll_interval` select the transport of every
+    model, see `make_batch_transport`. With an `opening_store`, stored opening
+    turns are reused and the new ones are added to it. Unusable judge responses
+    are requested again in another batch, at most `max_judge_retry` times.
+    """
+
+    def __init__(
+        self,
+        judger_model,
+        transport="auto",
+        batch_dir=DEFAULT_BATCH_DIR,
+        poll_interval=DEFAULT_POLL_INTERVAL,
+        opening_store=None,
+        max_judge_retry=JUDGE_MAX_RETRY,
+    ):
+        self.judger_model = judger_model
+        self.transport = transport
+        self.batch_dir = batch_dir
+        self.poll_interval = poll_interval
+        self.opening_store = opening_store
+        self.max_judge_retry = max_judge_retry
+        self.waves = 0
+        self._transports = {}
+
+    def get_transport(self, model):
+        key = (
+            model["api_type"],
+            get_endpoint_label(model),
+            model["model_name"],
+        )
+        if key not in self._transports:
+            self._transports[key] = make_batch_transport(
+                model, self.transport, self.batch_dir, self.poll_interval
+            )
+        return self._transports[key]
+
+    def run_batches(self, requests):
+        """Run (model, request) pairs as one batch per model, all at the same time,
+        and return the responses in order."""
+        groups = {}
+        for i, (model, request) in enumerate(requests):
+            key = json.dumps(
+                [model["api_type"], get_model_endpoints(model), model["model_name"]],
+                sort_keys=True,
+            )
+            groups.setdefault(key, (model, []))[1].append((i, request))
+
+        responses = [None] * len(requests)
+        with ThreadPoolExecutor(max_workers=max(1, len(groups))) as executor:
+            futures = [
+                (
+                    group,
+                    executor.submit(
+                        copy_context().run,
+                        self.get_transport(model).run,
+                        model,
+                        [request for _, request in group],
+                    ),
+                )
+                for model, group in groups.values()
+            ]
+            for group, future in futures:
+                for (i, _), response in zip(group, future.result()):
+                    responses[i] = response
+        return responses
+
+    def candidate_wave(self, steps):
+        """Responses of both candidates of every `CandidatesStep` in `steps`."""
+        requests = []
+        for step in steps.values():
+            for model in (step.model_a, step.model_b):
+                requests.append(
+                    (model, BatchRequest(step.messages, stop_at_json=step.stop_at_json))
+                )
+        with labels(role="candidate"):
+            responses = self.run_batches(requests)
+        return {
+            key: (responses[2 * i], responses[2 * i + 1])
+            for i, key in enumerate(steps)
+        }
+
+    def judge_wave(self, steps, example_ids):
+        """Usable judge responses of the `JudgeStep`s in `steps`, retried in new
+        batches while unusable. Steps without a usable response are left out."""
+        responses = {}
+        pending = {}
+        for key, step in steps.items():
+            if step.opening and self.opening_store is not None:
+                response = self.opening_store.lookup(example_ids[key], step.messages)
+                if response is not None:
+                    responses[key] = response
+                    continue
+            JUDGE_STATS.record_call()
+            pending[key] = step
+
+        json_mode = self.judger_model.get("json_mode", False)
+        for attempt in range(self.max_judge_retry):
+            if not pending:
+                break
+            requests = []
+            for step in pending.values():
+                seed = None
+                if step.opening and self.opening_store is not None:
+                    seed = self.opening_store.seed + attempt
+                requests.append(
+                    (
+                        self.judger_model,
+                        # a cached response that failed to parse must not be served again
+                        BatchRequest(
+                            step.messages,
+                            seed=seed,
+                            json_mode=json_mode,
+                            refresh_cache=attempt > 0,
+                        ),
+                    )
+                )
+            with labels(role="judge"):
+                batch_responses = self.run_batches(requests)
+
+            for (key, step), response in zip(list(pending.items()), batch_responses):
+                reason = judger_response_problem(response)
+                if reason is None:
+                    responses[key] = response
+                    del pending[key]
+                    if step.opening and self.opening_store is not None:
+                        self.opening_store.put(example_ids[key], step.messages, response)
+                    continue
+                print(
+                    f"Warning: unusable judge response ({reason}), "
+                    f"attempt {attempt + 1}"
+                )
+                JUDGE_STATS.record_failed_attempt(
+                    reason, num_message_tokens(step.messages) + num_tokens(response)
+                )
+
+        for key in pending:
+            JUDGE_STATS.record_failed_call()
+        return responses
+
+    def run(self, examples):
+        """Run `examples`, (key, example id, steps generator) tuples, in waves.
+
+        Yields (key, result) in the order of `examples`, like
+        `utils.ordered_parallel_map`, so a batched run writes its results in the
+        same order as a regular one. Examples that finish early are held back
+        until the ones before them are done. The result is None if the judge gave
+        no usable response within its retry budget.
+        """
+        active = {}
+        example_ids = {}
+        order = deque()
+        finished = {}
+        for key, example_id, steps in examples:
+            active[key] = (steps, next(steps))
+            example_ids[key] = example_id
+            order.append(key)
+
+        while active:
+            self.waves += 1
+            candidate_steps = {
+                key: step
+                for key, (_, step) in active.items()
+                if isinstance(step, CandidatesStep)
+            }
+            judge_steps = {
+                key: step
+                for key, (_, step) in active.items()
+                if not isinstance(step, CandidatesStep)
+            }
+            responses = {}
+            if candidate_steps:
+                responses.update(self.candidate_wave(candidate_steps))
+            if judge_steps:
+                responses.update(self.judge_wave(judge_steps, example_ids))
+
+            for key in list(active):
+                steps, _ = active[key]
+                if key not in responses:
+                    del active[key]
+                    error = JudgeError(
+                        f"No usable judge response after {self.max_judge_retry} attempts"
+                    )
+                    print(f"Warning: skipping example {example_ids[key]}: {error}")
+                    finished[key] = None
+                    continue
+                try:
+                    active[key] = (steps, steps.send(responses[key]))
+                except StopIteration as e:
+                    del active[key]
+                    finished[key] = e.value
+
+            while order and order[0] in finished:
+                key = order.popleft()
+                yield key, finished.pop(key)
@@ -0,0 +1,122 @@
+"""
+A/B comparison of full and compacted judge contexts.
+
+Rounds of existing full-context result files are judged again with the
+compacted context of `--judge_context compact`, and the new verdicts are compared
+with the recorded ones. The judge samples its verdicts, so with `--rejudge_full`
+every round is also judged again with the full context, which gives the rate at
+which the judge agrees with itself as the baseline for the compacted agreement.
+
+Usage (from the repository root):
+    python -m benchmarks.ab_judge_context --subset scene --num_rounds 200 --workers 8
+"""
+import os
+import random
+import argparse
+
+from tqdm.auto import tqdm
+
+from calculate_metrics import read_eval_results
+from utils import (
+    make_config,
+    chat_completion_judger,
+    compact_judger_messages,
+    extract_winner,
+    get_record_winner,
+    num_message_tokens,
+    ordered_parallel_map,
+    JudgeError,
+)
+
+
+def load_rounds(label_result_dir):
+    """Rounds of full-context result files that have earlier rounds to compact."""
+    rounds = []
+    for file in sorted(os.listdir(label_result_dir)):
+        if not file.endswith(".jsonl"):
+            continue
+        for round_record in read_eval_results(os.path.join(label_result_dir, file)):
+            if "judge_context" in getattr(round_record, "example", {}):
+                continue
+            # system prompt, opening turn and current round leave nothing to compact
+            if (
+                get_record_winner(round_record) is not None
+                and len(round_record["judger_messages"]) > 4
+            ):
+                rounds.append(round_record)
+    return rounds
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--label_result_dir", type=str, default="results")
+    parser.add_argument(
+        "--subset", type=str, choices=["character", "scene"], required=True
+    )
+    parser.add_argument("--num_rounds", type=int, default=200)
+    parser.add_argument("--judge_token_budget", type=int, default=None)
+    parser.add_argument(
+        "--rejudge_full",
+        action="store_true",
+        help="Also judge every round again with the full context",
+    )
+    parser.add_argument("--workers", type=int, default=1)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    judger_config = make_config("config/judger_config.yaml")
+    assert len(judger_config) == 1, "Judger config should have only one model"
+    judger_model = list(judger_config.values())[0]
+
+    rounds = load_rounds(os.path.join(args.label_result_dir, args.subset))
+    assert rounds, f"No full-context rounds found in {args.label_result_dir}"
+    random.Random(args.seed).shuffle(rounds)
+    rounds = rounds[: args.num_rounds]
+    print(f"Judging {len(rounds)} rounds again")
+
+    def judge(round_record):
+        full_messages = round_record["judger_messages"]
+        compact_messages = compact_judger_messages(
+            full_messages, args.judge_token_budget
+        )
+        result = {
+            "recorded": get_record_winner(round_record),
+            "full_tokens": num_message_tokens(full_messages),
+            "compact_tokens": num_message_tokens(compact_messages),
+        }
+        try:
+            result["compact"] = extract_winner(
+                chat_completion_judger(judger_model, compact_messages)
+            )
+            if args.rejudge_full:
+                result["full"] = extract_winner(
+                    chat_completion_judger(judger_model, full_messages)
+                )
+        except JudgeError as e:
+            print(f"Warning: skipping round of example {round_record['id']}: {e}")
+            return None
+        return result
+
+    results = [
+        result
+        for result in tqdm(
+            ordered_parallel_map(judge, rounds, workers=args.workers), total=len(rounds)
+        )
+        if result is not None
+    ]
+    assert results, "No round could be judged"
+
+    full_tokens = sum(r["full_tokens"] for r in results)
+    compact_tokens = sum(r["compact_tokens"] for r in results)
+    agreement = sum(r["compact"] == r["recorded"] for r in results) / len(results)
+    print(f"Rounds judged: {len(results)}")
+    print(
+        f"Judge input tokens: ~{full_tokens} full, ~{compact_tokens} compacted "
+        f"({1 - compact_tokens / full_tokens:.1%} saved)"
+    )
+    print(f"Compacted verdict agrees with the recorded verdict: {agreement:.1%}")
+    if args.rejudge_full:
+        self_agreement = sum(r["full"] == r["recorded"] for r in results) / len(
+            results
+        )
+        print(f"Full verdict agrees with the recorded verdict:      {self_agreement:.1%}")
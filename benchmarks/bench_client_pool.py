@@ -0,0 +1,127 @@
+"""
+Micro-benchmark of the per-request overhead saved by the shared API clients.
+
+Starts the local mock LLM server of `mock_server` and sends the same chat request
+through a freshly constructed client per call (the old behaviour) and through the
+pooled client, on both paths: `openai.OpenAI` and `utils.get_client` from a thread
+pool, and `openai.AsyncOpenAI` and `utils.get_async_client` from concurrent tasks
+on one event loop, which is how the eval scripts send their requests.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_client_pool --num_requests 500 --threads 8
+"""
+import argparse
+import asyncio
+import statistics
+import time
+
+from concurrent.futures import ThreadPoolExecutor
+
+import openai
+
+from mock_server import MockLLMServer
+from utils import get_async_client, get_client
+
+MESSAGES = [{"role": "user", "content": "Hello!"}]
+
+
+def fresh_client_request(api_base):
+    client = openai.OpenAI(base_url=api_base, api_key="mock")
+    client.chat.completions.create(model="mock", messages=MESSAGES)
+
+
+def pooled_client_request(api_base):
+    client = get_client("openai", api_base=api_base, api_key="mock")
+    client.chat.completions.create(model="mock", messages=MESSAGES)
+
+
+async def afresh_client_request(api_base):
+    async with openai.AsyncOpenAI(base_url=api_base, api_key="mock") as client:
+        await client.chat.completions.create(model="mock", messages=MESSAGES)
+
+
+async def apooled_client_request(api_base):
+    client = get_async_client("openai", api_base=api_base, api_key="mock")
+    await client.chat.completions.create(model="mock", messages=MESSAGES)
+
+
+def bench(fn, api_base, num_requests, threads):
+    latencies = []
+
+    def timed(_):
+        start = time.perf_counter()
+        fn(api_base)
+        latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=threads) as executor:
+        list(executor.map(timed, range(num_requests)))
+    elapsed = time.perf_counter() - start
+    return elapsed, statistics.median(latencies) * 1000
+
+
+async def abench(fn, api_base, num_requests, concurrency):
+    latencies = []
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def timed():
+        async with semaphore:
+            start = time.perf_counter()
+            await fn(api_base)
+            latencies.append(time.perf_counter() - start)
+
+    start = time.perf_counter()
+    await asyncio.gather(*(timed() for _ in range(num_requests)))
+    elapsed = time.perf_counter() - start
+    return elapsed, statistics.median(latencies) * 1000
+
+
+async def abench_all(api_base, num_requests, concurrency):
+    # warm up the pooled client of this loop
+    await apooled_client_request(api_base)
+    results = {}
+    for name, fn in [
+        ("fresh", afresh_client_request),
+        ("pooled", apooled_client_request),
+    ]:
+        results[name] = await abench(fn, api_base, num_requests, concurrency)
+    return results
+
+
+def report(path, results, num_requests, concurrency):
+    for name, (elapsed, p50) in results.items():
+        print(
+            f"{path:>5} {name:>6}: {num_requests / elapsed:8.1f} req/s, "
+            f"p50 latency {p50:6.2f} ms"
+        )
+    saved = (results["fresh"][0] - results["pooled"][0]) / num_requests * concurrency
+    print(f"{path:>5} per-request overhead saved: {saved * 1000:.2f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_requests", type=int, default=500)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument(
+        "--concurrency",
+        type=int,
+        default=None,
+        help="Requests in flight on the async path, defaults to --threads",
+    )
+    args = parser.parse_args()
+    concurrency = args.concurrency or args.threads
+
+    server = MockLLMServer().start()
+    api_base = f"{server.url}/v1"
+
+    # warm up imports and the pooled client
+    pooled_client_request(api_base)
+
+    results = {}
+    for name, fn in [("fresh", fresh_client_request), ("pooled", pooled_client_request)]:
+        results[name] = bench(fn, api_base, args.num_requests, args.threads)
+    report("sync", results, args.num_requests, args.threads)
+
+    results = asyncio.run(abench_all(api_base, args.num_requests, concurrency))
+    report("async", results, args.num_requests, concurrency)
+    server.stop()
@@ -0,0 +1,424 @@
+"""
+End-to-end throughput benchmark of the eval scripts against the mock LLM server.
+
+Starts a `mock_server.MockLLMServer` and runs `eval_models_pairwise` of
+`run_character_eval` and / or `run_scene_eval` against it, with an OpenAI-type
+and an Anthropic-type candidate and an OpenAI-type judge served by the mock.
+The runs happen in a temporary working directory, so configs, results, caches
+and telemetry of the repository are left untouched. For every subset it reports
+examples/sec, the p50 / p95 latency of a round (both candidate requests and the
+judge request) and the retry overhead, i.e. the share of requests received by
+the server that did not produce a used response: HTTP errors, 429s and
+unusable judge verdicts. Every HTTP error and 429 of the server must show up as
+a retry in the telemetry, the run fails if they do not match. With
+`--stream`, the time to first token and the output speed of every model are
+reported as well, to compare the serving speed of the endpoints. With
+`--batched`, the examples advance turn by turn in batches, see
+`batch.WaveScheduler`; the mock endpoints get every batch at once, or through
+the file-based batch stand-in with `--batch_transport local`. With
+`--replicas N`, every model is served by N mock servers that are listed as its
+endpoints and routed with `--endpoint_policy`, and `--failing_replicas K` makes
+the first K of them answer every request with an HTTP 500, to check the
+ejection and failover of unhealthy endpoints.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_e2e --limit 20 --workers 8 --latency lognormal:0.2,0.5 \
+        --rate_limit_rate 0.05 --judge_formats valid=0.9,fenced=0.05,malformed=0.05
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import argparse
+import threading
+
+import numpy as np
+
+import run_character_eval
+import run_scene_eval
+from mock_server import add_mock_server_args, make_mock_server
+from telemetry import TELEMETRY
+from batch import BATCH_TRANSPORTS
+from load_balancer import ENDPOINT_POLICIES
+from utils import (
+    get_model_endpoint_pool,
+    get_result_path,
+    make_config,
+    CandidatesStep,
+    JUDGE_STATS,
+)
+
+SUBSETS = {"character": run_character_eval, "scene": run_scene_eval}
+MODEL_1 = "mock-openai"
+MODEL_2 = "mock-anthropic"
+JUDGE = "mock-judge"
+
+
+def format_endpoints(server_urls, path=""):
+    """The `endpoints` field of a config, a single endpoint or a list of replicas."""
+    if len(server_urls) == 1:
+        return f"""
+        api_base: {server_urls[0]}{path}
+        api_key: mock"""
+    return "".join(
+        f"""
+        - api_base: {server_url}{path}
+          api_key: mock"""
+        for server_url in server_urls
+    )
+
+
+def write_configs(workdir, server_urls, rpm=None, endpoint_policy=None):
+    """Write candidate and judge configs that point at the mock servers."""
+    limits = f"\n    rpm: {rpm}" if rpm else ""
+    if endpoint_policy:
+        limits += f"\n    endpoint_policy: {endpoint_policy}"
+    os.makedirs(os.path.join(workdir, "config"))
+    with open(os.path.join(workdir, "config", "api_config.yaml"), "w") as f:
+        f.write(
+            f"""{MODEL_1}:
+    model_name: {MODEL_1}
+    api_type: openai
+    endpoints:{format_endpoints(server_urls, "/v1")}{limits}
+
+{MODEL_2}:
+    model_name: {MODEL_2}
+    api_type: anthropic
+    endpoints:{format_endpoints(server_urls)}{limits}
+"""
+        )
+    with open(os.path.join(workdir, "config", "judger_config.yaml"), "w") as f:
+        f.write(
+            f"""{JUDGE}:
+    model_name: {JUDGE}
+    api_type: openai
+    endpoints:{format_endpoints(server_urls, "/v1")}{limits}
+"""
+        )
+
+
+class RoundTimer:
+    """Times the rounds of an eval module, from the candidate requests to the verdict.
+
+    Wraps the `example_steps` generator of the module, a round starts when it
+    yields a `CandidatesStep` and ends when the following `JudgeStep` is answered,
+    so both the per-example and the batched runs are timed.
+    """
+
+    def __init__(self, module):
+        self.module = module
+        self.latencies = []
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        self.example_steps = example_steps = self.module.example_steps
+
+        def timed_example_steps(*args, **kwargs):
+            steps = example_steps(*args, **kwargs)
+            # the opening judge turn has no candidate requests before it
+            start = None
+            response = None
+            while True:
+                try:
+                    step = steps.send(response)
+                except StopIteration as e:
+                    return e.value
+                if isinstance(step, CandidatesStep):
+                    start = time.perf_counter()
+                response = yield step
+                if not isinstance(step, CandidatesStep) and start is not None:
+                    with self._lock:
+                        self.latencies.append(time.perf_counter() - start)
+                    start = None
+
+        self.module.example_steps = timed_example_steps
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.module.example_steps = self.example_steps
+
+
+def count_lines(path):
+    if not os.path.exists(path):
+        return 0
+    with open(path, "r") as f:
+        return sum(1 for line in f if line.strip())
+
+
+def count_ejections():
+    """Endpoint ejections so far of the models of the written configs."""
+    models = list(make_config("config/api_config.yaml").values()) + list(
+        make_config("config/judger_config.yaml").values()
+    )
+    return sum(
+        endpoint["ejections"]
+        for model in models
+        for endpoint in get_model_endpoint_pool(model).stats()
+    )
+
+
+def bench_subset(subset, servers, args):
+    module = SUBSETS[subset]
+    for server in servers:
+        server.reset_stats()
+    ejections = count_ejections()
+    # only scene candidates answer with a JSON object
+    extra_kwargs = {"stop_at_json": args.stop_at_json} if subset == "scene" else {}
+    start = time.perf_counter()
+    with RoundTimer(module) as timer:
+        module.eval_models_pairwise(
+            MODEL_1,
+            MODEL_2,
+            workers=args.workers,
+            parallel_candidates=args.parallel_candidates,
+            cache=args.cache,
+            prompt_cache=args.prompt_cache,
+            stream=args.stream,
+            batched=args.batched,
+            batch_transport=args.batch_transport,
+            limit=args.limit,
+            seed=args.seed,
+            telemetry_out=os.path.join("telemetry", f"bench_e2e_{subset}.json"),
+            **extra_kwargs,
+        )
+    elapsed = time.perf_counter() - start
+
+    replica_stats = [server.stats() for server in servers]
+    served = {}
+    for stats in replica_stats:
+        for key, value in stats.items():
+            served[key] = served.get(key, 0) + value
+    telemetry = TELEMETRY.summary()
+    totals = telemetry["totals"]
+    judge_stats = JUDGE_STATS.summary()
+    examples = count_lines(
+        get_result_path(os.path.join("results", subset), MODEL_1, MODEL_2)
+    )
+    requests = served.get("requests", 0)
+    # every API call that returned a response other than a retried judge verdict
+    used = totals["calls"] - totals["cache_hits"] - totals["errors"]
+    used -= judge_stats["retries"]
+    result = {
+        "subset": subset,
+        "examples": examples,
+        "seconds": elapsed,
+        "examples_per_sec": examples / elapsed,
+        "rounds": len(timer.latencies),
+        "round_latency_p50": float(np.percentile(timer.latencies, 50))
+        if timer.latencies
+        else None,
+        "round_latency_p95": float(np.percentile(timer.latencies, 95))
+        if timer.latencies
+        else None,
+        "api_calls": totals["calls"],
+        "cache_hits": totals["cache_hits"],
+        "prompt_tokens": totals["prompt_tokens"],
+        "cached_prompt_tokens": totals["cached_prompt_tokens"],
+        "client_retries": totals["retries"],
+        "judge_retries": judge_stats["retries"],
+        "server_requests": requests,
+        "server_errors": served.get("errors", 0),
+        "server_rate_limited": served.get("rate_limited", 0),
+        "malformed_verdicts": served.get("judge_malformed", 0),
+        "retry_overhead": (requests - used) / requests if requests else 0.0,
+        # failed requests the telemetry does not know about
+        "unrecorded_retries": served.get("errors", 0)
+        + served.get("rate_limited", 0)
+        - totals["retries"],
+        "streams_cancelled": served.get("streams_cancelled", 0),
+        "replica_requests": [stats.get("requests", 0) for stats in replica_stats],
+        "endpoint_ejections": count_ejections() - ejections,
+        "serving": [
+            {
+                key: group.get(key)
+                for key in (
+                    "model",
+                    "role",
+                    "streamed_calls",
+                    "ttft_p50",
+                    "ttft_p95",
+                    "output_tokens_per_sec",
+                    "cut_offs",
+                )
+            }
+            for group in telemetry["groups"]
+            if group["streamed_calls"]
+        ],
+    }
+    return result
+
+
+def print_result(result):
+    print(
+        f"{result['subset']:>9}: {result['examples']} examples in "
+        f"{result['seconds']:.1f}s, {result['examples_per_sec']:.2f} examples/s"
+    )
+    if result["rounds"]:
+        print(
+            f"           {result['rounds']} rounds, round latency "
+            f"p50 {result['round_latency_p50'] * 1000:.0f} ms, "
+            f"p95 {result['round_latency_p95'] * 1000:.0f} ms"
+        )
+    print(
+        f"           {result['server_requests']} requests served "
+        f"({result['server_errors']} errors, {result['server_rate_limited']} rate "
+        f"limited, {result['malformed_verdicts']} malformed verdicts), "
+        f"{result['client_retries']} client retries, {result['judge_retries']} "
+        f"judge retries, retry overhead {result['retry_overhead']:.1%}"
+    )
+    if result["unrecorded_retries"]:
+        print(
+            f"           {result['server_errors'] + result['server_rate_limited']} "
+            f"failed requests served but {result['client_retries']} retries recorded"
+        )
+    if len(result["replica_requests"]) > 1:
+        print(
+            f"           requests per replica: "
+            f"{', '.join(str(n) for n in result['replica_requests'])}, "
+            f"{result['endpoint_ejections']} endpoint ejections"
+        )
+    if result["cached_prompt_tokens"]:
+        print(
+            f"           {result['cached_prompt_tokens']} of "
+            f"{result['prompt_tokens']} prompt tokens read from the prompt cache"
+        )
+    for serving in result["serving"]:
+        line = (
+            f"           {serving['role']} {serving['model']}: TTFT p50 "
+            f"{serving['ttft_p50'] * 1000:.0f} ms, p95 {serving['ttft_p95'] * 1000:.0f} ms"
+        )
+        if serving["output_tokens_per_sec"] is not None:
+            line += f", {serving['output_tokens_per_sec']:.0f} tokens/s"
+        if serving["cut_offs"]:
+            line += f", {serving['cut_offs']} cut off after the JSON object"
+        print(line)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--subsets",
+        type=str,
+        nargs="+",
+        choices=list(SUBSETS),
+        default=list(SUBSETS),
+    )
+    parser.add_argument("--limit", type=int, default=20)
+    parser.add_argument("--workers", type=int, default=8)
+    parser.add_argument("--parallel_candidates", action="store_true")
+    parser.add_argument(
+        "--cache", type=str, choices=["off", "read", "readwrite"], default="off"
+    )
+    parser.add_argument("--prompt_cache", action="store_true")
+    parser.add_argument("--stream", action="store_true")
+    parser.add_argument(
+        "--stop_at_json",
+        action="store_true",
+        help="Stop the streamed scene candidates after their JSON object",
+    )
+    parser.add_argument(
+        "--rpm",
+        type=int,
+        default=None,
+        help="Client-side requests per minute of every mock endpoint",
+    )
+    parser.add_argument(
+        "--batched",
+        action="store_true",
+        help="Advance all examples turn by turn in batched requests",
+    )
+    parser.add_argument(
+        "--batch_transport",
+        type=str,
+        choices=BATCH_TRANSPORTS,
+        default="auto",
+        help="How the batches of --batched are sent to the mock server",
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    add_mock_server_args(parser)
+    parser.add_argument(
+        "--replicas",
+        type=int,
+        default=1,
+        help="Serve every model from this many mock servers, listed as its endpoints",
+    )
+    parser.add_argument(
+        "--failing_replicas",
+        type=int,
+        default=0,
+        help="Make the first K replicas answer every request with an HTTP 500",
+    )
+    parser.add_argument(
+        "--endpoint_policy",
+        type=str,
+        choices=ENDPOINT_POLICIES,
+        default=None,
+        help="Routing policy of the replicas, see load_balancer",
+    )
+    parser.add_argument(
+        "--json_out", type=str, default=None, help="Also write the results as JSON"
+    )
+    parser.add_argument(
+        "--min_examples_per_sec",
+        type=float,
+        default=None,
+        help="Exit with an error if a subset runs slower, for CI regression checks",
+    )
+    parser.add_argument(
+        "--keep_workdir",
+        action="store_true",
+        help="Keep the working directory with the results and telemetry of the runs",
+    )
+    args = parser.parse_args()
+
+    repo_dir = os.getcwd()
+    workdir = tempfile.mkdtemp(prefix="rpbench_bench_e2e_")
+    servers = []
+    for i in range(args.replicas):
+        server = make_mock_server(args, seed=args.seed + i)
+        if i < args.failing_replicas:
+            server.error_rate = 1.0
+        servers.append(server.start())
+    results = []
+    try:
+        write_configs(
+            workdir,
+            [server.url for server in servers],
+            rpm=args.rpm,
+            endpoint_policy=args.endpoint_policy,
+        )
+        os.symlink(os.path.join(repo_dir, "data"), os.path.join(workdir, "data"))
+        os.chdir(workdir)
+        for subset in args.subsets:
+            results.append(bench_subset(subset, servers, args))
+    finally:
+        os.chdir(repo_dir)
+        for server in servers:
+            server.stop()
+        if args.keep_workdir:
+            print(f"Working directory kept at {workdir}")
+        else:
+            shutil.rmtree(workdir)
+
+    print()
+    for result in results:
+        print_result(result)
+    if args.json_out:
+        with open(args.json_out, "w") as f:
+            json.dump(results, f, indent=2)
+        print(f"Results written to {args.json_out}")
+    unrecorded = [result["subset"] for result in results if result["unrecorded_retries"]]
+    if unrecorded:
+        print(f"Retries missing from the telemetry: {', '.join(unrecorded)}")
+        sys.exit(1)
+    if args.min_examples_per_sec is not None:
+        slow = [
+            result["subset"]
+            for result in results
+            if result["examples_per_sec"] < args.min_examples_per_sec
+        ]
+        if slow:
+            print(f"Below {args.min_examples_per_sec} examples/s: {', '.join(slow)}")
+            sys.exit(1)
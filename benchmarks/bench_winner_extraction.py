@@ -0,0 +1,83 @@
+"""
+Benchmark of winner extraction from judge responses.
+
+Compares `extract_and_parse_json(...)["winner"]`, which `calculate_metrics` used
+before, with `extract_winner` on the judge responses found in the result files.
+If there are no result files, a synthetic mix of plain, fenced and malformed
+judge responses is used instead.
+
+Usage (from the repository root):
+    python -m benchmarks.bench_winner_extraction --label_result_dir results
+"""
+import os
+import json
+import time
+import random
+import argparse
+
+from utils import extract_and_parse_json, extract_winner, iter_rounds
+
+
+def load_judger_responses(label_result_dir):
+    responses = []
+    for subset in ["character", "scene"]:
+        subset_dir = os.path.join(label_result_dir, subset)
+        if not os.path.isdir(subset_dir):
+            continue
+        for file in os.listdir(subset_dir):
+            if file.endswith(".jsonl"):
+                with open(os.path.join(subset_dir, file), "r") as f:
+                    for line in f:
+                        for round_record in iter_rounds(json.loads(line)):
+                            responses.append(round_record["judger_response"])
+    return responses
+
+
+def synthetic_judger_responses(num, seed=0):
+    rng = random.Random(seed)
+    responses = []
+    for i in range(num):
+        obj = {
+            "winner": rng.choice(["model_a", "model_b"]),
+            "next_round_user_speaks": "Well, " * rng.randint(5, 60),
+            "decision_reason": "Model stays in character. " * rng.randint(5, 30),
+        }
+        text = json.dumps(obj)
+        kind = i % 10
+        if kind < 3:
+            text = f"```json\n{text}\n```"
+        elif kind == 9:
+            # trailing comma and missing closing brace
+            text = text[:-1] + ", "
+        responses.append(text)
+    return responses
+
+
+def bench(fn, responses):
+    start = time.perf_counter()
+    winners = [fn(text) for text in responses]
+    return time.perf_counter() - start, winners
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--label_result_dir", type=str, default="results")
+    parser.add_argument("--num_synthetic", type=int, default=20000)
+    args = parser.parse_args()
+
+    responses = load_judger_responses(args.label_result_dir)
+    if responses:
+        print(f"Loaded {len(responses)} judge responses from {args.label_result_dir}")
+    else:
+        responses = synthetic_judger_responses(args.num_synthetic)
+        print(f"No result files found, using {len(responses)} synthetic responses")
+
+    baseline_time, expected = bench(
+        lambda text: extract_and_parse_json(text)["winner"], responses
+    )
+    fast_time, winners = bench(extract_winner, responses)
+    print(f"extract_and_parse_json: {baseline_time:.3f}s")
+    print(f"extract_winner:         {fast_time:.3f}s")
+    print(f"Speedup: {baseline_time / fast_time:.1f}x")
+    mismatches = sum(a != b for a, b in zip(expected, winners))
+    print(f"Mismatched winners: {mismatches}")
@@ -8,8 +8,110 @@ import matplotlib.pyplot as plt
 from tqdm import tqdm
 
 from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
 from typing import Dict
-from utils import extract_and_parse_json
+from collections.abc import Mapping
+from match_store import load_matches
+from utils import compact_judger_messages
+
+
+class RoundRecord(Mapping):
+    """Read-only view of one round of a compact eval result record.
+
+    Behaves like the per-round records of older result files: besides the round's
+    own fields it provides "id", "candidate_messages" (the messages sent to the
+    candidates in this round) and "judger_messages" (the messages sent to the
+    judge in this round, compacted if the run compacted the judge context). The
+    transcripts are only rebuilt when accessed.
+    """
+
+    _LAZY_KEYS = ("candidate_messages", "judger_messages")
+
+    def __init__(self, example, round_index):
+        self.example = example
+        self.round_index = round_index
+        self.fields = dict(example["rounds"][round_index], id=example["id"])
+
+    def __getitem__(self, key):
+        if key == "candidate_messages":
+            return self.candidate_messages()
+        elif key == "judger_messages":
+            return self.judger_messages()
+        return self.fields[key]
+
+    def __iter__(self):
+        yield from self.fields
+        yield from self._LAZY_KEYS
+
+    def __len__(self):
+        return len(self.fields) + len(self._LAZY_KEYS)
+
+    def _previous_rounds(self):
+        return self.example["rounds"][: self.round_index]
+
+    def candidate_messages(self):
+        messages = [
+            {"role": "system", "content": self.example["candidate_system"]},
+            {"role": "assistant", "content": self.example["greeting"]},
+        ]
+        for previous in self._previous_rounds():
+            winner_response = (
+                previous["model_a_response"]
+                if previous["winner"] == "model_a"
+                else previous["model_b_response"]
+            )
+            messages.append({"role": "user", "content": previous["user"]})
+            messages.append({"role": "assistant", "content": winner_response})
+        messages.append({"role": "user", "content": self.fields["user"]})
+        return messages
+
+    def judger_messages(self):
+        greeting = self.example["greeting"]
+        messages = [
+            {"role": "system", "content": self.example["judger_system"]},
+            {
+                "role": "user",
+                "content": json.dumps({"model_a": greeting, "model_b": greeting}),
+            },
+            {"role": "assistant", "content": self.example["opening_judger_response"]},
+        ]
+        for previous in self._previous_rounds() + [self.fields]:
+            messages.append(
+                {
+                    "role": "user",
+                    "content": json.dumps(
+                        {
+                            "model_a": previous["model_a_response"],
+                            "model_b": previous["model_b_response"],
+                        }
+                    ),
+                }
+            )
+            if previous is not self.fields:
+                messages.append(
+                    {"role": "assistant", "content": previous["judger_response"]}
+                )
+        judge_context = self.example.get("judge_context")
+        if judge_context is not None and judge_context["mode"] == "compact":
+            messages = compact_judger_messages(messages, judge_context["token_budget"])
+        return messages
+
+
+def read_eval_results(path):
+    """Iterate over the per-round records of a result file.
+
+    Compact records (one line per example) are expanded into `RoundRecord`s that
+    rebuild the transcripts lazily, older per-round records are returned as is.
+    """
+    with open(path, "r") as f:
+        for line in f:
+            record = json.loads(line)
+            if "rounds" in record:
+                for round_index in range(len(record["rounds"])):
+                    yield RoundRecord(record, round_index)
+            else:
+                yield record
 
 
 class EloCalculator:
@@ -38,22 +140,79 @@ class EloCalculator:
         else:
             raise NotImplementedError
 
-    def get_bootstrap_result(self, matches, num_round=100):
-        rows = []
-        matches_df = pd.DataFrame(matches, columns=["model_a", "model_b", "winner"])
-        for i in tqdm(range(num_round), desc="bootstrap"):
-            shuffled_matches = matches_df.sample(frac=1.0, replace=True)
-            matches = list(
-                zip(
-                    shuffled_matches["model_a"],
-                    shuffled_matches["model_b"],
-                    shuffled_matches["winner"],
+    def get_bootstrap_result(
+        self, matches, num_round=100, seed=None, batch_size=256, num_workers=1
+    ):
+        """Compute ratings on `num_round` bootstrap resamples of `matches`.
+
+        For the MLE method, the resample counts of all rounds are drawn at once from
+        a multinomial over the distinct pairings, and the rounds are fitted in
+        batches of `batch_size`, spread over `num_workers` processes. Other methods
+        refit one resample at a time. Pass a `seed` to make the result reproducible.
+        Returns a DataFrame with one row per round and one column per model.
+        """
+        rng = np.random.default_rng(seed)
+        if self.method == "mle":
+            df = self._bootstrap_mle(matches, num_round, rng, batch_size, num_workers)
+        else:
+            matches_df = pd.DataFrame(matches, columns=["model_a", "model_b", "winner"])
+            samples = [
+                list(
+                    zip(
+                        shuffled_matches["model_a"],
+                        shuffled_matches["model_b"],
+                        shuffled_matches["winner"],
+                    )
                 )
-            )
-            rows.append(self.score(matches))
-        df = pd.DataFrame(rows)
+                for shuffled_matches in (
+                    matches_df.sample(frac=1.0, replace=True, random_state=rng)
+                    for _ in range(num_round)
+                )
+            ]
+            if num_workers > 1:
+                with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                    rows = list(
+                        tqdm(
+                            executor.map(self._score_dict, samples),
+                            total=num_round,
+                            desc="bootstrap",
+                        )
+                    )
+            else:
+                rows = [
+                    self._score_dict(sample)
+                    for sample in tqdm(samples, desc="bootstrap")
+                ]
+            df = pd.DataFrame(rows)
         return df[df.median().sort_values(ascending=False).index]
 
+    def _score_dict(self, matches):
+        return dict(self.score(matches))
+
+    def _bootstrap_mle(self, matches, num_round, rng, batch_size, num_workers):
+        models, wins = bootstrap_win_matrices(matches, num_round, rng)
+        elo_scores = self.fit_win_matrices(wins, batch_size, num_workers)
+        return pd.DataFrame(elo_scores, columns=models)
+
+    def fit_win_matrices(self, wins, batch_size=256, num_workers=1):
+        """Fit MLE Elo ratings to a (num_round, p, p) stack of win matrices.
+
+        Returns a (num_round, p) array, NaN for models without games in a round.
+        """
+        batches = [wins[i : i + batch_size] for i in range(0, len(wins), batch_size)]
+        fit = partial(fit_bradley_terry, base=self.base)
+        if num_workers > 1 and len(batches) > 1:
+            with ProcessPoolExecutor(max_workers=num_workers) as executor:
+                coefs = list(executor.map(fit, batches))
+        else:
+            coefs = [fit(batch) for batch in tqdm(batches, desc="bootstrap")]
+        elo_scores = self.scale * np.concatenate(coefs) + self.init_rating
+
+        # models that did not play in a round get no rating, as with a refit
+        played = (wins + np.swapaxes(wins, 1, 2)).sum(axis=2) > 0
+        elo_scores[~played] = np.nan
+        return elo_scores
+
     def compute_whr(self, matches):
         """Compute ELO via the whole-history-rating package.
 
@@ -82,40 +241,16 @@ class EloCalculator:
         """Compute Elo ratings for a set of matches using maximum likelihood estimation.
 
         That means, we calculate the MLE estimator of the Bradley-Terry model for the given matches.
+        The matches are first aggregated into a win matrix, so the fit does not depend on the
+        number of matches.
         """
         rating = defaultdict(lambda: self.init_rating)
 
-        from sklearn.linear_model import LogisticRegression
-
-        df = pd.DataFrame(matches, columns=["model_a", "model_b", "winner"])
-        models = pd.concat([df["model_a"], df["model_b"]]).unique()
-        models = pd.Series(np.arange(len(models)), index=models)
-
-        # duplicate battles
-        df = pd.concat([df, df], ignore_index=True)
-        p = len(models.index)
-        n = df.shape[0]
-
-        X = np.zeros([n, p])
-        X[np.arange(n), models[df["model_a"]]] = +math.log(self.base)
-        X[np.arange(n), models[df["model_b"]]] = -math.log(self.base)
-
-        # one A win => two A win
-        Y = np.zeros(n)
-        Y[df["winner"] == df["model_a"]] = 1.0
-
-        # one tie => one A win + one B win
-        # find tie + tie (both bad) index
-        tie_idx = (df["winner"] == "tie") | (df["winner"] == "tie (bothbad)")
-        tie_idx[len(tie_idx) // 2 :] = False
-        Y[tie_idx] = 1.0
-
-        model = LogisticRegression(fit_intercept=False, penalty=None, tol=1e-8)
-        model.fit(X, Y)
-
-        elo_scores = self.scale * model.coef_[0] + self.init_rating
-        for i in range(p):
-            rating[models.index[i]] = elo_scores[i]
+        models, wins = aggregate_matches(matches)
+        coef = fit_bradley_terry(wins, base=self.base)
+        elo_scores = self.scale * coef + self.init_rating
+        for i, model in enumerate(models):
+            rating[model] = elo_scores[i]
         return rating
 
     def compute_online_elo(self, matches):
@@ -149,6 +284,149 @@ class EloCalculator:
         return rating
 
 
+def aggregate_pairings(matches):
+    """Group (model_a, model_b, winner) matches by distinct pairing and outcome.
+
+    Returns the list of models, a (k, 3) array of (model_a id, model_b id, score
+    of model_a) rows, one per distinct pairing, and the number of matches of each.
+    """
+    model_ids = {}
+    pairing_counts = defaultdict(int)
+    for model_a, model_b, winner in matches:
+        for model in (model_a, model_b):
+            if model not in model_ids:
+                model_ids[model] = len(model_ids)
+        if winner == model_a:
+            score = 1.0
+        elif winner == "tie" or winner == "tie (bothbad)":
+            score = 0.5
+        else:
+            score = 0.0
+        pairing_counts[(model_ids[model_a], model_ids[model_b], score)] += 1
+
+    pairings = np.array(list(pairing_counts), dtype=np.float64).reshape(-1, 3)
+    counts = np.array(list(pairing_counts.values()), dtype=np.int64)
+    return list(model_ids), pairings, counts
+
+
+def bootstrap_win_matrices(matches, num_round, rng):
+    """Draw `num_round` bootstrap resamples of `matches` as win matrices.
+
+    The resample counts of all rounds are drawn at once from a multinomial over
+    the distinct pairings and summed straight into the win matrices, so memory
+    grows with `num_round * p * p` rather than with a pairing-by-cell matrix.
+    Returns the list of models and a (num_round, p, p) stack of win matrices,
+    see `aggregate_matches`.
+    """
+    models, pairings, counts = aggregate_pairings(matches)
+    p = len(models)
+    a_ids = pairings[:, 0].astype(np.int64)
+    b_ids = pairings[:, 1].astype(np.int64)
+    scores = pairings[:, 2]
+
+    resample_counts = rng.multinomial(
+        counts.sum(), counts / counts.sum(), size=num_round
+    )
+    # cell of every (round, pairing) in the flattened stack of win matrices
+    offsets = (np.arange(num_round) * p * p)[:, None]
+    size = num_round * p * p
+    wins = np.bincount(
+        (offsets + a_ids * p + b_ids).ravel(),
+        weights=(resample_counts * scores).ravel(),
+        minlength=size,
+    )
+    wins += np.bincount(
+        (offsets + b_ids * p + a_ids).ravel(),
+        weights=(resample_counts * (1.0 - scores)).ravel(),
+        minlength=size,
+    )
+    return models, wins.reshape(num_round, p, p)
+
+
+def aggregate_matches(matches):
+    """Aggregate (model_a, model_b, winner) matches into a win matrix.
+
+    Returns the list of models, in order of first appearance, and a matrix whose
+    entry (i, j) is the number of wins of model i over model j. A tie counts as
+    half a win for each side.
+    """
+    models, pairings, counts = aggregate_pairings(matches)
+    p = len(models)
+    a_ids = pairings[:, 0].astype(np.int64)
+    b_ids = pairings[:, 1].astype(np.int64)
+    scores = pairings[:, 2]
+    wins = np.bincount(a_ids * p + b_ids, weights=counts * scores, minlength=p * p)
+    wins += np.bincount(
+        b_ids * p + a_ids, weights=counts * (1.0 - scores), minlength=p * p
+    )
+    return models, wins.reshape(p, p)
+
+
+# L2 penalty of the fits whose unpenalized maximum likelihood estimate is infinite
+SEPARABLE_C = 1.0
+
+
+def has_finite_mle(wins):
+    """Whether the unpenalized Bradley-Terry fit of `wins` has a finite solution.
+
+    That is the case if, among the models with games, every model beat every
+    other one directly or through a chain of wins. Otherwise the models can be
+    split into a group that never lost to the rest, e.g. one undefeated model,
+    whose ratings diverge. `wins` is a (p, p) matrix or a (batch, p, p) stack,
+    the result is a bool or a (batch,) array.
+    """
+    wins = np.asarray(wins, dtype=np.float64)
+    played = (wins + np.swapaxes(wins, -1, -2)).sum(axis=-1) > 0
+    reach = (wins > 0) | np.eye(wins.shape[-1], dtype=bool)
+    # square the reachability matrix until it covers paths of every length
+    for _ in range(max(1, math.ceil(math.log2(max(wins.shape[-1], 2))))):
+        reach = (reach.astype(np.float64) @ reach.astype(np.float64)) > 0
+    pairs = played[..., :, None] & played[..., None, :]
+    return np.all(reach | ~pairs, axis=(-2, -1))
+
+
+def fit_bradley_terry(
+    wins, base=10, C=None, separable_C=SEPARABLE_C, max_iter=100, tol=1e-8
+):
+    """Fit Bradley-Terry coefficients to a win matrix with Newton's method.
+
+    `wins` is a (p, p) matrix, or a (batch, p, p) stack of matrices that are
+    fitted together. Model i beats model j with probability
+    1 / (1 + base ** (coef[j] - coef[i])). With `C`, the coefficients carry the L2
+    penalty of sklearn's `LogisticRegression(fit_intercept=False, C=C)` fitted on
+    every match twice. By default the fit is unpenalized like the original
+    `penalty=None` fit, and as the likelihood only depends on differences, the
+    minimum-norm (zero-sum) solution is returned. Only matrices without a finite
+    solution, see `has_finite_mle`, e.g. bootstrap resamples of small subsets in
+    which a model never loses, get the penalty of `separable_C` to keep their
+    ratings finite. `separable_C=None` turns that off.
+    """
+    wins = np.asarray(wins, dtype=np.float64)
+    c = math.log(base)
+    games = wins + np.swapaxes(wins, -1, -2)
+    # every match counts twice in the likelihood sklearn penalizes
+    if C is not None:
+        ridge = np.full(wins.shape[:-2], 1.0 / (2.0 * C))
+    elif separable_C is not None:
+        ridge = np.where(has_finite_mle(wins), 0.0, 1.0 / (2.0 * separable_C))
+    else:
+        ridge = np.zeros(wins.shape[:-2])
+    ridge = ridge[..., None]
+    coef = np.zeros(wins.shape[:-1])
+    for _ in range(max_iter):
+        prob = 1.0 / (1.0 + np.exp(-c * (coef[..., :, None] - coef[..., None, :])))
+        grad = c * (wins - games * prob).sum(axis=-1) - ridge * coef
+        weights = c * c * games * prob * (1.0 - prob)
+        hessian = -weights
+        diagonal = np.einsum("...ii->...i", hessian)
+        diagonal += weights.sum(axis=-1) + ridge
+        step = (np.linalg.pinv(hessian) @ grad[..., None])[..., 0]
+        coef += step
+        if np.abs(step).max() < tol:
+            break
+    return coef
+
+
 def win_rate_over_model(matches, eval_model_name, baseline_model_name):
     """Compute the win rate of eval_model_name over baseline_model_name."""
     wins = 0
@@ -166,6 +444,34 @@ def win_rate_over_model(matches, eval_model_name, baseline_model_name):
         return wins / total
 
 
+def win_rate_matrix(model_a_ids, model_b_ids, scores, num_models):
+    """Compute the pairwise win rate matrix of integer-coded matches in one pass.
+
+    `scores` holds the outcome of every match for model_a: 1 for a win, 0.5 for a
+    tie and 0 for a loss. Entry (i, j) is the win rate of model i over model j,
+    NaN on the diagonal and for pairs that never met. Gives the same numbers as
+    `win_rate_over_model` for every ordered pair.
+    """
+    model_a_ids = np.asarray(model_a_ids, dtype=np.int64)
+    model_b_ids = np.asarray(model_b_ids, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    size = num_models * num_models
+    forward = model_a_ids * num_models + model_b_ids
+    backward = model_b_ids * num_models + model_a_ids
+
+    wins = np.bincount(forward, weights=scores, minlength=size) + np.bincount(
+        backward, weights=1.0 - scores, minlength=size
+    )
+    counts = np.bincount(forward, minlength=size) + np.bincount(
+        backward, minlength=size
+    )
+    win_rate = np.full(size, np.nan)
+    np.divide(wins, counts, out=win_rate, where=counts > 0)
+    win_rate = win_rate.reshape(num_models, num_models)
+    np.fill_diagonal(win_rate, np.nan)
+    return win_rate
+
+
 def plot_win_rate(win_rate, model_list, subset):
     fig, ax = plt.subplots(figsize=(8, 8))
     fig.suptitle(f"RPBench-{subset} win rate matrix (Y-axis over X-axis)")
@@ -187,43 +493,40 @@ def plot_win_rate(win_rate, model_list, subset):
     return fig
 
 
+def to_match_tuples(models, winners, losers):
+    """Turn integer-coded matches into (winner, loser, winner) tuples."""
+    return [
+        (models[winner], models[loser], models[winner])
+        for winner, loser in zip(winners.tolist(), losers.tolist())
+    ]
+
+
 def get_metrics(label_result_dir, elo_algo="mle"):
-    model_num_annotations = defaultdict(int)
-    matches = []
-
-    elo_calculator = EloCalculator(method=elo_algo)
-
-    for file in os.listdir(label_result_dir):
-        if file.endswith(".jsonl"):
-            with open(os.path.join(label_result_dir, file), "r") as f:
-                for line in f:
-                    obj = json.loads(line)
-                    model_assignment = obj["assignment"]
-                    winner = extract_and_parse_json(obj["judger_response"])["winner"]
-                    winner_model = model_assignment.get(winner)
-                    if winner_model is None:
-                        continue
-                    loser_model = (
-                        model_assignment["model_a"]
-                        if winner == "model_b"
-                        else model_assignment["model_b"]
-                    )
-                    matches.append((winner_model, loser_model, winner_model))
-                    model_num_annotations[winner_model] += 1
-                    model_num_annotations[loser_model] += 1
+    """Compute Elo ratings and the win rate matrix of a result directory.
 
-    ratings = elo_calculator.score(matches)
+    Pass `elo_algo=None` to skip the Elo computation, `ratings` is None then.
+    """
+    models, winners, losers = load_matches(label_result_dir)
+    num_annotations = np.bincount(winners, minlength=len(models)) + np.bincount(
+        losers, minlength=len(models)
+    )
+    model_num_annotations = {
+        model: int(num_annotations[i])
+        for i, model in enumerate(models)
+        if num_annotations[i] > 0
+    }
 
     model_list = sorted(model_num_annotations.keys())
-    win_rate = np.zeros((len(model_list), len(model_list)))
+    # every match is stored as (winner, loser), so model_a always scores 1
+    win_rate = win_rate_matrix(winners, losers, np.ones(len(winners)), len(models))
+    model_list_ids = [models.index(model) for model in model_list]
+    win_rate = win_rate[np.ix_(model_list_ids, model_list_ids)]
 
-    for i, model_a in enumerate(model_list):
-        for j, model_b in enumerate(model_list):
-            if i != j:
-                win_rate[i, j] = win_rate_over_model(matches, model_a, model_b)
-            else:
-                win_rate[i, j] = float("nan")
+    if elo_algo is None:
+        return None, win_rate, model_list
 
+    matches = to_match_tuples(models, winners, losers)
+    ratings = EloCalculator(method=elo_algo).score(matches)
     ratings = pd.DataFrame(
         [
             {
@@ -240,6 +543,42 @@ def get_metrics(label_result_dir, elo_algo="mle"):
     return ratings, win_rate, model_list
 
 
+def get_bootstrap_metrics(
+    label_result_dir, baseline_model, num_round=500, seed=None, num_workers=1, ci=0.95
+):
+    """Bootstrap confidence intervals of the win rate over `baseline_model` and of the
+    MLE Elo rating of every model in a result directory.
+
+    Both are computed on the same `num_round` resamples of the matches. Returns a
+    DataFrame indexed by model with the point estimates and the CI bounds.
+    """
+    matches = to_match_tuples(*load_matches(label_result_dir))
+    elo_calculator = EloCalculator(method="mle")
+    elo = elo_calculator.score(matches)
+
+    rng = np.random.default_rng(seed)
+    models, wins = bootstrap_win_matrices(matches, num_round, rng)
+    elo_scores = elo_calculator.fit_win_matrices(wins, num_workers=num_workers)
+
+    baseline = models.index(baseline_model)
+    games = wins[:, :, baseline] + wins[:, baseline, :]
+    win_rates = np.full(games.shape, np.nan)
+    np.divide(wins[:, :, baseline], games, out=win_rates, where=games > 0)
+    win_rates[:, baseline] = 0.5
+
+    lower, upper = (1 - ci) / 2, 1 - (1 - ci) / 2
+    return pd.DataFrame(
+        {
+            "win_rate_lower": np.nanquantile(win_rates, lower, axis=0),
+            "win_rate_upper": np.nanquantile(win_rates, upper, axis=0),
+            "elo": [elo[model] for model in models],
+            "elo_lower": np.nanquantile(elo_scores, lower, axis=0),
+            "elo_upper": np.nanquantile(elo_scores, upper, axis=0),
+        },
+        index=pd.Index(models, name="model"),
+    )
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--label_result_dir", type=str, default="results")
@@ -9,13 +9,23 @@ if __name__ == "__main__":
     parser.add_argument("--label_result_dir", type=str, default="results")
     parser.add_argument("--model_config", type=str, default="./config/api_config.yaml")
     parser.add_argument("--baseline_model", type=str, default="gpt-4o")
+    parser.add_argument("--num_bootstrap", type=int, default=500)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--num_workers", type=int, default=os.cpu_count())
     args = parser.parse_args()
 
     result_dfs = []
 
     for subset in ["character", "scene"]:
         _, win_rate, model_list = get_metrics(
-            os.path.join(args.label_result_dir, subset), elo_algo="online"
+            os.path.join(args.label_result_dir, subset), elo_algo=None
+        )
+        bootstrap_df = get_bootstrap_metrics(
+            os.path.join(args.label_result_dir, subset),
+            args.baseline_model,
+            num_round=args.num_bootstrap,
+            seed=args.seed,
+            num_workers=args.num_workers,
         )
         # get model_name -> beautiful name mapping
         # read yaml
@@ -37,6 +47,7 @@ if __name__ == "__main__":
                 "win_rate": win_rate[:, baseline_model_index],
             }
         )
+        win_rate_df = win_rate_df.join(bootstrap_df, on="model")
 
         # rank by win rate
         win_rate_df = win_rate_df.sort_values(by="win_rate", ascending=False)
@@ -0,0 +1,274 @@
+"""
+Routing of the requests of a model across its endpoints.
+
+The `endpoints` field of a model config is either one endpoint or a list of
+endpoints, e.g. the replicas of a self-hosted model or the regions of a provider.
+All requests to the model share one `EndpointPool`, which picks an endpoint for
+every attempt of a request with the `endpoint_policy` of the config:
+- round-robin: the endpoints in turn (default);
+- least-outstanding: the endpoint with the fewest requests in flight;
+- ewma: the endpoint with the lowest exponentially weighted moving average of
+  its latency, weighted by its requests in flight;
+- random: an endpoint at random.
+
+An endpoint is ejected for `endpoint_eject_seconds` after `max_endpoint_failures`
+consecutive failed requests, i.e. connection errors, timeouts or 5xx responses.
+After that time it gets requests again, and the first failure ejects it again.
+A retry of a failed or rate limited request goes to another endpoint if there is
+one, so an in-flight request fails over to a healthy replica.
+"""
+import time
+import random
+import asyncio
+import threading
+from contextlib import contextmanager
+
+ENDPOINT_POLICIES = ("round-robin", "least-outstanding", "ewma", "random")
+MAX_ENDPOINT_FAILURES = 3
+ENDPOINT_EJECT_SECONDS = 30.0
+EWMA_ALPHA = 0.3
+
+
+def get_model_endpoints(model):
+    """The list of endpoint configs of `model`, empty for the provider default."""
+    endpoints = model.get("endpoints")
+    if not endpoints:
+        return []
+    if isinstance(endpoints, dict):
+        return [endpoints]
+    return list(endpoints)
+
+
+def get_endpoint_label(model):
+    """The endpoint of `model` for cache keys and telemetry labels.
+
+    The api_base of a single endpoint or, for a list of endpoints, all of them
+    joined by commas. Falls back to the api_type for the provider default.
+    """
+    api_bases = [e.get("api_base") for e in get_model_endpoints(model)]
+    if not any(api_bases):
+        return None
+    return ",".join(api_base or "" for api_base in api_bases)
+
+
+_CONNECTION_ERRORS = None
+
+
+def _connection_errors():
+    """The exception types of failed connections and timeouts of the API clients."""
+    global _CONNECTION_ERRORS
+    if _CONNECTION_ERRORS is None:
+        errors = [ConnectionError, TimeoutError, asyncio.TimeoutError]
+        # the SDKs are optional, only the installed ones can raise their errors
+        try:
+            import httpx
+
+            errors.append(httpx.TransportError)
+        except ImportError:
+            pass
+        try:
+            import openai
+
+            # APITimeoutError is a subclass
+            errors.append(openai.APIConnectionError)
+        except ImportError:
+            pass
+        try:
+            import anthropic
+
+            errors.append(anthropic.APIConnectionError)
+        except ImportError:
+            pass
+        _CONNECTION_ERRORS = tuple(errors)
+    return _CONNECTION_ERRORS
+
+
+def is_server_error(error):
+    """Whether `error` counts against the health of the endpoint that raised it.
+
+    Only connection errors, timeouts and responses with a 5xx status code are the
+    endpoint's. Errors with a 4xx status code, including rate limits, are the
+    caller's, and any other exception, e.g. a bug in the code handling the
+    response, says nothing about the endpoint. A cancelled request is neither.
+    """
+    if not isinstance(error, Exception):
+        return False
+    status_code = getattr(error, "status_code", None)
+    if isinstance(status_code, int):
+        return status_code >= 500
+    return isinstance(error, _connection_errors())
+
+
+class Endpoint:
+    """One endpoint of a pool and its load and health."""
+
+    def __init__(self, config, limiter=None):
+        self.config = config
+        self.api_base = config.get("api_base")
+        self.limiter = limiter
+        self.outstanding = 0
+        self.latency = None
+        self.requests = 0
+        self.failures = 0
+        self.consecutive_failures = 0
+        self.ejections = 0
+        self.ejected_until = 0.0
+
+
+class EndpointPool:
+    """Picks the endpoints of a model's requests, safe for threads and asyncio tasks.
+
+    `limiters` are the rate limiters of the `endpoints`, one per endpoint.
+    """
+
+    def __init__(
+        self,
+        endpoints,
+        limiters=None,
+        policy="round-robin",
+        max_failures=MAX_ENDPOINT_FAILURES,
+        eject_seconds=ENDPOINT_EJECT_SECONDS,
+    ):
+        assert policy in ENDPOINT_POLICIES, f"Unknown endpoint policy {policy}"
+        if not endpoints:
+            endpoints = [{}]
+        limiters = limiters or [None] * len(endpoints)
+        self.endpoints = [
+            Endpoint(config, limiter) for config, limiter in zip(endpoints, limiters)
+        ]
+        self.policy = policy
+        self.max_failures = max_failures
+        self.eject_seconds = eject_seconds
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _pick(self, candidates):
+        if len(candidates) == 1:
+            return candidates[0]
+        if self.policy == "round-robin":
+            for i in range(len(self.endpoints)):
+                endpoint = self.endpoints[(self._next + i) % len(self.endpoints)]
+                if endpoint in candidates:
+                    self._next = (self.endpoints.index(endpoint) + 1) % len(
+                        self.endpoints
+                    )
+                    return endpoint
+        if self.policy == "least-outstanding":
+            return min(candidates, key=lambda e: (e.outstanding, random.random()))
+        if self.policy == "ewma":
+            # endpoints without a latency yet are assumed to be as fast as the rest
+            known = [e.latency for e in candidates if e.latency is not None]
+            default = sum(known) / len(known) if known else 1.0
+            return min(
+                candidates,
+                key=lambda e: (
+                    (default if e.latency is None else e.latency) * (e.outstanding + 1),
+                    random.random(),
+                ),
+            )
+        return random.choice(candidates)
+
+    def _choose(self, exclude):
+        now = time.monotonic()
+        healthy = [e for e in self.endpoints if e.ejected_until <= now]
+        candidates = [e for e in healthy if e not in exclude] or healthy
+        if not candidates:
+            # all endpoints are ejected, try the one that comes back first
+            candidates = [min(self.endpoints, key=lambda e: e.ejected_until)]
+        return self._pick(candidates)
+
+    def pick(self, exclude=()):
+        """Pick an endpoint for a request with the policy of the pool.
+
+        Endpoints in `exclude`, e.g. the one a retried request failed on, and
+        ejected endpoints are only picked if there is no other endpoint left. The
+        request only counts as in flight once it is sent in `request`, so the
+        time spent waiting for the rate limiter of the endpoint counts neither
+        towards its load nor its latency.
+        """
+        with self._lock:
+            return self._choose(exclude)
+
+    def release(self, endpoint, latency=None, error=None):
+        """Record the end of a request on `endpoint`.
+
+        A request without an `error` updates the latency average of the endpoint,
+        an `error` of the endpoint counts towards its ejection.
+        """
+        with self._lock:
+            endpoint.outstanding -= 1
+            if error is None:
+                endpoint.consecutive_failures = 0
+                if latency is not None:
+                    endpoint.latency = (
+                        latency
+                        if endpoint.latency is None
+                        else EWMA_ALPHA * latency + (1 - EWMA_ALPHA) * endpoint.latency
+                    )
+                return
+            if not is_server_error(error):
+                return
+            endpoint.failures += 1
+            endpoint.consecutive_failures += 1
+            now = time.monotonic()
+            # requests still in flight when the endpoint was ejected do not extend it
+            if (
+                len(self.endpoints) > 1
+                and endpoint.consecutive_failures >= self.max_failures
+                and endpoint.ejected_until <= now
+            ):
+                endpoint.ejected_until = now + self.eject_seconds
+                endpoint.ejections += 1
+                print(
+                    f"Warning: ejecting endpoint {endpoint.api_base} for "
+                    f"{self.eject_seconds:.0f}s after "
+                    f"{endpoint.consecutive_failures} consecutive failures"
+                )
+
+    @contextmanager
+    def request(self, endpoint):
+        """Count the request attempt in the block as in flight on `endpoint`."""
+        with self._lock:
+            endpoint.outstanding += 1
+            endpoint.requests += 1
+        start = time.perf_counter()
+        try:
+            yield endpoint
+        except BaseException as e:
+            self.release(endpoint, error=e)
+            raise
+        self.release(endpoint, latency=time.perf_counter() - start)
+
+    def stats(self):
+        with self._lock:
+            return [
+                {
+                    "api_base": e.api_base,
+                    "requests": e.requests,
+                    "failures": e.failures,
+                    "ejections": e.ejections,
+                    "latency_ewma": e.latency,
+                }
+                for e in self.endpoints
+            ]
+
+
+_POOLS = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def get_endpoint_pool(key, endpoints, make_limiter=None, **kwargs):
+    """Return the pool shared by all requests to the model `key`.
+
+    `make_limiter(endpoint)` returns the rate limiter of an endpoint config, the
+    other arguments are passed to `EndpointPool`.
+    """
+    with _POOLS_LOCK:
+        pool = _POOLS.get(key)
+        if pool is None:
+            limiters = None
+            if make_limiter is not None:
+                limiters = [make_limiter(endpoint) for endpoint in endpoints or [{}]]
+            pool = EndpointPool(endpoints, limiters=limiters, **kwargs)
+            _POOLS[key] = pool
+    return pool
@@ -0,0 +1,110 @@
+"""
+Compact, incrementally updated index of the matches in a result directory.
+
+Parsing every result file on each metric computation is slow, even though the
+metrics only need the (winner, loser) pairs. The index keeps these pairs as
+integer-coded model ids in a NumPy `.npz` file next to the results, together with
+the modification time and size of every result file. Only files that were added
+or changed since the last update are parsed again.
+"""
+import os
+import json
+import numpy as np
+
+from utils import get_win_lose_pair, iter_rounds
+
+MATCH_INDEX_FILE = ".match_index.npz"
+
+
+def _file_signature(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _parse_result_file(path, model_ids):
+    winners, losers = [], []
+    with open(path, "r") as f:
+        for line in f:
+            for round_record in iter_rounds(json.loads(line)):
+                pair = get_win_lose_pair(round_record)
+                if pair is None:
+                    continue
+                for model in pair:
+                    if model not in model_ids:
+                        model_ids[model] = len(model_ids)
+                winners.append(model_ids[pair[0]])
+                losers.append(model_ids[pair[1]])
+    return winners, losers
+
+
+def _load_index(index_path):
+    if not os.path.exists(index_path):
+        return None
+    try:
+        with np.load(index_path) as index:
+            return {key: index[key] for key in index.files}
+    except (OSError, ValueError, KeyError):
+        print(f"Warning: ignoring unreadable match index {index_path}")
+        return None
+
+
+def load_matches(label_result_dir):
+    """Return the matches of all result files in `label_result_dir`.
+
+    Returns `(models, winners, losers)` where `models` is the list of model names
+    and `winners` / `losers` are int arrays of model ids, one entry per match.
+    The on-disk index is brought up to date first.
+    """
+    index_path = os.path.join(label_result_dir, MATCH_INDEX_FILE)
+    index = _load_index(index_path)
+
+    models = [] if index is None else index["models"].tolist()
+    model_ids = {model: i for i, model in enumerate(models)}
+    cached = {}
+    if index is not None:
+        offsets = index["offsets"]
+        for i, file in enumerate(index["files"].tolist()):
+            cached[file] = (
+                (int(index["mtimes"][i]), int(index["sizes"][i])),
+                index["winners"][offsets[i] : offsets[i + 1]],
+                index["losers"][offsets[i] : offsets[i + 1]],
+            )
+
+    files = [f for f in os.listdir(label_result_dir) if f.endswith(".jsonl")]
+    signatures, winner_chunks, loser_chunks = [], [], []
+    num_parsed = 0
+    for file in files:
+        path = os.path.join(label_result_dir, file)
+        signature = _file_signature(path)
+        if file in cached and cached[file][0] == signature:
+            winners, losers = cached[file][1], cached[file][2]
+        else:
+            winners, losers = _parse_result_file(path, model_ids)
+            winners = np.asarray(winners, dtype=np.int32)
+            losers = np.asarray(losers, dtype=np.int32)
+            num_parsed += 1
+        signatures.append(signature)
+        winner_chunks.append(winners)
+        loser_chunks.append(losers)
+
+    models = list(model_ids)
+    winners = np.concatenate(winner_chunks or [np.zeros(0, np.int32)]).astype(np.int32)
+    losers = np.concatenate(loser_chunks or [np.zeros(0, np.int32)]).astype(np.int32)
+
+    if num_parsed or index is None or len(cached) != len(files):
+        offsets = np.cumsum([0] + [len(chunk) for chunk in winner_chunks])
+        tmp_path = index_path + ".tmp.npz"
+        np.savez(
+            tmp_path,
+            models=np.array(models, dtype=str),
+            files=np.array(files, dtype=str),
+            mtimes=np.array([s[0] for s in signatures], dtype=np.int64),
+            sizes=np.array([s[1] for s in signatures], dtype=np.int64),
+            offsets=offsets.astype(np.int64),
+            winners=winners,
+            losers=losers,
+        )
+        os.replace(tmp_path, index_path)
+        print(f"Match index of {label_result_dir}: parsed {num_parsed}/{len(files)} files")
+
+    return models, winners, losers
@@ -0,0 +1,622 @@
+"""
+Local mock LLM server for offline runs and benchmarks.
+
+Serves the OpenAI chat completions API (`POST /v1/chat/completions`) and the
+Anthropic messages API (`POST /v1/messages`) with canned responses:
+- judge requests, recognised by the verdict format in their system prompt, get a
+  verdict with a random winner, as plain JSON, as JSON fenced in a markdown block
+  with some prose around it, or as truncated JSON that the judge has to retry;
+- scene NPC requests get a `{"npc_speaks": ..., "is_chat_finished": ...}` reply;
+- all other requests get a few sentences of filler text.
+
+Every response is delayed by a sampled latency, and a configurable share of the
+requests fails with HTTP 500 or with HTTP 429 and a `retry-after-ms` header.
+Point a model config at the server with `api_base: http://HOST:PORT/v1` for the
+OpenAI API type and `api_base: http://HOST:PORT` for the Anthropic one.
+
+Usage (from the repository root):
+    python mock_server.py --port 8000 --latency lognormal:0.5,0.4 --rate_limit_rate 0.02
+"""
+import re
+import json
+import hashlib
+import time
+import random
+import argparse
+import threading
+from collections import defaultdict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+JUDGE_FORMATS = ("valid", "fenced", "malformed")
+# streamed responses are sent one word at a time, roughly one token each
+TOKEN_PATTERN = re.compile(r"\s*\S+")
+LATENCY_DISTRIBUTIONS = ("constant", "uniform", "exponential", "lognormal")
+
+FILLER_SENTENCES = [
+    "The lantern light flickers across the old map on the table.",
+    "I have been waiting for someone to ask me that.",
+    "Careful, the floorboards near the door tend to creak.",
+    "There is more to this story than the villagers will tell you.",
+    "Let me pour you a cup before we talk business.",
+    "The storm should pass by nightfall, if the wind turns.",
+]
+
+
+def parse_latency(spec):
+    """Parse a latency distribution, in seconds, into a sampling function.
+
+    `spec` is a number for a constant latency or one of `uniform:LOW,HIGH`,
+    `exponential:MEAN` and `lognormal:MEDIAN,SIGMA`.
+    """
+    name, _, params = str(spec).partition(":")
+    try:
+        if not params:
+            value = float(name)
+            return lambda rng: value
+        values = [float(x) for x in params.split(",")]
+        if name == "constant":
+            (value,) = values
+            return lambda rng: value
+        if name == "uniform":
+            low, high = values
+            return lambda rng: rng.uniform(low, high)
+        if name == "exponential":
+            (mean,) = values
+            return lambda rng: rng.expovariate(1 / mean) if mean > 0 else 0.0
+        if name == "lognormal":
+            median, sigma = values
+            return lambda rng: median * rng.lognormvariate(0, sigma)
+    except ValueError:
+        pass
+    raise ValueError(
+        f"Invalid latency {spec!r}, expected SECONDS or one of "
+        f"{', '.join(d + ':...' for d in LATENCY_DISTRIBUTIONS[1:])}"
+    )
+
+
+def parse_judge_formats(spec):
+    """Parse judge format weights given as `valid=0.9,fenced=0.08,malformed=0.02`."""
+    weights = {}
+    try:
+        for item in spec.split(","):
+            name, value = item.split("=")
+            weights[name.strip()] = float(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid judge formats {spec!r}")
+    unknown = set(weights) - set(JUDGE_FORMATS)
+    if unknown or sum(weights.values()) <= 0:
+        raise argparse.ArgumentTypeError(
+            f"Judge formats must weigh some of {', '.join(JUDGE_FORMATS)}"
+        )
+    return weights
+
+
+def _num_tokens(text):
+    return max(1, len(text) // 4)
+
+
+def _anthropic_segment(content):
+    """Text of an Anthropic system prompt or message content, and whether it ends
+    with a cache breakpoint."""
+    if isinstance(content, str):
+        return content, False
+    return (
+        "".join(block.get("text", "") for block in content),
+        any("cache_control" in block for block in content),
+    )
+
+
+class MockLLMServer:
+    """OpenAI- and Anthropic-compatible mock server running on a daemon thread.
+
+    `latency` and `judge_latency` are latency specs, see `parse_latency`, the
+    judge uses `latency` unless `judge_latency` is given. `error_rate` and
+    `rate_limit_rate` are the shares of requests answered with HTTP 500 and 429.
+    `judge_formats` weighs the formats of the judge verdicts and `finish_rate` is
+    the chance that a scene NPC reply ends the scene, followed by
+    `json_trailer_sentences` sentences of prose after its JSON object. With
+    `tokens_per_sec`, the output takes time to generate: streamed responses
+    (`"stream": true`) send their first token after the latency and the others
+    at that rate, other responses arrive once all tokens are generated. Prompt caching is simulated
+    per message: OpenAI requests read every prefix seen before, Anthropic
+    requests only the prefixes ending at a `cache_control` breakpoint. The
+    counters of the served requests are available from `stats()`.
+    """
+
+    def __init__(
+        self,
+        host="127.0.0.1",
+        port=0,
+        latency="0",
+        judge_latency=None,
+        error_rate=0.0,
+        rate_limit_rate=0.0,
+        retry_after=0.1,
+        judge_formats=None,
+        response_sentences=3,
+        finish_rate=0.1,
+        tokens_per_sec=None,
+        json_trailer_sentences=0,
+        seed=0,
+    ):
+        self.latency = parse_latency(latency)
+        self.judge_latency = (
+            self.latency if judge_latency is None else parse_latency(judge_latency)
+        )
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.judge_formats = judge_formats or {"valid": 1.0}
+        self.response_sentences = response_sentences
+        self.finish_rate = finish_rate
+        self.tokens_per_sec = tokens_per_sec
+        self.json_trailer_sentences = json_trailer_sentences
+        self._rng = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = defaultdict(int)
+        self._cached_prefixes = set()
+
+        server = self
+
+        class Handler(_MockHandler):
+            mock = server
+
+        self.httpd = ThreadingHTTPServer((host, port), Handler)
+        self.httpd.daemon_threads = True
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def start(self):
+        self._thread = threading.Thread(
+            target=self.httpd.serve_forever, name="mock-llm-server", daemon=True
+        )
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def count(self, name, n=1):
+        with self._lock:
+            self._counts[name] += n
+
+    def stats(self):
+        with self._lock:
+            return dict(self._counts)
+
+    def reset_stats(self):
+        with self._lock:
+            self._counts.clear()
+
+    def sample(self, fn):
+        # random.Random is not safe to share between handler threads
+        with self._lock:
+            return fn(self._rng)
+
+    def plan(self, is_judge):
+        """Pick the latency and the outcome of one request."""
+        latency = self.sample(self.judge_latency if is_judge else self.latency)
+        outcome = self.sample(lambda rng: rng.random())
+        if outcome < self.error_rate:
+            return latency, "error"
+        if outcome < self.error_rate + self.rate_limit_rate:
+            return latency, "rate_limited"
+        return latency, "ok"
+
+    def prompt_cache(self, model, segments):
+        """Return the cached and the newly cached prompt tokens of a request.
+
+        `segments` are the (text, is_breakpoint) pairs of the system prompt and
+        the messages. The prefix up to every breakpoint is written to the cache,
+        and like Anthropic's lookback, a cached prefix is also read where the
+        current request has no breakpoint.
+        """
+        prefix = hashlib.sha256(model.encode("utf-8"))
+        tokens = cached = written_until = 0
+        with self._lock:
+            for text, is_breakpoint in segments:
+                prefix.update(text.encode("utf-8") + b"\0")
+                tokens += _num_tokens(text)
+                key = prefix.hexdigest()
+                if key in self._cached_prefixes:
+                    cached = tokens
+                elif is_breakpoint:
+                    self._cached_prefixes.add(key)
+                    written_until = tokens
+        return cached, max(0, written_until - cached)
+
+    def generation_time(self, num_tokens):
+        if not self.tokens_per_sec:
+            return 0.0
+        return num_tokens / self.tokens_per_sec
+
+    def judge_response(self, last_message):
+        winner = None
+        try:
+            responses = json.loads(last_message)
+            if responses["model_a"] != responses["model_b"]:
+                winner = self.sample(lambda rng: rng.choice(["model_a", "model_b"]))
+        except (ValueError, KeyError, TypeError):
+            pass
+        verdict = json.dumps(
+            {
+                "winner": winner,
+                "next_round_user_speaks": self.filler_text(2),
+                "decision_reason": self.filler_text(1),
+            }
+        )
+        names, weights = zip(*self.judge_formats.items())
+        judge_format = self.sample(lambda rng: rng.choices(names, weights)[0])
+        self.count(f"judge_{judge_format}")
+        if judge_format == "fenced":
+            return f"Here is my verdict:\n```json\n{verdict}\n```\nThanks!"
+        if judge_format == "malformed":
+            return verdict[: verdict.index('"next_round_user_speaks"') + 12]
+        return verdict
+
+    def filler_text(self, num_sentences):
+        return " ".join(
+            self.sample(lambda rng: rng.choices(FILLER_SENTENCES, k=num_sentences))
+        )
+
+    def completion_text(self, system, last_message):
+        if "next_round_user_speaks" in system:
+            return self.judge_response(last_message)
+        text = self.filler_text(self.response_sentences)
+        if "is_chat_finished" in system:
+            finished = self.sample(lambda rng: rng.random() < self.finish_rate)
+            reply = json.dumps({"npc_speaks": text, "is_chat_finished": finished})
+            if self.json_trailer_sentences:
+                reply += "\n\n" + self.filler_text(self.json_trailer_sentences)
+            return reply
+        return text
+
+
+class _MockHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    mock = None
+
+    def do_POST(self):
+        request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+        if self.path.rstrip("/").endswith("/chat/completions"):
+            api = "openai"
+            messages = request["messages"]
+            system = messages[0]["content"] if messages[0]["role"] == "system" else ""
+            # OpenAI caches prompt prefixes automatically
+            segments = [(str(m["content"]), True) for m in messages]
+        elif self.path.rstrip("/").endswith("/messages"):
+            api = "anthropic"
+            system, system_breakpoint = _anthropic_segment(request.get("system") or "")
+            segments = [(system, system_breakpoint)] if system else []
+            segments += [_anthropic_segment(m["content"]) for m in request["messages"]]
+        else:
+            self.send_json(404, {"error": {"message": f"Unknown path {self.path}"}})
+            return
+
+        mock = self.mock
+        is_judge = "next_round_user_speaks" in system
+        latency, outcome = mock.plan(is_judge)
+        mock.count("requests")
+        mock.count(f"{api}_requests")
+        time.sleep(latency)
+
+        if outcome == "error":
+            mock.count("errors")
+            self.send_error_json(api, 500, "api_error", "Mock server error")
+            return
+        if outcome == "rate_limited":
+            mock.count("rate_limited")
+            self.send_error_json(
+                api,
+                429,
+                "rate_limit_error",
+                "Mock rate limit",
+                headers={"retry-after-ms": str(int(mock.retry_after * 1000))},
+            )
+            return
+
+        text = mock.completion_text(system, segments[-1][0])
+        prompt_tokens = sum(_num_tokens(segment) for segment, _ in segments)
+        cached_tokens, written_tokens = mock.prompt_cache(
+            request.get("model", "mock"), segments
+        )
+        chunks = TOKEN_PATTERN.findall(text)
+        completion_tokens = len(chunks)
+        mock.count("responses")
+        if request.get("stream"):
+            try:
+                if api == "openai":
+                    self.stream_openai(
+                        request, chunks, prompt_tokens, completion_tokens, cached_tokens
+                    )
+                else:
+                    self.stream_anthropic(
+                        request,
+                        chunks,
+                        prompt_tokens,
+                        completion_tokens,
+                        cached_tokens,
+                        written_tokens,
+                    )
+            except (BrokenPipeError, ConnectionResetError):
+                # the client stopped reading, e.g. after the JSON object it wanted
+                mock.count("streams_cancelled")
+                self.close_connection = True
+            return
+
+        time.sleep(mock.generation_time(completion_tokens))
+        if api == "openai":
+            body = {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [
+                    {
+                        "index": 0,
+                        "message": {"role": "assistant", "content": text},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {
+                    "prompt_tokens": prompt_tokens,
+                    "completion_tokens": completion_tokens,
+                    "total_tokens": prompt_tokens + completion_tokens,
+                    "prompt_tokens_details": {"cached_tokens": cached_tokens},
+                },
+            }
+        else:
+            body = {
+                "id": "msg_mock",
+                "type": "message",
+                "role": "assistant",
+                "model": request.get("model", "mock"),
+                "content": [{"type": "text", "text": text}],
+                "stop_reason": "end_turn",
+                "stop_sequence": None,
+                "usage": {
+                    "input_tokens": prompt_tokens - cached_tokens - written_tokens,
+                    "output_tokens": completion_tokens,
+                    "cache_read_input_tokens": cached_tokens,
+                    "cache_creation_input_tokens": written_tokens,
+                },
+            }
+        self.send_json(200, body)
+
+    def stream_openai(
+        self, request, chunks, prompt_tokens, completion_tokens, cached_tokens
+    ):
+        self.start_stream()
+
+        def chunk(delta, finish_reason=None):
+            return {
+                "id": "chatcmpl-mock",
+                "object": "chat.completion.chunk",
+                "created": int(time.time()),
+                "model": request.get("model", "mock"),
+                "choices": [
+                    {"index": 0, "delta": delta, "finish_reason": finish_reason}
+                ],
+            }
+
+        self.send_event(chunk({"role": "assistant", "content": ""}))
+        for i, text in enumerate(chunks):
+            if i > 0:
+                time.sleep(self.mock.generation_time(1))
+            self.send_event(chunk({"content": text}))
+            self.mock.count("streamed_tokens")
+        self.send_event(chunk({}, finish_reason="stop"))
+        if (request.get("stream_options") or {}).get("include_usage"):
+            usage_chunk = chunk({})
+            usage_chunk["choices"] = []
+            usage_chunk["usage"] = {
+                "prompt_tokens": prompt_tokens,
+                "completion_tokens": completion_tokens,
+                "total_tokens": prompt_tokens + completion_tokens,
+                "prompt_tokens_details": {"cached_tokens": cached_tokens},
+            }
+            self.send_event(usage_chunk)
+        self.write_chunk(b"data: [DONE]\n\n")
+        self.write_chunk(b"")
+
+    def stream_anthropic(
+        self,
+        request,
+        chunks,
+        prompt_tokens,
+        completion_tokens,
+        cached_tokens,
+        written_tokens,
+    ):
+        self.start_stream()
+        self.send_event(
+            {
+                "type": "message_start",
+                "message": {
+                    "id": "msg_mock",
+                    "type": "message",
+                    "role": "assistant",
+                    "model": request.get("model", "mock"),
+                    "content": [],
+                    "stop_reason": None,
+                    "stop_sequence": None,
+                    "usage": {
+                        "input_tokens": prompt_tokens - cached_tokens - written_tokens,
+                        "output_tokens": 1,
+                        "cache_read_input_tokens": cached_tokens,
+                        "cache_creation_input_tokens": written_tokens,
+                    },
+                },
+            },
+            "message_start",
+        )
+        self.send_event(
+            {
+                "type": "content_block_start",
+                "index": 0,
+                "content_block": {"type": "text", "text": ""},
+            },
+            "content_block_start",
+        )
+        for i, text in enumerate(chunks):
+            if i > 0:
+                time.sleep(self.mock.generation_time(1))
+            self.send_event(
+                {
+                    "type": "content_block_delta",
+                    "index": 0,
+                    "delta": {"type": "text_delta", "text": text},
+                },
+                "content_block_delta",
+            )
+            self.mock.count("streamed_tokens")
+        self.send_event({"type": "content_block_stop", "index": 0}, "content_block_stop")
+        self.send_event(
+            {
+                "type": "message_delta",
+                "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                "usage": {"output_tokens": completion_tokens},
+            },
+            "message_delta",
+        )
+        self.send_event({"type": "message_stop"}, "message_stop")
+        self.write_chunk(b"")
+
+    def start_stream(self):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+
+    def send_event(self, data, event=None):
+        message = f"data: {json.dumps(data)}\n\n"
+        if event is not None:
+            message = f"event: {event}\n" + message
+        self.write_chunk(message.encode())
+
+    def write_chunk(self, data):
+        self.wfile.write(f"{len(data):x}\r\n".encode() + data + b"\r\n")
+        self.wfile.flush()
+
+    def send_error_json(self, api, status, error_type, message, headers=None):
+        if api == "anthropic":
+            body = {"type": "error", "error": {"type": error_type, "message": message}}
+        else:
+            body = {"error": {"type": error_type, "message": message}}
+        self.send_json(status, body, headers)
+
+    def send_json(self, status, body, headers=None):
+        data = json.dumps(body).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def add_mock_server_args(parser):
+    """Add the options of `MockLLMServer` to an argparse parser."""
+    parser.add_argument(
+        "--latency",
+        type=str,
+        default="0",
+        help="Latency distribution of a response, in seconds, e.g. lognormal:0.5,0.4",
+    )
+    parser.add_argument(
+        "--judge_latency",
+        type=str,
+        default=None,
+        help="Latency distribution of a judge response, defaults to --latency",
+    )
+    parser.add_argument(
+        "--error_rate", type=float, default=0.0, help="Share of HTTP 500 responses"
+    )
+    parser.add_argument(
+        "--rate_limit_rate",
+        type=float,
+        default=0.0,
+        help="Share of HTTP 429 responses",
+    )
+    parser.add_argument(
+        "--retry_after",
+        type=float,
+        default=0.1,
+        help="Seconds of the retry-after-ms header of HTTP 429 responses",
+    )
+    parser.add_argument(
+        "--judge_formats",
+        type=parse_judge_formats,
+        default="valid=1",
+        help="Weights of the judge verdict formats, e.g. valid=0.9,fenced=0.08,malformed=0.02",
+    )
+    parser.add_argument(
+        "--finish_rate",
+        type=float,
+        default=0.1,
+        help="Chance that a scene NPC reply ends the scene",
+    )
+    parser.add_argument(
+        "--tokens_per_sec",
+        type=float,
+        default=None,
+        help="Output speed of the responses, instant by default",
+    )
+    parser.add_argument(
+        "--json_trailer_sentences",
+        type=int,
+        default=0,
+        help="Sentences of prose after the JSON object of scene NPC replies",
+    )
+
+
+def make_mock_server(args, host="127.0.0.1", port=0, seed=0):
+    """Create a `MockLLMServer` from the options of `add_mock_server_args`."""
+    return MockLLMServer(
+        host=host,
+        port=port,
+        latency=args.latency,
+        judge_latency=args.judge_latency,
+        error_rate=args.error_rate,
+        rate_limit_rate=args.rate_limit_rate,
+        retry_after=args.retry_after,
+        judge_formats=args.judge_formats,
+        finish_rate=args.finish_rate,
+        tokens_per_sec=args.tokens_per_sec,
+        json_trailer_sentences=args.json_trailer_sentences,
+        seed=seed,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--seed", type=int, default=0)
+    add_mock_server_args(parser)
+    args = parser.parse_args()
+
+    server = make_mock_server(args, host=args.host, port=args.port, seed=args.seed)
+    print(f"Mock OpenAI API at {server.url}/v1, mock Anthropic API at {server.url}")
+    try:
+        server.httpd.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.httpd.server_close()
+        print(f"Served: {server.stats()}")
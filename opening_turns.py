@@ -0,0 +1,223 @@
+"""
+Versioned store of the judge's responses to the opening turn of each example.
+
+The first judge request of an example only shows the greeting to both sides, so
+its response, which carries the simulated user's first message, does not depend
+on the compared models. The store keeps one response per (judge model, subset,
+example id), sampled with an explicit seed, and shares it across all pairings and
+re-runs. Every entry records a hash of the judge request and of the store
+version, entries whose request changed, e.g. after an edit of the judge prompt,
+are ignored and requested again.
+
+Fill the store ahead of a run (from the repository root):
+    python opening_turns.py --subset character --workers 16
+"""
+import os
+import json
+import hashlib
+import argparse
+import threading
+from concurrent.futures import Future
+
+from tqdm.auto import tqdm
+
+from utils import (
+    make_config,
+    chat_completion_judger,
+    iter_examples,
+    ordered_parallel_map,
+)
+
+OPENING_TURN_VERSION = 1
+DEFAULT_OPENING_TURN_DIR = "cache/opening_turns"
+
+
+def get_opening_store_path(subset, judge_model_name, directory=DEFAULT_OPENING_TURN_DIR):
+    return os.path.join(directory, f"{subset}_{judge_model_name}.jsonl")
+
+
+def make_request_hash(judge_model, messages, seed):
+    payload = json.dumps(
+        [OPENING_TURN_VERSION, judge_model["model_name"], messages, seed],
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class OpeningTurnStore:
+    """Opening judge turns of one subset, shared across pairings and runs.
+
+    With `path=None` the responses are only kept in memory. Concurrent requests
+    for the same example wait for the first one instead of calling the judge
+    again. Failures are not stored. The store is safe to share between threads.
+    """
+
+    def __init__(self, subset, judge_model_name, judge_model, seed=0, path=None):
+        self.subset = subset
+        self.judge_model_name = judge_model_name
+        self.judge_model = judge_model
+        self.seed = seed
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._file = None
+
+        if path is not None:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+            if os.path.exists(path):
+                for entry in self._read_entries(path):
+                    future = Future()
+                    future.set_result(entry["response"])
+                    self._futures[(entry["id"], entry["request_hash"])] = future
+            self._file = open(path, "a+")
+            # a crash may leave a torn last line, start the next entry on a new line
+            if self._file.tell() > 0:
+                self._file.seek(self._file.tell() - 1)
+                if self._file.read(1) != "\n":
+                    self._file.write("\n")
+
+    @staticmethod
+    def _read_entries(path):
+        entries = []
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    continue
+        return entries
+
+    def get(self, example_id, messages):
+        """Return the judge response to the opening `messages` of an example."""
+        request_hash = make_request_hash(self.judge_model, messages, self.seed)
+        key = (example_id, request_hash)
+        with self._lock:
+            future = self._futures.get(key)
+            owner = future is None
+            if owner:
+                future = Future()
+                self._futures[key] = future
+                self.misses += 1
+            else:
+                self.hits += 1
+        if owner:
+            try:
+                response = chat_completion_judger(
+                    self.judge_model, messages, seed=self.seed
+                )
+            except BaseException as e:
+                with self._lock:
+                    del self._futures[key]
+                future.set_exception(e)
+            else:
+                self._save(example_id, request_hash, response)
+                future.set_result(response)
+        return future.result()
+
+    def lookup(self, example_id, messages):
+        """Return the stored response to the opening `messages`, or None.
+
+        Unlike `get`, a missing response is not requested. Batched runs request
+        the missing ones together and add them with `put`.
+        """
+        key = (example_id, make_request_hash(self.judge_model, messages, self.seed))
+        with self._lock:
+            future = self._futures.get(key)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        with self._lock:
+            self.hits += 1
+        return future.result()
+
+    def put(self, example_id, messages, response):
+        """Store a judge response to the opening `messages` of an example."""
+        request_hash = make_request_hash(self.judge_model, messages, self.seed)
+        future = Future()
+        future.set_result(response)
+        with self._lock:
+            self._futures[(example_id, request_hash)] = future
+            self.misses += 1
+        self._save(example_id, request_hash, response)
+
+    def _save(self, example_id, request_hash, response):
+        if self._file is None:
+            return
+        entry = {
+            "id": example_id,
+            "subset": self.subset,
+            "judge_model": self.judge_model_name,
+            "seed": self.seed,
+            "version": OPENING_TURN_VERSION,
+            "request_hash": request_hash,
+            "response": response,
+        }
+        with self._lock:
+            self._file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+            self._file.flush()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def make_opening_store(subset, seed=0, persistent=True):
+    """Opening turn store of `subset` for the judge in `config/judger_config.yaml`."""
+    judger_config = make_config("config/judger_config.yaml")
+    assert len(judger_config) == 1, "Judger config should have only one model"
+    judger_model_name = list(judger_config.keys())[0]
+    return OpeningTurnStore(
+        subset,
+        judger_model_name,
+        judger_config[judger_model_name],
+        seed=seed,
+        path=get_opening_store_path(subset, judger_model_name) if persistent else None,
+    )
+
+
+if __name__ == "__main__":
+    import run_character_eval
+    import run_scene_eval
+
+    subsets = {"character": run_character_eval, "scene": run_scene_eval}
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--subset", type=str, choices=list(subsets), required=True)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of examples requested concurrently",
+    )
+    args = parser.parse_args()
+
+    module = subsets[args.subset]
+    store = make_opening_store(args.subset, seed=args.seed)
+
+    def fill(d):
+        try:
+            store.get(d["id"], module.opening_judger_messages(d))
+        except Exception as e:
+            print(f"Warning: no opening turn for example {d['id']}: {e}")
+
+    try:
+        for _ in tqdm(
+            ordered_parallel_map(
+                fill, iter_examples(module.RPBENCH_PATH), workers=args.workers
+            )
+        ):
+            pass
+    finally:
+        store.close()
+    stats = store.stats()
+    print(
+        f"Opening turns of {args.subset} in {store.path}: "
+        f"{stats['misses']} requested, {stats['hits']} already stored"
+    )
@@ -0,0 +1,125 @@
+"""
+Client-side rate limiting and retry backoff for API endpoints.
+
+Every endpoint gets a shared limiter with optional requests-per-minute (`rpm`)
+and tokens-per-minute (`tpm`) budgets, read from the model config. All threads
+and asyncio tasks that talk to the same endpoint draw from the same buckets, so
+a concurrent run stays just under the provider quota instead of tripping it.
+"""
+import time
+import random
+import asyncio
+import threading
+
+from email.utils import parsedate_to_datetime
+
+# retry backoff settings, in seconds
+BACKOFF_BASE = 0.5
+BACKOFF_MAX = 60.0
+# a bucket holds at most this many seconds worth of budget
+BURST_SECONDS = 10.0
+
+
+class TokenBucket:
+    """A token bucket refilled continuously at `per_minute / 60` tokens per second.
+
+    `reserve` always succeeds and may drive the bucket into debt; it returns how
+    long the caller has to wait before its reservation is covered.
+    """
+
+    def __init__(self, per_minute):
+        self.rate = per_minute / 60.0
+        self.capacity = max(1.0, self.rate * BURST_SECONDS)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+
+    def reserve(self, amount, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= amount
+        return max(0.0, -self.tokens / self.rate)
+
+
+class EndpointLimiter:
+    """Shared RPM/TPM limiter of one endpoint, safe for threads and asyncio tasks."""
+
+    def __init__(self, rpm=None, tpm=None):
+        self.requests = TokenBucket(rpm) if rpm else None
+        self.tokens = TokenBucket(tpm) if tpm else None
+        self.paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def reserve(self, num_tokens=0):
+        """Book one request of `num_tokens` tokens, return the seconds to wait."""
+        with self._lock:
+            now = time.monotonic()
+            wait = max(0.0, self.paused_until - now)
+            if self.requests is not None:
+                wait = max(wait, self.requests.reserve(1, now))
+            if self.tokens is not None and num_tokens:
+                wait = max(wait, self.tokens.reserve(num_tokens, now))
+        return wait
+
+    def pause(self, seconds):
+        """Hold back every caller of this endpoint, e.g. after a `Retry-After`."""
+        with self._lock:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    def acquire(self, num_tokens=0):
+        wait = self.reserve(num_tokens)
+        if wait > 0:
+            time.sleep(wait)
+
+    async def aacquire(self, num_tokens=0):
+        wait = self.reserve(num_tokens)
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+_LIMITERS = {}
+_LIMITERS_LOCK = threading.Lock()
+
+
+def get_limiter(key, rpm=None, tpm=None):
+    """Return the limiter shared by all callers of the endpoint `key`."""
+    with _LIMITERS_LOCK:
+        limiter = _LIMITERS.get(key)
+        if limiter is None:
+            limiter = EndpointLimiter(rpm=rpm, tpm=tpm)
+            _LIMITERS[key] = limiter
+    return limiter
+
+
+def get_retry_after(error):
+    """Extract the `Retry-After` delay in seconds from an API error, if any."""
+    response = getattr(error, "response", None)
+    headers = getattr(response, "headers", None)
+    if not headers:
+        return None
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000
+        except ValueError:
+            pass
+    value = headers.get("retry-after")
+    if value is None:
+        return None
+    try:
+        return float(value)
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def backoff_delay(attempt, retry_after=None):
+    """Jittered exponential backoff delay for the given (0-based) retry attempt.
+
+    A `Retry-After` hint from the server takes precedence when it is given.
+    """
+    if retry_after is not None:
+        return min(BACKOFF_MAX, retry_after) + random.uniform(0, BACKOFF_BASE)
+    return random.uniform(0, min(BACKOFF_MAX, BACKOFF_BASE * 2**attempt))
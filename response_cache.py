@@ -0,0 +1,139 @@
+"""
+Persistent, content-addressed cache of chat completion responses.
+
+Responses are stored in a SQLite database keyed by a hash of the request
+(model name, API base, messages, temperature and max tokens, plus the seed and
+the flags that shape the response, e.g. JSON mode, if set). The cache is
+bounded in size, the least recently used entries are evicted first.
+"""
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+CACHE_MODES = ("off", "read", "readwrite")
+DEFAULT_CACHE_PATH = "cache/responses.sqlite"
+DEFAULT_CACHE_MAX_BYTES = 1 << 30
+
+
+def make_cache_key(
+    model_name,
+    api_base,
+    messages,
+    temperature,
+    max_tokens,
+    seed=None,
+    stop_at_json=False,
+    json_mode=False,
+):
+    request = [model_name, api_base, messages, temperature, max_tokens]
+    if seed is not None:
+        # keep the keys of unseeded requests unchanged
+        request.append(seed)
+    if stop_at_json is True:
+        # a response cut off after its JSON object differs from the full one
+        request.append("stop_at_json")
+    elif stop_at_json:
+        request.append(["stop_at_json", sorted(stop_at_json)])
+    if json_mode:
+        request.append("json_mode")
+    payload = json.dumps(
+        request,
+        sort_keys=True,
+        ensure_ascii=False,
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class ResponseCache:
+    """SQLite-backed response cache with size-based LRU eviction.
+
+    In "read" mode, lookups are served but new responses are not stored. The
+    cache is safe to share between threads, `achat_completion` calls it from
+    worker threads to keep its blocking I/O off the event loop.
+    """
+
+    def __init__(
+        self, path=DEFAULT_CACHE_PATH, mode="readwrite", max_bytes=DEFAULT_CACHE_MAX_BYTES
+    ):
+        assert mode in ("read", "readwrite"), f"Unsupported cache mode {mode}"
+        self.path = path
+        self.mode = mode
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, response TEXT NOT NULL, "
+            "size INTEGER NOT NULL, last_used REAL NOT NULL)"
+        )
+        self._conn.execute(
+            "CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used)"
+        )
+        self._conn.commit()
+        self._total_bytes = self._conn.execute(
+            "SELECT COALESCE(SUM(size), 0) FROM responses"
+        ).fetchone()[0]
+
+    def get(self, key):
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            if self.mode == "readwrite":
+                self._conn.execute(
+                    "UPDATE responses SET last_used = ? WHERE key = ?",
+                    (time.time(), key),
+                )
+                self._conn.commit()
+            return row[0]
+
+    def put(self, key, response):
+        if self.mode != "readwrite":
+            return
+        size = len(response.encode("utf-8"))
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT size FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None:
+                self._total_bytes -= row[0]
+            self._conn.execute(
+                "INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?)",
+                (key, response, size, time.time()),
+            )
+            self._total_bytes += size
+            self._evict()
+            self._conn.commit()
+
+    def _evict(self):
+        while self._total_bytes > self.max_bytes:
+            rows = self._conn.execute(
+                "SELECT key, size FROM responses ORDER BY last_used LIMIT 64"
+            ).fetchall()
+            if not rows:
+                break
+            for key, size in rows:
+                self._conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._total_bytes -= size
+                if self._total_bytes <= self.max_bytes:
+                    break
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -1,13 +1,42 @@
 import os
 import json
-import jsonlines
-from utils import make_config, chat_completion, extract_and_parse_json
+from utils import (
+    make_config,
+    extract_and_parse_json,
+    CandidatesStep,
+    JudgeStep,
+    run_example_steps,
+    configure_response_cache,
+    configure_prompt_cache,
+    configure_streaming,
+    get_result_path,
+    get_win_lose_pair,
+    prepare_judger_messages,
+    iter_examples,
+    iter_rounds,
+    merge_result_shards,
+    ordered_parallel_map,
+    parse_ids,
+    parse_shard,
+    ResultWriter,
+    JudgeError,
+    JUDGE_CONTEXT_MODES,
+    JUDGE_STATS,
+    report_judge_stats,
+)
+from concurrent.futures import ThreadPoolExecutor
 from string import Template
 from tqdm.auto import tqdm
 import random
 import argparse
 
+from batch import WaveScheduler, BATCH_TRANSPORTS, DEFAULT_POLL_INTERVAL
+from opening_turns import make_opening_store
+from telemetry import labels, TELEMETRY
+
 MAX_MESSAGES_PER_CHAR = 10
+# keys of the JSON object a candidate answers with
+RESPONSE_KEYS = ("npc_speaks", "is_chat_finished")
 RPBENCH_PATH = "data/rpbench_scene.jsonl"
 
 
@@ -59,30 +88,225 @@ You are testing a game powered by AI NPCs. You need to simulate a player and int
 )
 
 
-def chat_completion_judger(model, messages):
-    while True:
-        response = chat_completion(model, messages)
+def opening_judger_messages(d):
+    """Judge messages of the opening turn, which shows the greeting to both sides."""
+    greeting = "\n".join(d["conversation"][0]["sentences"])
+    return [
+        {"role": "system", "content": JUDGER_TEMPLATE.substitute(d)},
+        {
+            "role": "user",
+            "content": json.dumps({"model_a": greeting, "model_b": greeting}),
+        },
+    ]
+
+
+def example_steps(
+    d,
+    model_1,
+    model_2,
+    candidate_config,
+    judge_context="full",
+    judge_token_budget=None,
+    stop_at_json=False,
+):
+    """Generator of the multi-turn pairwise dialogue of a single example.
+
+    Yields the `utils.CandidatesStep`s and `utils.JudgeStep`s of the dialogue and
+    expects their responses back, see `utils.run_example_steps`. The opening
+    `JudgeStep` does not depend on the compared models. With
+    `judge_context="compact"`, later judge requests only carry the winning response
+    of earlier rounds, see `utils.compact_judger_messages`. With `stop_at_json`,
+    the candidates are streamed and stopped once their JSON object is complete,
+    text after the object is not part of their responses. Returns
+    the eval result record and the (winner, loser) pairs of the example. The record
+    stores the prompts once and only the new turns of each round,
+    `calculate_metrics.read_eval_results` rebuilds the full transcripts.
+    """
+    win_lose_pairs = []
+
+    conversation = d["conversation"]
+    greeting = "\n".join(conversation[0]["sentences"])
+    candidate_messages = [
+        {
+            "role": "system",
+            "content": TEMPLATE.substitute(d),
+        },
+        {"role": "assistant", "content": greeting},
+    ]
+
+    judger_messages = opening_judger_messages(d)
+
+    judger_response = yield JudgeStep(judger_messages, opening=True)
+    parsed_judger_response = extract_and_parse_json(judger_response)
+    judger_messages.append({"role": "assistant", "content": judger_response})
+
+    eval_result = {
+        "id": d["id"],
+        "candidate_system": candidate_messages[0]["content"],
+        "judger_system": judger_messages[0]["content"],
+        "greeting": greeting,
+        "opening_judger_response": judger_response,
+        "rounds": [],
+    }
+    if judge_context != "full":
+        eval_result["judge_context"] = {
+            "mode": judge_context,
+            "token_budget": judge_token_budget,
+        }
+
+    for _ in range(MAX_MESSAGES_PER_CHAR):
+        # randomly assign model_a and model_b to model_1 and model_2
+        model_a = model_1 if bool(random.getrandbits(1)) else model_2
+        model_b = model_2 if model_a == model_1 else model_1
+        assignment = {"model_a": model_a, "model_b": model_b}
+
+        user_input = parsed_judger_response["next_round_user_speaks"]
+        candidate_messages.append({"role": "user", "content": user_input})
+        model_a_response, model_b_response = yield CandidatesStep(
+            candidate_config[model_a],
+            candidate_config[model_b],
+            candidate_messages,
+            stop_at_json=RESPONSE_KEYS if stop_at_json else False,
+        )
+
         try:
-            parsed_response = extract_and_parse_json(response)
-            if (
-                "winner" in parsed_response
-                and "next_round_user_speaks" in parsed_response
-            ):
-                return response
+            parsed_model_a_response = extract_and_parse_json(model_a_response, is_judger=False)
+            model_a_end = parsed_model_a_response["is_chat_finished"]
+        except:
+            model_a_end = False
+            print(f"Warning: Format error in response of {model_a}")
+            print(model_a_response)
+        try:
+            parsed_model_b_response = extract_and_parse_json(model_b_response, is_judger=False)
+            model_b_end = parsed_model_b_response["is_chat_finished"]
         except:
-            pass
+            model_b_end = False
+            print(f"Warning: Format error in response of {model_b}")
+            print(model_b_response)
+
+        judger_message_content = json.dumps(
+            {"model_a": model_a_response, "model_b": model_b_response}
+        )
+        judger_messages.append({"role": "user", "content": judger_message_content})
+        judger_response = yield JudgeStep(
+            prepare_judger_messages(judger_messages, judge_context, judge_token_budget)
+        )
+        parsed_judger_response = extract_and_parse_json(judger_response)
 
+        eval_result["rounds"].append(
+            {
+                "assignment": assignment,
+                "user": user_input,
+                "model_a_response": model_a_response,
+                "model_b_response": model_b_response,
+                "judger_response": judger_response,
+                "winner": parsed_judger_response["winner"],
+                "decision_reason": parsed_judger_response.get("decision_reason"),
+            }
+        )
+        winner = parsed_judger_response["winner"]
+        if winner:
+            if winner == "model_a":
+                win_lose_pairs.append((model_a, model_b))
+            elif winner == "model_b":
+                win_lose_pairs.append((model_b, model_a))
+
+            if winner == "model_a" and model_a_end:
+                break
+            elif winner == "model_b" and model_b_end:
+                break
 
-def eval_models_pairwise(model_1, model_2):
+        judger_messages.append({"role": "assistant", "content": judger_response})
+        candidate_messages.append(
+            {
+                "role": "assistant",
+                "content": model_a_response
+                if winner == "model_a"
+                else model_b_response,
+            }
+        )
+
+    return eval_result, win_lose_pairs
+
+
+def eval_example(
+    d,
+    model_1,
+    model_2,
+    judger_model,
+    candidate_config,
+    candidate_executor=None,
+    opening_store=None,
+    judge_context="full",
+    judge_token_budget=None,
+    stop_at_json=False,
+):
+    """Run the multi-turn pairwise dialogue for a single example, see `example_steps`.
+
+    If `candidate_executor` is given, the two candidate requests of a round are sent
+    concurrently. With an `opening_store`, the judge's response to the opening turn
+    is shared across pairings.
+    """
+    return run_example_steps(
+        example_steps(
+            d,
+            model_1,
+            model_2,
+            candidate_config,
+            judge_context=judge_context,
+            judge_token_budget=judge_token_budget,
+            stop_at_json=stop_at_json,
+        ),
+        d["id"],
+        judger_model,
+        candidate_executor=candidate_executor,
+        opening_store=opening_store,
+    )
+
+
+def eval_models_pairwise(
+    model_1,
+    model_2,
+    workers=1,
+    parallel_candidates=False,
+    resume=False,
+    cache="off",
+    prompt_cache=False,
+    stream=False,
+    stop_at_json=False,
+    shard=None,
+    ids=None,
+    limit=None,
+    seed=0,
+    opening_store=True,
+    judge_context="full",
+    judge_token_budget=None,
+    batched=False,
+    batch_transport="auto",
+    batch_poll_interval=DEFAULT_POLL_INTERVAL,
+    telemetry_out=None,
+    prometheus_out=None,
+):
+    """Evaluate `model_1` against `model_2` on the examples of RPBENCH_PATH.
+
+    `shard`, `ids` and `limit` select a subset of the examples, see
+    `utils.iter_examples`. A sharded run writes to its own shard file, which
+    `merge_shards` merges into the result file of the pairing. The opening judge
+    turns are sampled with `seed` and, with `opening_store`, reused from and saved
+    to the store of `opening_turns`. `judge_context` and `judge_token_budget` are
+    passed to `eval_example`. `prompt_cache` turns on provider-side prompt
+    caching and `stream` streamed responses, see `utils.achat_completion`, and
+    `stop_at_json` is passed to `eval_example`. With `batched`, all examples
+    advance in lockstep waves of batched requests sent through `batch_transport`,
+    see `batch.WaveScheduler`. The usage metrics of the run are written to
+    `telemetry_out` as JSON and, optionally, to `prometheus_out` in the Prometheus
+    text format.
+    """
     model_1_win_count = 0
     model_2_win_count = 0
-    eval_data = []
     win_lose_pairs = []
-    eval_results = []
-    with jsonlines.open(RPBENCH_PATH) as reader:
-        for obj in reader:
-            eval_data.append(obj)
-    print(f"Loaded {len(eval_data)} examples from {RPBENCH_PATH}")
+    eval_data = iter_examples(RPBENCH_PATH, shard=shard, ids=ids, limit=limit)
+    print(f"Streaming examples from {RPBENCH_PATH}")
 
     judger_config = make_config("config/judger_config.yaml")
     assert len(judger_config) == 1, "Judger config should have only one model"
@@ -95,122 +319,283 @@ def eval_models_pairwise(model_1, model_2):
     assert model_2 in candidate_config, f"{model_2} not found in candidate config"
     print(f"Comparing `{model_1}` and `{model_2}`")
 
-    for d in (pbar := tqdm(eval_data)):
-        conversation = d["conversation"]
-        greeting = "\n".join(conversation[0]["sentences"])
-        candidate_messages = [
-            {
-                "role": "system",
-                "content": TEMPLATE.substitute(d),
-            },
-            {"role": "assistant", "content": greeting},
-        ]
-
-        judger_messages = [
-            {"role": "system", "content": JUDGER_TEMPLATE.substitute(d)},
-            {
-                "role": "user",
-                "content": json.dumps({"model_a": greeting, "model_b": greeting}),
-            },
-        ]
-
-        judger_response = chat_completion_judger(judger_model, judger_messages)
-        parsed_judger_response = extract_and_parse_json(judger_response)
-        judger_messages.append({"role": "assistant", "content": judger_response})
+    response_cache = configure_response_cache(cache)
+    configure_prompt_cache(prompt_cache)
+    configure_streaming(stream)
+    opening_turns = make_opening_store("scene", seed=seed, persistent=opening_store)
+    JUDGE_STATS.reset()
+    TELEMETRY.reset()
 
-        for _ in range(MAX_MESSAGES_PER_CHAR):
-            # randomly assign model_a and model_b to model_1 and model_2
-            model_a = model_1 if bool(random.getrandbits(1)) else model_2
-            model_b = model_2 if model_a == model_1 else model_1
-            assignment = {"model_a": model_a, "model_b": model_b}
-
-            user_input = parsed_judger_response["next_round_user_speaks"]
-            candidate_messages.append({"role": "user", "content": user_input})
-            model_a_response = chat_completion(
-                candidate_config[model_a], candidate_messages
+    if not os.path.exists("results/scene"):
+        os.makedirs("results/scene")
+    writer = ResultWriter(
+        get_result_path("results/scene", model_1, model_2, shard), resume=resume
+    )
+    for record in writer.records:
+        for round_record in iter_rounds(record):
+            pair = get_win_lose_pair(round_record)
+            if pair is not None:
+                win_lose_pairs.append(pair)
+    if resume:
+        eval_data = (d for d in eval_data if d["id"] not in writer.finished_ids)
+        print(f"Resuming: {len(writer.finished_ids)} examples already finished")
+    for winner_model, _ in win_lose_pairs:
+        if winner_model == model_1:
+            model_1_win_count += 1
+        elif winner_model == model_2:
+            model_2_win_count += 1
+
+    candidate_executor = (
+        ThreadPoolExecutor(max_workers=workers) if parallel_candidates else None
+    )
+
+    def run_example(d):
+        try:
+            return d["id"], eval_example(
+                d,
+                model_1,
+                model_2,
+                judger_model,
+                candidate_config,
+                candidate_executor=candidate_executor,
+                opening_store=opening_turns,
+                judge_context=judge_context,
+                judge_token_budget=judge_token_budget,
+                stop_at_json=stop_at_json,
             )
-            model_b_response = chat_completion(
-                candidate_config[model_b], candidate_messages
+        except JudgeError as e:
+            print(f"Warning: skipping example {d['id']}: {e}")
+            return d["id"], None
+
+    skipped_ids = []
+    if batched:
+        scheduler = WaveScheduler(
+            judger_model,
+            transport=batch_transport,
+            poll_interval=batch_poll_interval,
+            opening_store=opening_turns,
+        )
+        results = scheduler.run(
+            (
+                d["id"],
+                d["id"],
+                example_steps(
+                    d,
+                    model_1,
+                    model_2,
+                    candidate_config,
+                    judge_context=judge_context,
+                    judge_token_budget=judge_token_budget,
+                    stop_at_json=stop_at_json,
+                ),
             )
-
-            try:
-                parsed_model_a_response = extract_and_parse_json(model_a_response, is_judger=False)
-                model_a_end = parsed_model_a_response["is_chat_finished"]
-            except:
-                model_a_end = False
-                print(f"Warning: Format error in response of {model_a}")
-                print(model_a_response)
-            try:
-                parsed_model_b_response = extract_and_parse_json(model_b_response, is_judger=False)
-                model_b_end = parsed_model_b_response["is_chat_finished"]
-            except:
-                model_b_end = False
-                print(f"Warning: Format error in response of {model_b}")
-                print(model_b_response)
-
-            judger_message_content = json.dumps(
-                {"model_a": model_a_response, "model_b": model_b_response}
+            for d in eval_data
+        )
+    else:
+        results = ordered_parallel_map(run_example, eval_data, workers=workers)
+    try:
+        with writer, labels(subset="scene"):
+            for example_id, example_output in (
+                pbar := tqdm(results, total=limit)
+            ):
+                if example_output is None:
+                    skipped_ids.append(example_id)
+                    continue
+                example_result, example_pairs = example_output
+                writer.write(example_id, [example_result])
+                win_lose_pairs.extend(example_pairs)
+                for winner_model, _ in example_pairs:
+                    if winner_model == model_1:
+                        model_1_win_count += 1
+                    elif winner_model == model_2:
+                        model_2_win_count += 1
+                if model_1_win_count + model_2_win_count > 0:
+                    pbar.set_postfix(
+                        {
+                            "model_1_win_rate": model_1_win_count
+                            / (model_1_win_count + model_2_win_count)
+                        }
+                    )
+    finally:
+        if candidate_executor is not None:
+            candidate_executor.shutdown()
+        opening_turns.close()
+        report_judge_stats()
+        TELEMETRY.report()
+        TELEMETRY.write_summary(
+            telemetry_out or f"telemetry/scene_eval_{model_1}_vs_{model_2}.json"
+        )
+        if prometheus_out:
+            TELEMETRY.write_prometheus(prometheus_out)
+        if skipped_ids:
+            print(
+                f"Skipped {len(skipped_ids)} examples after judge failures, "
+                f"rerun with --resume to retry them: {skipped_ids}"
             )
-            judger_messages.append({"role": "user", "content": judger_message_content})
-            judger_response = chat_completion_judger(judger_model, judger_messages)
-            parsed_judger_response = extract_and_parse_json(judger_response)
-
-            eval_result = {
-                "candidate_messages": candidate_messages,
-                "assignment": assignment,
-                "judger_messages": judger_messages,
-                "judger_response": judger_response,
-            }
-            eval_results.append(eval_result)
-            winner = parsed_judger_response["winner"]
-            if winner:
-                winner_model = None
-                if winner == "model_a":
-                    winner_model = model_a
-                    win_lose_pairs.append((model_a, model_b))
-                elif winner == "model_b":
-                    winner_model = model_b
-                    win_lose_pairs.append((model_b, model_a))
-                if winner_model == model_1:
-                    model_1_win_count += 1
-                elif winner_model == model_2:
-                    model_2_win_count += 1
-
-                if winner == "model_a" and model_a_end:
-                    break
-                elif winner == "model_b" and model_b_end:
-                    break
-
-            pbar.set_postfix(
-                {
-                    "model_1_win_rate": model_1_win_count
-                    / (model_1_win_count + model_2_win_count)
-                }
+        if response_cache is not None:
+            stats = response_cache.stats()
+            print(
+                f"Response cache: {stats['hits']} hits, {stats['misses']} misses"
             )
+        stats = opening_turns.stats()
+        print(
+            f"Opening judge turns: {stats['misses']} requested, {stats['hits']} reused"
+        )
 
-            judger_messages.append({"role": "assistant", "content": judger_response})
-            candidate_messages.append(
-                {
-                    "role": "assistant",
-                    "content": model_a_response
-                    if winner == "model_a"
-                    else model_b_response,
-                }
-            )
+    return win_lose_pairs
 
-    if not os.path.exists("results/scene"):
-        os.makedirs("results/scene")
-    with jsonlines.open(
-        f"results/scene/eval_{model_1}_vs_{model_2}.jsonl", "w"
-    ) as writer:
-        writer.write_all(eval_results)
 
-    return win_lose_pairs
+def merge_shards(model_1, model_2, num_shards):
+    example_order = {d["id"]: i for i, d in enumerate(iter_examples(RPBENCH_PATH))}
+    merge_result_shards(
+        get_result_path("results/scene", model_1, model_2),
+        num_shards,
+        example_order,
+    )
 
 
 if __name__ == "__main__":
     parser = argparse.ArgumentParser()
     parser.add_argument("--model_1", type=str, required=True)
     parser.add_argument("--model_2", type=str, default="gpt-4o")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of examples evaluated concurrently",
+    )
+    parser.add_argument(
+        "--parallel_candidates",
+        action="store_true",
+        help="Send the two candidate requests of each round concurrently",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip examples already finished in an interrupted run",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        choices=["off", "read", "readwrite"],
+        default="off",
+        help="Serve identical requests from the on-disk response cache",
+    )
+    parser.add_argument(
+        "--prompt_cache",
+        action="store_true",
+        help="Mark the stable prompt prefix for provider-side prompt caching",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the responses and record their time to first token",
+    )
+    parser.add_argument(
+        "--stop_at_json",
+        action="store_true",
+        help="Stream the scene candidates and stop them after their JSON object",
+    )
+    parser.add_argument(
+        "--shard",
+        type=parse_shard,
+        default=None,
+        help="Only run shard i of N, given as i/N",
+    )
+    parser.add_argument(
+        "--ids",
+        type=parse_ids,
+        default=None,
+        help="Comma-separated ids of the examples to run",
+    )
+    parser.add_argument(
+        "--limit", type=int, default=None, help="Run at most this many examples"
+    )
+    parser.add_argument(
+        "--merge_shards",
+        type=int,
+        default=None,
+        metavar="N",
+        help="Merge the N finished shard files of the pairing instead of running",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Sampling seed of the opening judge turns",
+    )
+    parser.add_argument(
+        "--no_opening_store",
+        action="store_true",
+        help="Do not reuse or save the opening judge turns of the opening turn store",
+    )
+    parser.add_argument(
+        "--judge_context",
+        type=str,
+        choices=JUDGE_CONTEXT_MODES,
+        default="full",
+        help="Send the judge the full transcript or a compacted one",
+    )
+    parser.add_argument(
+        "--judge_token_budget",
+        type=int,
+        default=None,
+        help="Drop the oldest rounds of a compacted judge context beyond this budget",
+    )
+    parser.add_argument(
+        "--batched",
+        action="store_true",
+        help="Advance all examples turn by turn in batched requests",
+    )
+    parser.add_argument(
+        "--batch_transport",
+        type=str,
+        choices=BATCH_TRANSPORTS,
+        default="auto",
+        help="How the batches of --batched are sent, see batch.make_batch_transport",
+    )
+    parser.add_argument(
+        "--batch_poll_interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between status checks of submitted batch jobs",
+    )
+    parser.add_argument(
+        "--telemetry_out",
+        type=str,
+        default=None,
+        help="Path of the usage summary JSON, written under telemetry/ by default",
+    )
+    parser.add_argument(
+        "--prometheus_out",
+        type=str,
+        default=None,
+        help="Also write the usage metrics in the Prometheus text format to this path",
+    )
     args = parser.parse_args()
-    eval_models_pairwise(args.model_1, args.model_2)
+    if args.merge_shards:
+        merge_shards(args.model_1, args.model_2, args.merge_shards)
+        exit()
+    eval_models_pairwise(
+        args.model_1,
+        args.model_2,
+        workers=args.workers,
+        parallel_candidates=args.parallel_candidates,
+        resume=args.resume,
+        cache=args.cache,
+        prompt_cache=args.prompt_cache,
+        stream=args.stream,
+        stop_at_json=args.stop_at_json,
+        shard=args.shard,
+        ids=args.ids,
+        limit=args.limit,
+        seed=args.seed,
+        opening_store=not args.no_opening_store,
+        judge_context=args.judge_context,
+        judge_token_budget=args.judge_token_budget,
+        batched=args.batched,
+        batch_transport=args.batch_transport,
+        batch_poll_interval=args.batch_poll_interval,
+        telemetry_out=args.telemetry_out,
+        prometheus_out=args.prometheus_out,
+    )
@@ -0,0 +1,560 @@
+"""
+Evaluate several models against each other in a single run.
+
+All pairings of the tournament are scheduled through one shared worker pool, so a
+run keeps the API quota busy instead of evaluating one pairing at a time. The
+endpoint rate limiters are shared by every request of the process. The judge's
+response to the opening turn of an example only depends on the example, it is
+taken from the opening turn store and reused by all pairings. With `--batched`,
+the examples of a wave advance turn by turn in batched requests instead, see
+`batch.WaveScheduler`.
+
+Pairing strategies:
+- all-pairs: every model against every other model.
+- vs-baseline: every model against the baseline model.
+- adaptive: every model against the baseline on a first wave of examples, then
+  further waves between models adjacent in the Elo ranking whose bootstrap
+  confidence intervals still overlap.
+"""
+import os
+import time
+import itertools
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+from tqdm.auto import tqdm
+
+import run_character_eval
+import run_scene_eval
+from batch import WaveScheduler, BATCH_TRANSPORTS, DEFAULT_POLL_INTERVAL
+from calculate_metrics import EloCalculator
+from opening_turns import make_opening_store
+from telemetry import labels, TELEMETRY
+from utils import (
+    make_config,
+    configure_response_cache,
+    configure_prompt_cache,
+    configure_streaming,
+    get_result_path,
+    get_win_lose_pair,
+    iter_examples,
+    iter_rounds,
+    ordered_parallel_map,
+    parse_ids,
+    ResultWriter,
+    JudgeError,
+    JUDGE_CONTEXT_MODES,
+    JUDGE_STATS,
+    report_judge_stats,
+)
+
+SUBSETS = {"character": run_character_eval, "scene": run_scene_eval}
+STRATEGIES = ("all-pairs", "vs-baseline", "adaptive")
+
+
+class Pairing:
+    """Result file and remaining examples of one pairing of a tournament."""
+
+    def __init__(self, subset, model_1, model_2, resume=False, ids=None, limit=None):
+        self.model_1 = model_1
+        self.model_2 = model_2
+        self.writer = ResultWriter(
+            get_result_path(f"results/{subset}", model_1, model_2), resume=resume
+        )
+        self.win_lose_pairs = []
+        for record in self.writer.records:
+            for round_record in iter_rounds(record):
+                pair = get_win_lose_pair(round_record)
+                if pair is not None:
+                    self.win_lose_pairs.append(pair)
+        self.skipped_ids = []
+        self.examples = (
+            d
+            for d in iter_examples(SUBSETS[subset].RPBENCH_PATH, ids=ids, limit=limit)
+            if d["id"] not in self.writer.finished_ids
+        )
+        self.exhausted = False
+
+    def take(self, num=None):
+        """Return up to `num` of the remaining examples, all of them by default."""
+        examples = list(itertools.islice(self.examples, num))
+        if num is None or len(examples) < num:
+            self.exhausted = True
+        return examples
+
+    def win_rate(self):
+        wins = sum(winner == self.model_1 for winner, _ in self.win_lose_pairs)
+        losses = sum(winner == self.model_2 for winner, _ in self.win_lose_pairs)
+        return wins / (wins + losses) if wins + losses else None
+
+
+def get_pairings(models, strategy, baseline=None):
+    if strategy == "all-pairs":
+        return list(itertools.combinations(models, 2))
+    return [(model, baseline) for model in models if model != baseline]
+
+
+def round_robin(iterables):
+    """Interleave the items of several iterables."""
+    iterators = [iter(it) for it in iterables]
+    while iterators:
+        alive = []
+        for it in iterators:
+            item = next(it, StopIteration)
+            if item is not StopIteration:
+                alive.append(it)
+                yield item
+        iterators = alive
+
+
+def elo_intervals(pairings, num_round=100, seed=None, ci=0.95):
+    """Median and bootstrap confidence interval of the MLE Elo of every model."""
+    matches = [
+        (winner, loser, winner)
+        for pairing in pairings
+        for winner, loser in pairing.win_lose_pairs
+    ]
+    if not matches:
+        return {}
+    bootstrap = EloCalculator(method="mle").get_bootstrap_result(
+        matches, num_round=num_round, seed=seed
+    )
+    lower = bootstrap.quantile((1 - ci) / 2)
+    upper = bootstrap.quantile(1 - (1 - ci) / 2)
+    median = bootstrap.median()
+    return {
+        model: (median[model], lower[model], upper[model])
+        for model in bootstrap.columns
+    }
+
+
+def uncertain_pairs(intervals):
+    """Pairs of models adjacent in the Elo ranking whose intervals overlap.
+
+    The pairs are sorted by decreasing overlap.
+    """
+    ranking = sorted(intervals, key=lambda model: intervals[model][0], reverse=True)
+    pairs = []
+    for higher, lower in zip(ranking, ranking[1:]):
+        overlap = min(intervals[higher][2], intervals[lower][2]) - max(
+            intervals[higher][1], intervals[lower][1]
+        )
+        if overlap > 0:
+            pairs.append((overlap, higher, lower))
+    return [(higher, lower) for _, higher, lower in sorted(pairs, reverse=True)]
+
+
+class Tournament:
+    """Runs the examples of many pairings of one subset through a shared pool."""
+
+    def __init__(
+        self,
+        subset,
+        models,
+        workers=1,
+        parallel_candidates=False,
+        resume=False,
+        ids=None,
+        limit=None,
+        seed=0,
+        opening_store=True,
+        judge_context="full",
+        judge_token_budget=None,
+        stop_at_json=False,
+        batched=False,
+        batch_transport="auto",
+        batch_poll_interval=DEFAULT_POLL_INTERVAL,
+    ):
+        self.subset = subset
+        self.module = SUBSETS[subset]
+        self.models = models
+        self.workers = workers
+        self.resume = resume
+        self.ids = ids
+        self.limit = limit
+        self.judge_context = judge_context
+        self.judge_token_budget = judge_token_budget
+        # only scene candidates answer with a JSON object
+        self.example_kwargs = {"stop_at_json": stop_at_json} if subset == "scene" else {}
+        self.pairings = {}
+        self.opening_store = make_opening_store(
+            subset, seed=seed, persistent=opening_store
+        )
+
+        judger_config = make_config("config/judger_config.yaml")
+        assert len(judger_config) == 1, "Judger config should have only one model"
+        judger_model_name = list(judger_config.keys())[0]
+        self.judger_model = judger_config[judger_model_name]
+        print(f"Judger model: `{judger_model_name}`")
+
+        self.candidate_config = make_config("config/api_config.yaml")
+        for model in models:
+            assert (
+                model in self.candidate_config
+            ), f"{model} not found in candidate config"
+
+        self.candidate_executor = (
+            ThreadPoolExecutor(max_workers=workers) if parallel_candidates else None
+        )
+        self.scheduler = (
+            WaveScheduler(
+                self.judger_model,
+                transport=batch_transport,
+                poll_interval=batch_poll_interval,
+                opening_store=self.opening_store,
+            )
+            if batched
+            else None
+        )
+        if not os.path.exists(f"results/{subset}"):
+            os.makedirs(f"results/{subset}")
+
+    def get_pairing(self, model_1, model_2):
+        # name the result file after the order of the models on the command line
+        if model_1 in self.models and model_2 in self.models:
+            if self.models.index(model_1) > self.models.index(model_2):
+                model_1, model_2 = model_2, model_1
+        key = (model_1, model_2)
+        if key not in self.pairings:
+            self.pairings[key] = Pairing(
+                self.subset,
+                model_1,
+                model_2,
+                resume=self.resume,
+                ids=self.ids,
+                limit=self.limit,
+            )
+        return self.pairings[key]
+
+    def run_example(self, task):
+        pairing, d = task
+        try:
+            return pairing, d["id"], self.module.eval_example(
+                d,
+                pairing.model_1,
+                pairing.model_2,
+                self.judger_model,
+                self.candidate_config,
+                candidate_executor=self.candidate_executor,
+                opening_store=self.opening_store,
+                judge_context=self.judge_context,
+                judge_token_budget=self.judge_token_budget,
+                **self.example_kwargs,
+            )
+        except JudgeError as e:
+            print(
+                f"Warning: skipping example {d['id']} of `{pairing.model_1}` vs "
+                f"`{pairing.model_2}`: {e}"
+            )
+            return pairing, d["id"], None
+
+    def run_wave(self, pairings, num_examples=None):
+        """Evaluate up to `num_examples` new examples of each pairing."""
+        batches = [
+            [(pairing, d) for d in pairing.take(num_examples)] for pairing in pairings
+        ]
+        total = sum(len(batch) for batch in batches)
+        if self.scheduler is not None:
+            results = (
+                (pairing, example_id, example_output)
+                for (pairing, example_id), example_output in self.scheduler.run(
+                    (
+                        (pairing, d["id"]),
+                        d["id"],
+                        self.module.example_steps(
+                            d,
+                            pairing.model_1,
+                            pairing.model_2,
+                            self.candidate_config,
+                            judge_context=self.judge_context,
+                            judge_token_budget=self.judge_token_budget,
+                            **self.example_kwargs,
+                        ),
+                    )
+                    for pairing, d in round_robin(batches)
+                )
+            )
+        else:
+            results = ordered_parallel_map(
+                self.run_example, round_robin(batches), workers=self.workers
+            )
+        for pairing, example_id, example_output in tqdm(
+            results, total=total, desc=self.subset
+        ):
+            if example_output is None:
+                pairing.skipped_ids.append(example_id)
+                continue
+            example_result, example_pairs = example_output
+            pairing.writer.write(example_id, [example_result])
+            pairing.win_lose_pairs.extend(example_pairs)
+        return total
+
+    def run_adaptive(self, baseline, wave_size, max_waves, num_bootstrap, seed):
+        pairings = [
+            self.get_pairing(model_1, model_2)
+            for model_1, model_2 in get_pairings(self.models, "vs-baseline", baseline)
+        ]
+        for wave in range(max_waves):
+            if not pairings or not self.run_wave(pairings, wave_size):
+                break
+            intervals = elo_intervals(
+                self.pairings.values(), num_round=num_bootstrap, seed=seed
+            )
+            pairings = [
+                pairing
+                for pairing in (
+                    self.get_pairing(higher, lower)
+                    for higher, lower in uncertain_pairs(intervals)
+                )
+                if not pairing.exhausted
+            ]
+            print(
+                f"Wave {wave}: {len(pairings)} pairings with overlapping "
+                "Elo intervals left"
+            )
+
+    def run(
+        self,
+        strategy,
+        baseline=None,
+        wave_size=10,
+        max_waves=10,
+        num_bootstrap=100,
+        seed=None,
+    ):
+        finished = False
+        try:
+            with labels(subset=self.subset):
+                if strategy != "adaptive":
+                    self.run_wave(
+                        [
+                            self.get_pairing(model_1, model_2)
+                            for model_1, model_2 in get_pairings(
+                                self.models, strategy, baseline
+                            )
+                        ]
+                    )
+                else:
+                    self.run_adaptive(
+                        baseline, wave_size, max_waves, num_bootstrap, seed
+                    )
+            finished = True
+        finally:
+            for pairing in self.pairings.values():
+                pairing.writer.close(finished=finished)
+            if self.candidate_executor is not None:
+                self.candidate_executor.shutdown()
+            self.opening_store.close()
+
+        for pairing in self.pairings.values():
+            win_rate = pairing.win_rate()
+            if win_rate is not None:
+                print(
+                    f"{self.subset}: `{pairing.model_1}` vs `{pairing.model_2}`: "
+                    f"win rate {win_rate:.3f} over {len(pairing.win_lose_pairs)} rounds"
+                )
+            if pairing.skipped_ids:
+                print(
+                    f"Skipped {len(pairing.skipped_ids)} examples of `{pairing.model_1}` "
+                    f"vs `{pairing.model_2}` after judge failures, rerun with --resume "
+                    f"to retry them: {pairing.skipped_ids}"
+                )
+        stats = self.opening_store.stats()
+        print(
+            f"Opening judge turns: {stats['misses']} requested, {stats['hits']} reused"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--models", type=str, nargs="+", required=True)
+    parser.add_argument(
+        "--strategy", type=str, choices=STRATEGIES, default="vs-baseline"
+    )
+    parser.add_argument(
+        "--baseline",
+        type=str,
+        default="gpt-4o",
+        help="Baseline model of the vs-baseline and adaptive strategies",
+    )
+    parser.add_argument(
+        "--subsets",
+        type=str,
+        nargs="+",
+        choices=list(SUBSETS),
+        default=list(SUBSETS),
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Number of examples evaluated concurrently, across all pairings",
+    )
+    parser.add_argument(
+        "--parallel_candidates",
+        action="store_true",
+        help="Send the two candidate requests of each round concurrently",
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip examples already finished in an interrupted run",
+    )
+    parser.add_argument(
+        "--cache",
+        type=str,
+        choices=["off", "read", "readwrite"],
+        default="off",
+        help="Serve identical requests from the on-disk response cache",
+    )
+    parser.add_argument(
+        "--prompt_cache",
+        action="store_true",
+        help="Mark the stable prompt prefix for provider-side prompt caching",
+    )
+    parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="Stream the responses and record their time to first token",
+    )
+    parser.add_argument(
+        "--stop_at_json",
+        action="store_true",
+        help="Stream the scene candidates and stop them after their JSON object",
+    )
+    parser.add_argument(
+        "--ids",
+        type=parse_ids,
+        default=None,
+        help="Comma-separated ids of the examples to run",
+    )
+    parser.add_argument(
+        "--limit",
+        type=int,
+        default=None,
+        help="Run at most this many examples per pairing",
+    )
+    parser.add_argument(
+        "--wave_size",
+        type=int,
+        default=10,
+        help="Examples per pairing and wave of the adaptive strategy",
+    )
+    parser.add_argument(
+        "--max_waves",
+        type=int,
+        default=10,
+        help="Maximum number of waves of the adaptive strategy",
+    )
+    parser.add_argument(
+        "--num_bootstrap",
+        type=int,
+        default=100,
+        help="Bootstrap rounds of the Elo intervals of the adaptive strategy",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Sampling seed of the opening judge turns and seed of the bootstrap",
+    )
+    parser.add_argument(
+        "--no_opening_store",
+        action="store_true",
+        help="Do not reuse or save the opening judge turns of the opening turn store",
+    )
+    parser.add_argument(
+        "--judge_context",
+        type=str,
+        choices=JUDGE_CONTEXT_MODES,
+        default="full",
+        help="Send the judge the full transcript or a compacted one",
+    )
+    parser.add_argument(
+        "--judge_token_budget",
+        type=int,
+        default=None,
+        help="Drop the oldest rounds of a compacted judge context beyond this budget",
+    )
+    parser.add_argument(
+        "--batched",
+        action="store_true",
+        help="Advance all examples of a wave turn by turn in batched requests",
+    )
+    parser.add_argument(
+        "--batch_transport",
+        type=str,
+        choices=BATCH_TRANSPORTS,
+        default="auto",
+        help="How the batches of --batched are sent, see batch.make_batch_transport",
+    )
+    parser.add_argument(
+        "--batch_poll_interval",
+        type=float,
+        default=DEFAULT_POLL_INTERVAL,
+        help="Seconds between status checks of submitted batch jobs",
+    )
+    parser.add_argument(
+        "--telemetry_out",
+        type=str,
+        default=None,
+        help="Path of the usage summary JSON, written under telemetry/ by default",
+    )
+    parser.add_argument(
+        "--prometheus_out",
+        type=str,
+        default=None,
+        help="Also write the usage metrics in the Prometheus text format to this path",
+    )
+    args = parser.parse_args()
+
+    models = list(dict.fromkeys(args.models))
+    if args.strategy != "all-pairs" and args.baseline not in models:
+        models.append(args.baseline)
+    assert len(models) >= 2, "A tournament needs at least two models"
+
+    response_cache = configure_response_cache(args.cache)
+    configure_prompt_cache(args.prompt_cache)
+    configure_streaming(args.stream)
+    JUDGE_STATS.reset()
+    TELEMETRY.reset()
+    try:
+        for subset in args.subsets:
+            Tournament(
+                subset,
+                models,
+                workers=args.workers,
+                parallel_candidates=args.parallel_candidates,
+                resume=args.resume,
+                ids=args.ids,
+                limit=args.limit,
+                seed=args.seed,
+                opening_store=not args.no_opening_store,
+                judge_context=args.judge_context,
+                judge_token_budget=args.judge_token_budget,
+                stop_at_json=args.stop_at_json,
+                batched=args.batched,
+                batch_transport=args.batch_transport,
+                batch_poll_interval=args.batch_poll_interval,
+            ).run(
+                args.strategy,
+                baseline=args.baseline,
+                wave_size=args.wave_size,
+                max_waves=args.max_waves,
+                num_bootstrap=args.num_bootstrap,
+                seed=args.seed,
+            )
+    finally:
+        report_judge_stats()
+        TELEMETRY.report()
+        TELEMETRY.write_summary(
+            args.telemetry_out
+            or time.strftime("telemetry/tournament_%Y%m%d-%H%M%S.json")
+        )
+        if args.prometheus_out:
+            TELEMETRY.write_prometheus(args.prometheus_out)
+        if response_cache is not None:
+            stats = response_cache.stats()
+            print(
+                f"Response cache: {stats['hits']} hits, {stats['misses']} misses"
+            )
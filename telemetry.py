@@ -0,0 +1,388 @@
+"""
+Per-call usage metrics of the API requests of a run.
+
+Every `utils.chat_completion` call is recorded with its latency, prompt and
+completion tokens, retries, errors and, if the model config sets prices, its cost.
+Streamed calls also record their time to first token (TTFT), measured from the
+start of the call, and the output speed after the first token.
+Calls are grouped by model, endpoint, role ("candidate" or "judge") and subset.
+A call to a model with several endpoints is counted on the endpoint that served
+its last attempt.
+The role and subset come from `labels(...)` blocks around the calls. They are
+kept in context variables, so every thread and asyncio task sees the labels of
+the code that started it.
+
+Prices are read from the optional `input_price` and `output_price` fields of a
+model config, in USD per million tokens. Prompt tokens served from the provider's
+prompt cache are billed at `cached_input_price` if the config sets it.
+"""
+import os
+import json
+import time
+import threading
+import contextvars
+from collections import defaultdict
+from contextlib import contextmanager
+
+import numpy as np
+
+from load_balancer import get_endpoint_label
+
+LABEL_NAMES = ("model", "endpoint", "role", "subset")
+_LABELS = contextvars.ContextVar("telemetry_labels", default={})
+_CURRENT_CALL = contextvars.ContextVar("telemetry_call", default=None)
+
+
+@contextmanager
+def labels(**kwargs):
+    """Attach `role` and / or `subset` labels to the calls made in the block."""
+    token = _LABELS.set({**_LABELS.get(), **kwargs})
+    try:
+        yield
+    finally:
+        _LABELS.reset(token)
+
+
+class CallRecord:
+    def __init__(self, model):
+        current = _LABELS.get()
+        self.labels = (
+            model.get("model_name"),
+            get_endpoint_label(model) or model.get("api_type"),
+            current.get("role", "other"),
+            current.get("subset", "none"),
+        )
+        self.input_price = model.get("input_price")
+        self.output_price = model.get("output_price")
+        self.cached_input_price = model.get("cached_input_price")
+        self.latency = 0.0
+        self.retries = 0
+        self.retry_reasons = []
+        self.error = False
+        self.cache_hit = False
+        self.prompt_tokens = None
+        self.completion_tokens = None
+        self.cached_prompt_tokens = 0
+        self.estimated_tokens = False
+        self.started = time.perf_counter()
+        self.ttft = None
+        self.cut_off = False
+
+    def cost(self):
+        if self.input_price is None and self.output_price is None:
+            return None
+        input_price = self.input_price or 0
+        cached_input_price = (
+            input_price if self.cached_input_price is None else self.cached_input_price
+        )
+        uncached_tokens = (self.prompt_tokens or 0) - self.cached_prompt_tokens
+        return (
+            uncached_tokens * input_price
+            + self.cached_prompt_tokens * cached_input_price
+            + (self.completion_tokens or 0) * (self.output_price or 0)
+        ) / 1e6
+
+
+class _GroupStats:
+    def __init__(self):
+        self.calls = 0
+        self.cache_hits = 0
+        self.errors = 0
+        self.retries = 0
+        self.prompt_tokens = 0
+        self.completion_tokens = 0
+        self.cached_prompt_tokens = 0
+        self.estimated_calls = 0
+        self.cost = None
+        self.latencies = []
+        self.ttfts = []
+        self.streamed_completion_tokens = 0
+        self.generation_time = 0.0
+        self.cut_offs = 0
+        self.retry_reasons = defaultdict(int)
+
+    def summary(self):
+        summary = {
+            "calls": self.calls,
+            "cache_hits": self.cache_hits,
+            "errors": self.errors,
+            "retries": self.retries,
+            "retry_reasons": dict(self.retry_reasons),
+            "prompt_tokens": self.prompt_tokens,
+            "completion_tokens": self.completion_tokens,
+            "cached_prompt_tokens": self.cached_prompt_tokens,
+            "estimated_token_calls": self.estimated_calls,
+            "cost": self.cost,
+            "latency_total": float(np.sum(self.latencies)) if self.latencies else 0.0,
+        }
+        if self.latencies:
+            summary["latency_mean"] = float(np.mean(self.latencies))
+            for q in (50, 95, 99):
+                summary[f"latency_p{q}"] = float(np.percentile(self.latencies, q))
+            summary["latency_max"] = float(np.max(self.latencies))
+        summary["streamed_calls"] = len(self.ttfts)
+        summary["cut_offs"] = self.cut_offs
+        if self.ttfts:
+            summary["ttft_mean"] = float(np.mean(self.ttfts))
+            for q in (50, 95):
+                summary[f"ttft_p{q}"] = float(np.percentile(self.ttfts, q))
+        if self.generation_time > 0:
+            summary["output_tokens_per_sec"] = (
+                self.streamed_completion_tokens / self.generation_time
+            )
+        return summary
+
+
+class Telemetry:
+    """Thread-safe aggregate of the `CallRecord`s of a run, grouped by labels."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.started = time.time()
+            self.groups = defaultdict(_GroupStats)
+
+    def record(self, call):
+        with self._lock:
+            group = self.groups[call.labels]
+            group.calls += 1
+            if call.cache_hit:
+                group.cache_hits += 1
+                return
+            group.latencies.append(call.latency)
+            group.errors += call.error
+            group.retries += call.retries
+            for reason in call.retry_reasons:
+                group.retry_reasons[reason] += 1
+            group.prompt_tokens += call.prompt_tokens or 0
+            group.completion_tokens += call.completion_tokens or 0
+            group.cached_prompt_tokens += call.cached_prompt_tokens
+            group.estimated_calls += call.estimated_tokens
+            group.cut_offs += call.cut_off
+            if call.ttft is not None:
+                group.ttfts.append(call.ttft)
+                generation_time = call.latency - call.ttft
+                if generation_time > 0 and call.completion_tokens:
+                    group.streamed_completion_tokens += call.completion_tokens
+                    group.generation_time += generation_time
+            cost = call.cost()
+            if cost is not None:
+                group.cost = (group.cost or 0.0) + cost
+
+    def summary(self):
+        with self._lock:
+            groups = [
+                dict(zip(LABEL_NAMES, key), **group.summary())
+                for key, group in sorted(
+                    self.groups.items(), key=lambda item: [str(x) for x in item[0]]
+                )
+            ]
+            duration = time.time() - self.started
+        totals = {
+            key: sum(group[key] for group in groups)
+            for key in (
+                "calls",
+                "cache_hits",
+                "errors",
+                "retries",
+                "prompt_tokens",
+                "completion_tokens",
+                "cached_prompt_tokens",
+                "cut_offs",
+            )
+        }
+        costs = [group["cost"] for group in groups if group["cost"] is not None]
+        totals["cost"] = sum(costs) if costs else None
+        return {"duration": duration, "totals": totals, "groups": groups}
+
+    def write_summary(self, path):
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.summary(), f, indent=2)
+        print(f"Telemetry summary written to {path}")
+
+    def write_prometheus(self, path):
+        """Write the metrics in the Prometheus text exposition format."""
+        metrics = [
+            ("calls_total", "API calls", "calls"),
+            ("cache_hits_total", "Calls served by the response cache", "cache_hits"),
+            ("errors_total", "Calls that returned no response", "errors"),
+            ("retries_total", "Retried API requests", "retries"),
+            ("prompt_tokens_total", "Prompt tokens", "prompt_tokens"),
+            ("completion_tokens_total", "Completion tokens", "completion_tokens"),
+            (
+                "cached_prompt_tokens_total",
+                "Prompt tokens served from the provider's prompt cache",
+                "cached_prompt_tokens",
+            ),
+            (
+                "cut_offs_total",
+                "Streamed responses stopped after their JSON object",
+                "cut_offs",
+            ),
+            ("cost_usd_total", "Cost in USD", "cost"),
+        ]
+        groups = self.summary()["groups"]
+        lines = []
+        for name, help_text, key in metrics:
+            lines.append(f"# HELP rpbench_{name} {help_text}")
+            lines.append(f"# TYPE rpbench_{name} counter")
+            for group in groups:
+                if group[key] is not None:
+                    lines.append(
+                        f"rpbench_{name}{{{_format_labels(group)}}} {group[key]}"
+                    )
+        lines.append("# HELP rpbench_latency_seconds Latency of the API calls")
+        lines.append("# TYPE rpbench_latency_seconds summary")
+        for group in groups:
+            if "latency_mean" not in group:
+                continue
+            group_labels = _format_labels(group)
+            for q in (50, 95, 99):
+                lines.append(
+                    f'rpbench_latency_seconds{{{group_labels},quantile="{q / 100}"}} '
+                    f"{group[f'latency_p{q}']}"
+                )
+            lines.append(
+                f"rpbench_latency_seconds_sum{{{group_labels}}} {group['latency_total']}"
+            )
+            lines.append(
+                f"rpbench_latency_seconds_count{{{group_labels}}} "
+                f"{group['calls'] - group['cache_hits']}"
+            )
+        lines.append("# HELP rpbench_ttft_seconds Time to first token of streamed calls")
+        lines.append("# TYPE rpbench_ttft_seconds summary")
+        for group in groups:
+            if "ttft_mean" not in group:
+                continue
+            group_labels = _format_labels(group)
+            for q in (50, 95):
+                lines.append(
+                    f'rpbench_ttft_seconds{{{group_labels},quantile="{q / 100}"}} '
+                    f"{group[f'ttft_p{q}']}"
+                )
+            lines.append(
+                f"rpbench_ttft_seconds_sum{{{group_labels}}} "
+                f"{group['ttft_mean'] * group['streamed_calls']}"
+            )
+            lines.append(
+                f"rpbench_ttft_seconds_count{{{group_labels}}} {group['streamed_calls']}"
+            )
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            f.write("\n".join(lines) + "\n")
+        print(f"Prometheus metrics written to {path}")
+
+    def report(self):
+        """Print one line per model, endpoint, role and subset."""
+        for group in self.summary()["groups"]:
+            line = (
+                f"{group['role']:>9} {group['model']} @ {group['endpoint']} "
+                f"({group['subset']}): "
+                f"{group['calls']} calls, {group['cache_hits']} cached, "
+                f"{group['errors']} errors, {group['retries']} retries, "
+                f"{group['prompt_tokens']}+{group['completion_tokens']} tokens"
+            )
+            if group["cached_prompt_tokens"]:
+                line += f" ({group['cached_prompt_tokens']} prompt tokens cached)"
+            if "latency_mean" in group:
+                line += (
+                    f", latency mean {group['latency_mean']:.2f}s "
+                    f"p95 {group['latency_p95']:.2f}s"
+                )
+            if "ttft_mean" in group:
+                line += (
+                    f", TTFT p50 {group['ttft_p50']:.2f}s p95 {group['ttft_p95']:.2f}s"
+                )
+            if "output_tokens_per_sec" in group:
+                line += f", {group['output_tokens_per_sec']:.0f} tokens/s"
+            if group["cut_offs"]:
+                line += f", {group['cut_offs']} cut off after the JSON object"
+            if group["cost"] is not None:
+                line += f", ${group['cost']:.2f}"
+            print(line)
+        totals = self.summary()["totals"]
+        if totals["cached_prompt_tokens"]:
+            print(
+                f"Prompt cache: {totals['cached_prompt_tokens']} of "
+                f"{totals['prompt_tokens']} prompt tokens served from the provider cache"
+            )
+
+
+def _format_labels(group):
+    values = (
+        str(group[name]).replace("\\", "\\\\").replace('"', '\\"')
+        for name in LABEL_NAMES
+    )
+    return ",".join(f'{name}="{value}"' for name, value in zip(LABEL_NAMES, values))
+
+
+TELEMETRY = Telemetry()
+
+
+@contextmanager
+def track_call(model):
+    """Record the API call made in the block as one call of `model`."""
+    call = CallRecord(model)
+    token = _CURRENT_CALL.set(call)
+    try:
+        yield call
+    except BaseException:
+        call.error = True
+        raise
+    finally:
+        call.latency = time.perf_counter() - call.started
+        _CURRENT_CALL.reset(token)
+        TELEMETRY.record(call)
+
+
+def record_usage(prompt_tokens, completion_tokens, cached_prompt_tokens=0):
+    """Report the token usage of the current call, as returned by the provider.
+
+    `prompt_tokens` includes the `cached_prompt_tokens` read from the provider's
+    prompt cache.
+    """
+    call = _CURRENT_CALL.get()
+    if call is not None:
+        call.prompt_tokens = prompt_tokens
+        call.completion_tokens = completion_tokens
+        call.cached_prompt_tokens = cached_prompt_tokens
+
+
+def record_retry(error=None):
+    """Report a failed request of the current call that is about to be retried.
+
+    The retry is attributed to the type of `error`, or to "unknown" without one.
+    """
+    call = _CURRENT_CALL.get()
+    if call is not None:
+        call.retries += 1
+        call.retry_reasons.append(
+            "unknown" if error is None else type(error).__name__
+        )
+
+
+def record_endpoint(api_base):
+    """Report the endpoint the current attempt of the current call is sent to."""
+    call = _CURRENT_CALL.get()
+    if call is not None and api_base:
+        call.labels = call.labels[:1] + (api_base,) + call.labels[2:]
+
+
+def record_first_token():
+    """Report that the first token of the current streamed call was received."""
+    call = _CURRENT_CALL.get()
+    if call is not None and call.ttft is None:
+        call.ttft = time.perf_counter() - call.started
+
+
+def record_cut_off():
+    """Report that the current streamed call was stopped after its JSON object."""
+    call = _CURRENT_CALL.get()
+    if call is not None:
+        call.cut_off = True
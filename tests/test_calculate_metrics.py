@@ -0,0 +1,57 @@
+import numpy as np
+
+from calculate_metrics import aggregate_matches, fit_bradley_terry, has_finite_mle
+
+SCALE = 400
+
+
+def undefeated_matches():
+    """"a" beats every other model, the others split their games."""
+    matches = []
+    for opponent in ("b", "c", "d"):
+        matches += [("a", opponent, "a")] * 20
+    matches += [("b", "c", "b")] * 12 + [("b", "c", "c")] * 8
+    matches += [("c", "d", "c")] * 10 + [("c", "d", "tie")] * 10
+    matches += [("b", "d", "d")] * 5 + [("b", "d", "b")] * 15
+    return matches
+
+
+def connected_matches():
+    """Like `undefeated_matches`, but "b" beat "a" twice."""
+    return undefeated_matches() + [("b", "a", "b")] * 2
+
+
+def test_undefeated_model_has_bounded_rating():
+    models, wins = aggregate_matches(undefeated_matches())
+    assert not has_finite_mle(wins)
+    coef = fit_bradley_terry(wins)
+    assert np.all(np.isfinite(coef))
+    elo = dict(zip(models, SCALE * coef))
+    assert elo["a"] == max(elo.values())
+    assert elo["a"] < 1000
+
+
+def test_undefeated_model_matches_penalized_logistic_regression():
+    # sklearn's LogisticRegression(fit_intercept=False, C=1.0) on every match
+    # twice, a tie as one win and one loss, as in the original fit
+    expected = [1.69605, -0.345985, -0.470471, -0.879594]
+    _, wins = aggregate_matches(undefeated_matches())
+    np.testing.assert_allclose(fit_bradley_terry(wins), expected, atol=1e-5)
+    np.testing.assert_allclose(fit_bradley_terry(wins, C=1.0), expected, atol=1e-5)
+
+
+def test_connected_matches_are_fitted_unpenalized():
+    # the same regression with penalty=None, centered
+    expected = [1.157659, -0.130492, -0.309782, -0.717385]
+    _, wins = aggregate_matches(connected_matches())
+    assert has_finite_mle(wins)
+    np.testing.assert_allclose(fit_bradley_terry(wins), expected, atol=1e-5)
+
+
+def test_batched_fit_matches_single_fits():
+    _, wins = aggregate_matches(undefeated_matches())
+    _, connected = aggregate_matches(connected_matches())
+    stack = np.stack([wins, wins.T, 2 * wins, connected])
+    np.testing.assert_allclose(
+        fit_bradley_terry(stack), [fit_bradley_terry(w) for w in stack], atol=1e-8
+    )
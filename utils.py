@@ -5,18 +5,53 @@ import os
 import json
 import time
 import yaml
-import random
 import requests
 import json_repair
+import jsonlines
 import re
+import asyncio
+import hashlib
+import weakref
+import threading
+import concurrent.futures
 
 from typing import Optional
 from glob import glob
+from collections import deque
+from contextvars import copy_context
+from concurrent.futures import ThreadPoolExecutor
+from load_balancer import (
+    EndpointPool,
+    get_endpoint_label,
+    get_endpoint_pool,
+    get_model_endpoints,
+    ENDPOINT_EJECT_SECONDS,
+    MAX_ENDPOINT_FAILURES,
+)
+from rate_limit import backoff_delay, get_limiter, get_retry_after
+from telemetry import (
+    labels,
+    record_cut_off,
+    record_endpoint,
+    record_first_token,
+    record_retry,
+    record_usage,
+    track_call,
+)
 
 # API setting constants
 API_MAX_RETRY = 16
-API_RETRY_SLEEP = 10
+JUDGE_MAX_RETRY = 5
 API_ERROR_OUTPUT = "$ERROR$"
+# response length of models whose config does not set `max_tokens`
+DEFAULT_MAX_TOKENS = 2048
+# `anthropic.HUMAN_PROMPT`, removed from recent versions of the SDK
+ANTHROPIC_HUMAN_PROMPT = "\n\nHuman:"
+
+# HTTP connection pool settings of the shared API clients
+HTTP_MAX_CONNECTIONS = 256
+HTTP_MAX_KEEPALIVE_CONNECTIONS = 64
+HTTP_KEEPALIVE_EXPIRY = 30
 
 
 OPENAI_MODEL_LIST = (
@@ -35,9 +70,12 @@ OPENAI_MODEL_LIST = (
 )
 
 
+JSON_BLOCK_PATTERN = re.compile(r"```json\s+(.+?)\s+```", re.DOTALL)
+WINNER_PATTERN = re.compile(r'"winner"\s*:\s*(?:"([^"\\]*)"|null)')
+
+
 def extract_and_parse_json(text, is_judger=True):
-    pattern = r"```json\s+(.+?)\s+```"
-    match = re.search(pattern, text, re.DOTALL)
+    match = JSON_BLOCK_PATTERN.search(text)
     if match:
         json_str = match.group(1)
     else:
@@ -51,6 +89,7 @@ def extract_and_parse_json(text, is_judger=True):
         parsed_obj = json_repair.loads(json_str)
         assert "winner" in parsed_obj
     except Exception:
+        new_json_str = None
         try:
             # There are something wrong in the JSON string, we will try to extract the "winner" field from the string and throw away other keys.
             winner_start = json_str.find("winner\":")
@@ -65,13 +104,238 @@ def extract_and_parse_json(text, is_judger=True):
     return parsed_obj
 
 
-def get_endpoint(endpoint_list):
-    if endpoint_list is None:
-        return None
-    assert endpoint_list is not None
-    # randomly pick one
-    api_dict = random.choices(endpoint_list)[0]
-    return api_dict
+def extract_winner(text):
+    """Return the "winner" field of a judge response, None if there is no winner.
+
+    Much faster than `extract_and_parse_json`: a precompiled scan picks the field
+    out of well-formed responses and json_repair is only used for broken ones.
+    """
+    json_str = text
+    block_start = text.find("```json")
+    if block_start != -1:
+        block_end = text.find("```", block_start + 7)
+        if block_end != -1:
+            json_str = text[block_start + 7 : block_end]
+
+    # in valid JSON, a quoted "winner" followed by a colon can only be a key
+    match = WINNER_PATTERN.search(json_str)
+    if match:
+        return match.group(1)
+    return extract_and_parse_json(text)["winner"]
+
+
+def get_record_winner(record):
+    """Return the winner of an eval result record, parsing the judge response only
+    for records written before the winner was stored alongside it."""
+    if "winner" in record:
+        return record["winner"]
+    return extract_winner(record["judger_response"])
+
+
+def iter_examples(path, shard=None, ids=None, limit=None):
+    """Lazily yield the examples of an RPBench data file.
+
+    `shard` is an (index, count) pair and keeps every count-th example starting at
+    position index, so that `count` processes or machines can split a run. `ids`
+    keeps only the examples with these ids. At most `limit` examples are yielded.
+    """
+    if limit is not None and limit <= 0:
+        return
+    num_yielded = 0
+    with open(path, "r") as f:
+        for position, line in enumerate(f):
+            if shard is not None and position % shard[1] != shard[0]:
+                continue
+            example = json.loads(line)
+            if ids is not None and example["id"] not in ids:
+                continue
+            yield example
+            num_yielded += 1
+            if limit is not None and num_yielded >= limit:
+                return
+
+
+def parse_shard(text):
+    """Parse a "i/N" shard specification into an (i, N) pair."""
+    index, count = (int(x) for x in text.split("/"))
+    assert 0 <= index < count, f"Invalid shard {text}, expected i/N with 0 <= i < N"
+    return index, count
+
+
+def parse_ids(text):
+    """Parse a comma-separated list of example ids."""
+    return set(int(x) if x.strip().isdigit() else x.strip() for x in text.split(","))
+
+
+def get_result_path(result_dir, model_1, model_2, shard=None):
+    """Path of the result file of a pairing, or of one of its shards."""
+    path = os.path.join(result_dir, f"eval_{model_1}_vs_{model_2}.jsonl")
+    if shard is not None:
+        # no .jsonl suffix, so metrics ignore shards until they are merged
+        path += f".shard-{shard[0]}-of-{shard[1]}"
+    return path
+
+
+def merge_result_shards(result_path, num_shards, example_order):
+    """Merge the finished shard files of `result_path` into it and delete them.
+
+    Records of the main file that are not in any shard are kept. Records are
+    written in `example_order`, a dict mapping example ids to their position.
+    """
+    shard_paths = [
+        f"{result_path}.shard-{i}-of-{num_shards}" for i in range(num_shards)
+    ]
+    for path in shard_paths:
+        assert os.path.exists(path), f"Missing shard {path}"
+        assert not os.path.exists(
+            path + ".ckpt"
+        ), f"Shard {path} is unfinished, rerun it with --resume"
+
+    records = {}
+    if os.path.exists(result_path):
+        for record in _read_jsonl_lines(result_path):
+            records[record["id"]] = record
+    for path in shard_paths:
+        for record in _read_jsonl_lines(path):
+            records[record["id"]] = record
+
+    with open(result_path + ".tmp", "w") as f:
+        jsonlines.Writer(f).write_all(
+            sorted(records.values(), key=lambda r: example_order.get(r["id"], -1))
+        )
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(result_path + ".tmp", result_path)
+    for path in shard_paths:
+        os.remove(path)
+    print(f"Merged {num_shards} shards into {result_path} ({len(records)} examples)")
+
+
+def ordered_parallel_map(fn, iterable, workers=1):
+    """Apply `fn` to every item of `iterable` on a thread pool of `workers` threads.
+
+    Results are yielded in the order of `iterable`, regardless of the order in which
+    they complete. At most a few items per worker are in flight at a time, so the
+    iterable is consumed lazily. If the consumer stops early, e.g. on Ctrl-C, the
+    queued items are cancelled and only the running ones are finished.
+    """
+    if workers <= 1:
+        for item in iterable:
+            yield fn(item)
+        return
+
+    executor = ThreadPoolExecutor(max_workers=workers)
+    try:
+        pending = deque()
+        for item in iterable:
+            # run in a copy of the caller's context, so telemetry labels carry over
+            pending.append(executor.submit(copy_context().run, fn, item))
+            if len(pending) >= 4 * workers:
+                yield pending.popleft().result()
+        while pending:
+            yield pending.popleft().result()
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+
+
+def iter_rounds(record):
+    """Iterate over the per-round records of an eval result record.
+
+    Compact records hold all rounds of an example in "rounds", older result files
+    have one record per round.
+    """
+    if "rounds" in record:
+        return iter(record["rounds"])
+    return iter([record])
+
+
+def get_win_lose_pair(record):
+    """Return the (winner, loser) model pair of an eval result record, or None."""
+    winner = get_record_winner(record)
+    assignment = record["assignment"]
+    if winner == "model_a":
+        return assignment["model_a"], assignment["model_b"]
+    elif winner == "model_b":
+        return assignment["model_b"], assignment["model_a"]
+    return None
+
+
+def _read_jsonl_lines(path):
+    # a crash may leave a torn last line behind, skip anything that does not parse
+    objs = []
+    with open(path, "r") as f:
+        for line in f:
+            try:
+                objs.append(json.loads(line))
+            except json.JSONDecodeError:
+                continue
+    return objs
+
+
+class ResultWriter:
+    """Crash-safe, append-only writer of eval result records.
+
+    The records of each finished example are appended and fsync'd together, then
+    the example id is appended to a `<path>.ckpt` checkpoint file. With
+    `resume=True`, examples listed in the checkpoint are kept and exposed through
+    `records` and `finished_ids`, records of unfinished examples are dropped. The
+    checkpoint is removed once the writer is closed without an error.
+    """
+
+    def __init__(self, path, resume=False):
+        self.path = path
+        self.checkpoint_path = path + ".ckpt"
+        self.records = []
+        self.finished_ids = set()
+
+        if resume and os.path.exists(path):
+            self.records = _read_jsonl_lines(path)
+            if os.path.exists(self.checkpoint_path):
+                self.finished_ids = set(_read_jsonl_lines(self.checkpoint_path))
+                self.records = [
+                    r for r in self.records if r.get("id") in self.finished_ids
+                ]
+            else:
+                # the previous run finished cleanly
+                assert all(
+                    "id" in r for r in self.records
+                ), f"{path} has no example ids and cannot be resumed"
+                self.finished_ids = set(r["id"] for r in self.records)
+            with open(path + ".tmp", "w") as f:
+                jsonlines.Writer(f).write_all(self.records)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+            with open(self.checkpoint_path, "w") as f:
+                f.writelines(f"{json.dumps(i)}\n" for i in sorted(self.finished_ids))
+        else:
+            open(path, "w").close()
+            open(self.checkpoint_path, "w").close()
+
+        self._file = open(path, "a")
+        self._writer = jsonlines.Writer(self._file, flush=True)
+        self._checkpoint = open(self.checkpoint_path, "a")
+
+    def write(self, example_id, records):
+        self._writer.write_all(records)
+        os.fsync(self._file.fileno())
+        self._checkpoint.write(f"{json.dumps(example_id)}\n")
+        self._checkpoint.flush()
+        os.fsync(self._checkpoint.fileno())
+        self.finished_ids.add(example_id)
+
+    def close(self, finished=True):
+        self._writer.close()
+        self._file.close()
+        self._checkpoint.close()
+        if finished:
+            os.remove(self.checkpoint_path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close(finished=exc_type is None)
 
 
 # load config args from config yaml files
@@ -91,191 +355,1245 @@ def fix_anthropic_message(messages):
     return messages
 
 
-def chat_completion(model, messages, temperature=1.0, max_tokens=2048):
+_CLIENTS = {}
+_CLIENTS_LOCK = threading.Lock()
+
+
+def _http_limits():
+    import httpx
+
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=HTTP_KEEPALIVE_EXPIRY,
+    )
+
+
+# The OpenAI and Anthropic clients do not retry on their own, every retry goes
+# through the retry loops of the achat_completion_* functions, which honour the
+# endpoint limiters, Retry-After and the endpoint failover, and are recorded.
+def _make_client(api_type, api_base, api_key, api_version):
+    if api_type == "anthropic":
+        import anthropic
+
+        return anthropic.Anthropic(
+            base_url=api_base,
+            api_key=api_key,
+            max_retries=0,
+            http_client=anthropic.DefaultHttpxClient(limits=_http_limits()),
+        )
+    elif api_type == "azure":
+        import openai
+
+        return openai.AzureOpenAI(
+            azure_endpoint=api_base,
+            api_key=api_key,
+            api_version=api_version,
+            timeout=240,
+            max_retries=0,
+            http_client=openai.DefaultHttpxClient(limits=_http_limits()),
+        )
+    elif api_type == "mistral":
+        from mistralai.client import MistralClient
+
+        return MistralClient(api_key=api_key)
+    elif api_type == "cohere":
+        import cohere
+
+        return cohere.Client(api_key)
+    elif api_type == "gemini":
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(
+            pool_connections=HTTP_MAX_KEEPALIVE_CONNECTIONS,
+            pool_maxsize=HTTP_MAX_CONNECTIONS,
+        )
+        session.mount("https://", adapter)
+        return session
+    else:
+        import openai
+
+        return openai.OpenAI(
+            base_url=api_base,
+            api_key=api_key,
+            max_retries=0,
+            http_client=openai.DefaultHttpxClient(limits=_http_limits()),
+        )
+
+
+def get_client(api_type, api_base=None, api_key=None, api_version=None):
+    """Return the shared API client for an endpoint, creating it on first use.
+
+    Clients are keyed by (api_type, api_base, api_key, api_version) and kept for
+    the lifetime of the process, so connections are reused across requests. Safe
+    to call from several threads.
+    """
+    key = (api_type, api_base, api_key, api_version)
+    with _CLIENTS_LOCK:
+        client = _CLIENTS.get(key)
+        if client is None:
+            client = _make_client(api_type, api_base, api_key, api_version)
+            _CLIENTS[key] = client
+    return client
+
+
+def _make_async_client(api_type, api_base, api_key, api_version):
+    import httpx
+
+    if api_type == "anthropic":
+        import anthropic
+
+        return anthropic.AsyncAnthropic(
+            base_url=api_base,
+            api_key=api_key,
+            max_retries=0,
+            http_client=anthropic.DefaultAsyncHttpxClient(limits=_http_limits()),
+        )
+    elif api_type == "azure":
+        import openai
+
+        return openai.AsyncAzureOpenAI(
+            azure_endpoint=api_base,
+            api_key=api_key,
+            api_version=api_version,
+            timeout=240,
+            max_retries=0,
+            http_client=openai.DefaultAsyncHttpxClient(limits=_http_limits()),
+        )
+    elif api_type == "mistral":
+        from mistralai.async_client import MistralAsyncClient
+
+        return MistralAsyncClient(api_key=api_key)
+    elif api_type == "cohere":
+        import cohere
+
+        return cohere.AsyncClient(api_key)
+    elif api_type == "gemini":
+        return httpx.AsyncClient(limits=_http_limits(), timeout=240)
+    else:
+        import openai
+
+        return openai.AsyncOpenAI(
+            base_url=api_base,
+            api_key=api_key,
+            max_retries=0,
+            http_client=openai.DefaultAsyncHttpxClient(limits=_http_limits()),
+        )
+
+
+_ASYNC_CLIENTS = weakref.WeakKeyDictionary()
+
+
+def get_async_client(api_type, api_base=None, api_key=None, api_version=None):
+    """Return the shared async API client for an endpoint on the running event loop.
+
+    Async clients hold connections bound to the event loop that created them, so
+    every loop gets its own set of clients, keyed like the ones of `get_client`.
+    """
+    loop = asyncio.get_running_loop()
+    key = (api_type, api_base, api_key, api_version)
+    with _CLIENTS_LOCK:
+        clients = _ASYNC_CLIENTS.setdefault(loop, {})
+        client = clients.get(key)
+        if client is None:
+            client = _make_async_client(api_type, api_base, api_key, api_version)
+            clients[key] = client
+    return client
+
+
+_LOOP = None
+_LOOP_LOCK = threading.Lock()
+
+
+def _get_background_loop():
+    global _LOOP
+    with _LOOP_LOCK:
+        if _LOOP is None:
+            _LOOP = asyncio.new_event_loop()
+            threading.Thread(
+                target=_LOOP.run_forever, name="chat-completion-loop", daemon=True
+            ).start()
+    return _LOOP
+
+
+def run_sync(coro):
+    """Run `coro` on the shared background event loop and wait for its result.
+
+    The coroutine runs in a copy of the caller's context, so context variables
+    such as the telemetry labels carry over. Safe to call from many threads, all
+    their requests share the connections of one event loop.
+    """
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        pass
+    else:
+        coro.close()
+        raise RuntimeError("run_sync would block the running event loop, await instead")
+
+    loop = _get_background_loop()
+    future = concurrent.futures.Future()
+
+    def start():
+        # a task copies the context that is current when it is created
+        task = loop.create_task(coro)
+
+        def done(task):
+            if task.cancelled():
+                future.cancel()
+            elif task.exception() is not None:
+                future.set_exception(task.exception())
+            else:
+                future.set_result(task.result())
+
+        task.add_done_callback(done)
+
+    loop.call_soon_threadsafe(copy_context().run, start)
+    return future.result()
+
+
+_RESPONSE_CACHE = None
+
+
+def configure_response_cache(mode, path=None, max_bytes=None):
+    """Set up the response cache used by `chat_completion`.
+
+    `mode` is one of "off", "read" or "readwrite". Returns the cache, or None if
+    caching is off.
+    """
+    global _RESPONSE_CACHE
+    from response_cache import (
+        ResponseCache,
+        DEFAULT_CACHE_PATH,
+        DEFAULT_CACHE_MAX_BYTES,
+    )
+
+    if _RESPONSE_CACHE is not None:
+        _RESPONSE_CACHE.close()
+        _RESPONSE_CACHE = None
+    if mode != "off":
+        _RESPONSE_CACHE = ResponseCache(
+            path=path or DEFAULT_CACHE_PATH,
+            mode=mode,
+            max_bytes=max_bytes or DEFAULT_CACHE_MAX_BYTES,
+        )
+    return _RESPONSE_CACHE
+
+
+def get_response_cache():
+    return _RESPONSE_CACHE
+
+
+_PROMPT_CACHE = False
+
+
+def configure_prompt_cache(enabled):
+    """Turn provider-side prompt caching on or off for all `chat_completion` calls."""
+    global _PROMPT_CACHE
+    _PROMPT_CACHE = bool(enabled)
+
+
+_STREAMING = False
+
+
+def configure_streaming(enabled):
+    """Turn streamed responses on or off for all `chat_completion` calls."""
+    global _STREAMING
+    _STREAMING = bool(enabled)
+
+
+class JsonObjectScanner:
+    """Finds the end of the first JSON object in text fed chunk by chunk.
+
+    Text before the opening brace, e.g. a markdown fence, is skipped; braces
+    inside strings are ignored. A balanced `{...}` only counts once it parses as
+    a JSON object with all `required_keys`, so braces in prose before the answer,
+    e.g. "I think {this} fits", do not end the scan.
+    """
+
+    def __init__(self, required_keys=()):
+        self.required_keys = tuple(required_keys)
+        self.depth = 0
+        self.in_string = False
+        self.escaped = False
+        self.pending = []
+
+    def _is_answer(self, candidate):
+        try:
+            parsed = json.loads(candidate)
+        except ValueError:
+            return False
+        return isinstance(parsed, dict) and all(
+            key in parsed for key in self.required_keys
+        )
+
+    def feed(self, text):
+        """Return the index after the closing brace in `text`, or None."""
+        start = 0
+        for i, char in enumerate(text):
+            if self.in_string:
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == "{":
+                if self.depth == 0:
+                    start = i
+                self.depth += 1
+            elif self.depth > 0:
+                if char == '"':
+                    self.in_string = True
+                elif char == "}":
+                    self.depth -= 1
+                    if self.depth == 0:
+                        candidate = "".join(self.pending) + text[start : i + 1]
+                        self.pending = []
+                        if self._is_answer(candidate):
+                            return i + 1
+        if self.depth > 0:
+            self.pending.append(text[start:])
+        return None
+
+
+def make_json_scanner(stop_at_json):
+    """The scanner of a streamed response for `stop_at_json`, see `achat_completion`."""
+    if not stop_at_json:
+        return None
+    if stop_at_json is True:
+        return JsonObjectScanner()
+    return JsonObjectScanner(required_keys=stop_at_json)
+
+
+def make_prompt_cache_key(model_name, messages):
+    """Key routing requests with the same system prompt to the same OpenAI cache."""
+    prefix = messages[0]["content"] if messages[0]["role"] == "system" else ""
+    payload = json.dumps([model_name, prefix], ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:32]
+
+
+def mark_anthropic_cache_breakpoints(system, messages):
+    """Add Anthropic `cache_control` breakpoints after the system prompt and after
+    the last message.
+
+    The conversation only grows by appending rounds, so the prefix written to the
+    cache by one round is read back by the next one. Returns the system blocks and
+    a copy of the messages.
+    """
+    cache_control = {"type": "ephemeral"}
+    system_blocks = (
+        [{"type": "text", "text": system, "cache_control": cache_control}]
+        if system
+        else system
+    )
+    messages = list(messages)
+    if messages and isinstance(messages[-1]["content"], str):
+        messages[-1] = {
+            "role": messages[-1]["role"],
+            "content": [
+                {
+                    "type": "text",
+                    "text": messages[-1]["content"],
+                    "cache_control": cache_control,
+                }
+            ],
+        }
+    return system_blocks, messages
+
+
+def get_model_endpoint_pool(model):
+    """Return the shared pool of the endpoints serving `model`, see `load_balancer`.
+
+    Every endpoint has its own rate limiter, with the optional `rpm` and `tpm`
+    budgets of the endpoint or, if it sets none, of the model config.
+    """
+    endpoints = get_model_endpoints(model)
+    return get_endpoint_pool(
+        (model["api_type"], model["model_name"], json.dumps(endpoints, sort_keys=True)),
+        endpoints,
+        make_limiter=lambda endpoint: get_limiter(
+            (model["api_type"], endpoint.get("api_base"), model["model_name"]),
+            rpm=endpoint.get("rpm", model.get("rpm")),
+            tpm=endpoint.get("tpm", model.get("tpm")),
+        ),
+        policy=model.get("endpoint_policy", "round-robin"),
+        max_failures=model.get("max_endpoint_failures", MAX_ENDPOINT_FAILURES),
+        eject_seconds=model.get("endpoint_eject_seconds", ENDPOINT_EJECT_SECONDS),
+    )
+
+
+def estimate_request_tokens(messages, max_tokens):
+    # rough count for rate limiting, providers also book max_tokens up front
+    return sum(len(str(m["content"])) for m in messages) // 4 + max_tokens
+
+
+def sleep_before_retry(attempt, error=None, limiter=None):
+    """Back off before retry `attempt`, honouring a `Retry-After` from `error`.
+
+    A `Retry-After` also pauses the endpoint's limiter, so concurrent callers of
+    the same endpoint wait as well instead of tripping the limit again.
+    """
+    # every backoff is one retry of the current call, whatever its error
+    record_retry(error)
+    retry_after = get_retry_after(error) if error is not None else None
+    if retry_after is not None and limiter is not None:
+        limiter.pause(retry_after)
+    time.sleep(backoff_delay(attempt, retry_after))
+
+
+async def asleep_before_retry(attempt, error=None, limiter=None):
+    """Async version of `sleep_before_retry`."""
+    # every backoff is one retry of the current call, whatever its error
+    record_retry(error)
+    retry_after = get_retry_after(error) if error is not None else None
+    if retry_after is not None and limiter is not None:
+        limiter.pause(retry_after)
+    await asyncio.sleep(backoff_delay(attempt, retry_after))
+
+
+def chat_completion(
+    model,
+    messages,
+    temperature=1.0,
+    max_tokens=None,
+    refresh_cache=False,
+    json_mode=False,
+    seed=None,
+    prompt_cache=None,
+    stream=None,
+    stop_at_json=False,
+):
+    """Query `model` and return its response text, see `achat_completion`.
+
+    The request runs on a shared background event loop, the calling thread blocks
+    until it is done.
+    """
+    return run_sync(
+        achat_completion(
+            model,
+            messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            refresh_cache=refresh_cache,
+            json_mode=json_mode,
+            seed=seed,
+            prompt_cache=prompt_cache,
+            stream=stream,
+            stop_at_json=stop_at_json,
+        )
+    )
+
+
+async def achat_completion(
+    model,
+    messages,
+    temperature=1.0,
+    max_tokens=None,
+    refresh_cache=False,
+    json_mode=False,
+    seed=None,
+    prompt_cache=None,
+    stream=None,
+    stop_at_json=False,
+):
+    """Query `model` and return its response text.
+
+    If a response cache is configured, identical requests are served from it
+    without touching the network. With `refresh_cache=True` the lookup is skipped
+    and the new response replaces the cached one. `json_mode` asks OpenAI-compatible
+    endpoints for a JSON object response and `seed` for deterministic sampling,
+    other providers ignore both. With `prompt_cache`, which defaults to the
+    setting of `configure_prompt_cache`, the stable prefix of the request is
+    marked for provider-side prompt caching: Anthropic requests get
+    `cache_control` breakpoints and OpenAI requests a `prompt_cache_key` derived
+    from the system prompt.
+
+    `max_tokens` defaults to the `max_tokens` field of the model config, or
+    `DEFAULT_MAX_TOKENS`. With `stream`, which defaults to the setting of
+    `configure_streaming`, OpenAI and Anthropic responses are streamed and their
+    time to first token is recorded. `stop_at_json` streams the response and
+    stops the generation once a complete JSON object was received, the rest of
+    the response is dropped. It may also be a tuple of keys the object must have,
+    e.g. `JUDGE_RESPONSE_KEYS`, objects that do not parse or lack a key are
+    skipped. Every call is recorded in `telemetry.TELEMETRY`,
+    including the prompt tokens served from the provider's cache. Many calls can
+    be in flight concurrently on one event loop.
+    """
+    if max_tokens is None:
+        max_tokens = model.get("max_tokens") or DEFAULT_MAX_TOKENS
+    if stream is None:
+        stream = _STREAMING
+    with track_call(model) as call:
+        cache = _RESPONSE_CACHE
+        if cache is not None:
+            from response_cache import make_cache_key
+
+            cache_key = make_cache_key(
+                model["model_name"],
+                get_endpoint_label(model),
+                messages,
+                temperature,
+                max_tokens,
+                seed=seed,
+                stop_at_json=stop_at_json,
+                json_mode=json_mode,
+            )
+            if not refresh_cache:
+                # the SQLite I/O runs in a worker thread to not block the event loop
+                output = await asyncio.to_thread(cache.get, cache_key)
+                if output is not None:
+                    call.cache_hit = True
+                    return output
+
+        output = await _adispatch_chat_completion(
+            model,
+            messages,
+            temperature,
+            max_tokens,
+            json_mode,
+            seed,
+            _PROMPT_CACHE if prompt_cache is None else prompt_cache,
+            stream=stream or stop_at_json,
+            stop_at_json=stop_at_json,
+        )
+        if output == API_ERROR_OUTPUT:
+            call.error = True
+        elif call.prompt_tokens is None:
+            # the provider did not report its usage
+            call.prompt_tokens = num_message_tokens(messages)
+            call.completion_tokens = num_tokens(output)
+            call.estimated_tokens = True
+        elif call.completion_tokens is None:
+            # a stream stopped early reports no completion tokens
+            call.completion_tokens = num_tokens(output)
+            call.estimated_tokens = True
+
+        if cache is not None and output != API_ERROR_OUTPUT:
+            await asyncio.to_thread(cache.put, cache_key, output)
+        return output
+
+
+async def _adispatch_chat_completion(
+    model,
+    messages,
+    temperature,
+    max_tokens,
+    json_mode,
+    seed,
+    prompt_cache=False,
+    stream=False,
+    stop_at_json=False,
+):
     api_type = model["api_type"]
-    api_dict = model.get("endpoints")
+    endpoints = get_model_endpoint_pool(model)
+    # mistral and cohere are always called on their default endpoint
+    limiter = endpoints.endpoints[0].limiter
     if api_type == "anthropic":
-        messages = fix_anthropic_message(messages)
-        output = chat_completion_anthropic(
+        # work on a copy so the caller's conversation is left untouched
+        messages = fix_anthropic_message(list(messages))
+        output = await achat_completion_anthropic(
             model=model["model_name"],
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
-            api_dict=api_dict,
+            endpoints=endpoints,
+            prompt_cache=prompt_cache,
+            stream=stream,
+            stop_at_json=stop_at_json,
         )
     elif api_type == "mistral":
-        output = chat_completion_mistral(
+        output = await achat_completion_mistral(
             model=model["model_name"],
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
+            limiter=limiter,
         )
     elif api_type == "gemini":
         raise NotImplementedError(
             "Gemini API is not supported in this version due to multi-turn chat."
         )
     elif api_type == "azure":
-        output = chat_completion_openai_azure(
+        output = await achat_completion_openai_azure(
             model=model["model_name"],
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
-            api_dict=api_dict,
+            endpoints=endpoints,
+            json_mode=json_mode,
+            seed=seed,
+            stream=stream,
+            stop_at_json=stop_at_json,
         )
     elif api_type == "cohere":
-        output = chat_completion_cohere(
+        output = await achat_completion_cohere(
             model=model["model_name"],
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
+            limiter=limiter,
         )
     else:
-        output = chat_completion_openai(
+        output = await achat_completion_openai(
             model=model["model_name"],
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
-            api_dict=api_dict,
+            endpoints=endpoints,
+            json_mode=json_mode,
+            seed=seed,
+            prompt_cache=prompt_cache,
+            stream=stream,
+            stop_at_json=stop_at_json,
         )
 
     return output
 
 
-def chat_completion_openai(model, messages, temperature, max_tokens, api_dict=None):
-    import openai
+class JudgeError(Exception):
+    """Raised when the judge gives no usable response within its retry budget."""
+
+
+class JudgeStats:
+    """Thread-safe record of judge calls, failed attempts and the tokens they wasted."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.calls = 0
+            self.failed_attempts = []
+            self.failed_calls = 0
+            self.wasted_tokens = 0
+            self.full_context_tokens = 0
+            self.sent_context_tokens = 0
+
+    def record_call(self):
+        with self._lock:
+            self.calls += 1
+
+    def record_failed_attempt(self, reason, wasted_tokens):
+        with self._lock:
+            self.failed_attempts.append(reason)
+            self.wasted_tokens += wasted_tokens
+
+    def record_failed_call(self):
+        with self._lock:
+            self.failed_calls += 1
 
-    if api_dict:
-        client = openai.OpenAI(
-            base_url=api_dict.get("api_base"),
-            api_key=api_dict.get("api_key"),
+    def record_context(self, full_tokens, sent_tokens):
+        with self._lock:
+            self.full_context_tokens += full_tokens
+            self.sent_context_tokens += sent_tokens
+
+    def summary(self):
+        with self._lock:
+            return {
+                "calls": self.calls,
+                "retries": len(self.failed_attempts),
+                "failed_calls": self.failed_calls,
+                "wasted_tokens": self.wasted_tokens,
+                "full_context_tokens": self.full_context_tokens,
+                "sent_context_tokens": self.sent_context_tokens,
+            }
+
+
+JUDGE_STATS = JudgeStats()
+
+
+def report_judge_stats():
+    judge_stats = JUDGE_STATS.summary()
+    print(
+        f"Judge: {judge_stats['calls']} calls, {judge_stats['retries']} retries, "
+        f"{judge_stats['failed_calls']} failed calls, "
+        f"~{judge_stats['wasted_tokens']} tokens wasted on retries"
+    )
+    full_tokens = judge_stats["full_context_tokens"]
+    if full_tokens:
+        sent_tokens = judge_stats["sent_context_tokens"]
+        print(
+            f"Judge context: ~{sent_tokens} tokens sent instead of ~{full_tokens} "
+            f"({1 - sent_tokens / full_tokens:.1%} saved by compaction)"
         )
-    else:
-        client = openai.OpenAI()
 
-    output = API_ERROR_OUTPUT
-    for _ in range(API_MAX_RETRY):
+_TOKEN_ENCODER = None
+_TOKEN_ENCODER_LOCK = threading.Lock()
+
+
+def num_tokens(text):
+    """Count the tokens of `text` with tiktoken's cl100k_base encoding.
+
+    Falls back to a rough estimate of 4 characters per token if the encoding
+    cannot be loaded, e.g. on a machine without internet access.
+    """
+    global _TOKEN_ENCODER
+    if _TOKEN_ENCODER is None:
+        with _TOKEN_ENCODER_LOCK:
+            if _TOKEN_ENCODER is None:
+                try:
+                    import tiktoken
+
+                    _TOKEN_ENCODER = tiktoken.get_encoding("cl100k_base")
+                except Exception as e:
+                    print(
+                        f"Warning: cannot load tiktoken encoding "
+                        f"({type(e).__name__}), estimating token counts"
+                    )
+                    _TOKEN_ENCODER = False
+    if _TOKEN_ENCODER is False:
+        return len(text) // 4
+    return len(_TOKEN_ENCODER.encode(text, disallowed_special=()))
+
+
+def num_message_tokens(messages):
+    return sum(num_tokens(str(m["content"])) for m in messages)
+
+
+JUDGE_RESPONSE_KEYS = ("winner", "next_round_user_speaks")
+
+
+def judger_response_problem(response):
+    """Return why a judge response is unusable, or None if it is usable."""
+    try:
+        parsed_response = extract_and_parse_json(response)
+        if all(key in parsed_response for key in JUDGE_RESPONSE_KEYS):
+            return None
+        return "missing 'winner' or 'next_round_user_speaks'"
+    except Exception as e:
+        return str(e).split("\n")[0]
+
+
+def chat_completion_judger(model, messages, max_retry=JUDGE_MAX_RETRY, seed=None):
+    """Query the judge until it returns a parsable verdict, at most `max_retry` times.
+
+    The judge config may set `json_mode: true` to request a JSON object response
+    from OpenAI-compatible endpoints. With a `seed`, attempt i samples with seed
+    `seed + i`. Every failed attempt is recorded in `JUDGE_STATS`; raises
+    `JudgeError` once the retry budget is exhausted.
+    """
+    JUDGE_STATS.record_call()
+    for attempt in range(max_retry):
+        # a cached response that failed to parse must not be served again
+        with labels(role="judge"):
+            response = chat_completion(
+                model,
+                messages,
+                refresh_cache=attempt > 0,
+                json_mode=model.get("json_mode", False),
+                seed=None if seed is None else seed + attempt,
+            )
+        reason = judger_response_problem(response)
+        if reason is None:
+            return response
+
+        print(f"Warning: unusable judge response ({reason}), attempt {attempt + 1}")
+        JUDGE_STATS.record_failed_attempt(
+            reason, num_message_tokens(messages) + num_tokens(response)
+        )
+        if attempt + 1 < max_retry:
+            sleep_before_retry(attempt)
+
+    JUDGE_STATS.record_failed_call()
+    raise JudgeError(f"No usable judge response after {max_retry} attempts: {reason}")
+
+
+JUDGE_CONTEXT_MODES = ("full", "compact")
+
+
+def _compact_judger_round(candidates_message, judger_message):
+    try:
+        responses = json.loads(candidates_message["content"])
+        verdict = extract_and_parse_json(judger_message["content"])
+    except Exception:
+        return [candidates_message, judger_message]
+    # the opening round shows the same greeting to both sides and has no winner
+    winner = verdict.get("winner") or "model_a"
+    if not isinstance(responses, dict) or winner not in responses:
+        return [candidates_message, judger_message]
+    return [
+        {"role": "user", "content": json.dumps({winner: responses[winner]})},
+        {
+            "role": "assistant",
+            "content": json.dumps(
+                {
+                    "winner": verdict.get("winner"),
+                    "next_round_user_speaks": verdict.get("next_round_user_speaks"),
+                }
+            ),
+        },
+    ]
+
+
+def compact_judger_messages(messages, token_budget=None):
+    """Shrink the judge context to stop its quadratic growth over the rounds.
+
+    Every earlier round is reduced to the winning response and the judge's
+    verdict with its simulated user turn, the decision reason is dropped. The
+    system prompt and the current round are kept as they are. With a
+    `token_budget`, the oldest rounds are dropped until the messages fit.
+    """
+    history = messages[1:-1]
+    rounds = [
+        _compact_judger_round(history[i], history[i + 1])
+        for i in range(0, len(history) - 1, 2)
+    ]
+    if token_budget is not None:
+        used = num_message_tokens([messages[0], messages[-1]])
+        kept = []
+        for round_messages in reversed(rounds):
+            used += num_message_tokens(round_messages)
+            if used > token_budget:
+                break
+            kept.append(round_messages)
+        rounds = kept[::-1]
+    return [messages[0]] + [m for round_messages in rounds for m in round_messages] + [
+        messages[-1]
+    ]
+
+
+def prepare_judger_messages(messages, mode="full", token_budget=None):
+    """The messages to send to the judge for `messages` in the given context mode.
+
+    In "compact" mode the context is compacted, and the tokens of the full and of
+    the compacted context are recorded in `JUDGE_STATS`.
+    """
+    if mode == "full":
+        return messages
+    compacted = compact_judger_messages(messages, token_budget)
+    JUDGE_STATS.record_context(
+        num_message_tokens(messages), num_message_tokens(compacted)
+    )
+    return compacted
+
+
+class CandidatesStep:
+    """Step of an example that asks both candidates of a round the same `messages`.
+
+    The step is answered with the (model_a, model_b) responses.
+    """
+
+    def __init__(self, model_a, model_b, messages, stop_at_json=False):
+        self.model_a = model_a
+        self.model_b = model_b
+        self.messages = messages
+        self.stop_at_json = stop_at_json
+
+
+class JudgeStep:
+    """Step of an example that asks the judge for a verdict on `messages`.
+
+    The step is answered with a usable judge response. The `opening` turn does
+    not depend on the compared models and may come from an opening turn store.
+    """
+
+    def __init__(self, messages, opening=False):
+        self.messages = messages
+        self.opening = opening
+
+
+def run_example_steps(
+    steps, example_id, judger_model, candidate_executor=None, opening_store=None
+):
+    """Answer the steps of one example right away and return its result.
+
+    `steps` is the generator of an example, e.g. `run_character_eval.example_steps`,
+    it yields `CandidatesStep`s and `JudgeStep`s and returns the result of the
+    example. `batch.WaveScheduler` answers the steps of many examples in waves
+    instead.
+    """
+    response = None
+    while True:
         try:
-            completion = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                temperature=temperature,
-                max_tokens=max_tokens,
+            step = steps.send(response)
+        except StopIteration as e:
+            return e.value
+        if isinstance(step, CandidatesStep):
+            response = chat_completion_pair(
+                step.model_a,
+                step.model_b,
+                step.messages,
+                executor=candidate_executor,
+                stop_at_json=step.stop_at_json,
             )
-            output = completion.choices[0].message.content
+        elif step.opening and opening_store is not None:
+            response = opening_store.get(example_id, step.messages)
+        else:
+            response = chat_completion_judger(judger_model, step.messages)
+
+
+def chat_completion_pair(model_a, model_b, messages, executor=None, stop_at_json=False):
+    """Query two models with the same `messages` and return both responses.
+
+    If an `executor` is given, the `model_a` request is sent from it while the
+    `model_b` request runs on the calling thread, so the round takes as long as the
+    slower of the two models instead of the sum of both. `stop_at_json` is passed
+    to `chat_completion`.
+    """
+    with labels(role="candidate"):
+        if executor is None:
+            return chat_completion(
+                model_a, messages, stop_at_json=stop_at_json
+            ), chat_completion(model_b, messages, stop_at_json=stop_at_json)
+
+        future_a = executor.submit(
+            copy_context().run,
+            chat_completion,
+            model_a,
+            messages,
+            stop_at_json=stop_at_json,
+        )
+        model_b_response = chat_completion(model_b, messages, stop_at_json=stop_at_json)
+        return future_a.result(), model_b_response
+
+
+def _openai_cached_tokens(usage):
+    details = getattr(usage, "prompt_tokens_details", None)
+    return getattr(details, "cached_tokens", None) or 0
+
+
+async def _aread_openai_stream(stream, stop_at_json=False):
+    """Collect the text of an OpenAI chat completion stream."""
+    scanner = make_json_scanner(stop_at_json)
+    parts = []
+    try:
+        async for chunk in stream:
+            if chunk.usage is not None:
+                record_usage(
+                    chunk.usage.prompt_tokens,
+                    chunk.usage.completion_tokens,
+                    _openai_cached_tokens(chunk.usage),
+                )
+            if not chunk.choices or not chunk.choices[0].delta.content:
+                continue
+            text = chunk.choices[0].delta.content
+            if not parts:
+                record_first_token()
+            if scanner is not None:
+                end = scanner.feed(text)
+                if end is not None:
+                    parts.append(text[:end])
+                    record_cut_off()
+                    break
+            parts.append(text)
+    finally:
+        # closing the connection early stops the generation
+        await stream.close()
+    return "".join(parts)
+
+
+async def _aread_anthropic_stream(stream, stop_at_json=False):
+    """Collect the text of an Anthropic message stream."""
+    scanner = make_json_scanner(stop_at_json)
+    parts = []
+    prompt_tokens = completion_tokens = None
+    cached_tokens = 0
+    try:
+        async for event in stream:
+            if event.type == "message_start":
+                usage = event.message.usage
+                cached_tokens = getattr(usage, "cache_read_input_tokens", None) or 0
+                prompt_tokens = (
+                    usage.input_tokens
+                    + cached_tokens
+                    + (getattr(usage, "cache_creation_input_tokens", None) or 0)
+                )
+            elif event.type == "message_delta":
+                completion_tokens = event.usage.output_tokens
+            elif event.type == "content_block_delta" and event.delta.type == "text_delta":
+                text = event.delta.text
+                if not parts:
+                    record_first_token()
+                if scanner is not None:
+                    end = scanner.feed(text)
+                    if end is not None:
+                        parts.append(text[:end])
+                        record_cut_off()
+                        break
+                parts.append(text)
+    finally:
+        await stream.close()
+    if prompt_tokens is not None:
+        record_usage(prompt_tokens, completion_tokens, cached_tokens)
+    return "".join(parts)
+
+
+async def achat_completion_openai(
+    model,
+    messages,
+    temperature,
+    max_tokens,
+    endpoints=None,
+    json_mode=False,
+    seed=None,
+    prompt_cache=False,
+    stream=False,
+    stop_at_json=False,
+):
+    import openai
+
+    if endpoints is None:
+        endpoints = EndpointPool([])
+
+    extra_kwargs = {}
+    if json_mode:
+        extra_kwargs["response_format"] = {"type": "json_object"}
+    if seed is not None:
+        extra_kwargs["seed"] = seed
+    if prompt_cache:
+        # OpenAI caches prompt prefixes automatically, the key sends requests with
+        # the same system prompt to the same cache
+        extra_kwargs["extra_body"] = {
+            "prompt_cache_key": make_prompt_cache_key(model, messages)
+        }
+
+    request_tokens = estimate_request_tokens(messages, max_tokens)
+    output = API_ERROR_OUTPUT
+    endpoint = None
+    for attempt in range(API_MAX_RETRY):
+        try:
+            # a retry goes to another endpoint if there is one
+            endpoint = endpoints.pick(exclude=[endpoint])
+            record_endpoint(endpoint.api_base)
+            if endpoint.limiter is not None:
+                await endpoint.limiter.aacquire(request_tokens)
+            with endpoints.request(endpoint):
+                client = get_async_client(
+                    "openai",
+                    api_base=endpoint.config.get("api_base"),
+                    api_key=endpoint.config.get("api_key"),
+                )
+                request = dict(
+                    model=model,
+                    messages=messages,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    **extra_kwargs,
+                )
+                if stream:
+                    output = await _aread_openai_stream(
+                        await client.chat.completions.create(
+                            **request,
+                            stream=True,
+                            stream_options={"include_usage": True},
+                        ),
+                        stop_at_json,
+                    )
+                else:
+                    completion = await client.chat.completions.create(**request)
+                    output = completion.choices[0].message.content
+                    if completion.usage is not None:
+                        record_usage(
+                            completion.usage.prompt_tokens,
+                            completion.usage.completion_tokens,
+                            _openai_cached_tokens(completion.usage),
+                        )
             break
         except openai.RateLimitError as e:
             print(type(e), e)
-            time.sleep(API_RETRY_SLEEP)
+            await asleep_before_retry(attempt, e, endpoint.limiter)
+        except (openai.InternalServerError, openai.APIConnectionError) as e:
+            print(type(e), e)
+            await asleep_before_retry(attempt, e)
         except openai.BadRequestError as e:
             print(messages)
             print(type(e), e)
         except TypeError as e:
             print(type(e), e)
-            time.sleep(API_RETRY_SLEEP)
-        except KeyError:
+            await asleep_before_retry(attempt, e)
+        except KeyError as e:
             print(type(e), e)
             break
 
     return output
 
 
-def chat_completion_openai_azure(
-    model, messages, temperature, max_tokens, api_dict=None
+async def achat_completion_openai_azure(
+    model,
+    messages,
+    temperature,
+    max_tokens,
+    endpoints,
+    json_mode=False,
+    seed=None,
+    stream=False,
+    stop_at_json=False,
 ):
     import openai
-    from openai import AzureOpenAI
-
-    api_base = api_dict["api_base"]
-    client = AzureOpenAI(
-        azure_endpoint=api_base,
-        api_key=api_dict["api_key"],
-        api_version=api_dict["api_version"],
-        timeout=240,
-        max_retries=2,
-    )
 
+    extra_kwargs = {}
+    if json_mode:
+        extra_kwargs["response_format"] = {"type": "json_object"}
+
+    request_tokens = estimate_request_tokens(messages, max_tokens)
     output = API_ERROR_OUTPUT
-    for _ in range(API_MAX_RETRY):
+    endpoint = None
+    for attempt in range(API_MAX_RETRY):
         try:
-            response = client.chat.completions.create(
-                model=model,
-                messages=messages,
-                n=1,
-                temperature=temperature,
-                max_tokens=max_tokens,
-                seed=42,
-            )
-            output = response.choices[0].message.content
+            # a retry goes to another endpoint if there is one
+            endpoint = endpoints.pick(exclude=[endpoint])
+            record_endpoint(endpoint.api_base)
+            if endpoint.limiter is not None:
+                await endpoint.limiter.aacquire(request_tokens)
+            with endpoints.request(endpoint):
+                client = get_async_client(
+                    "azure",
+                    api_base=endpoint.config["api_base"],
+                    api_key=endpoint.config["api_key"],
+                    api_version=endpoint.config["api_version"],
+                )
+                request = dict(
+                    model=model,
+                    messages=messages,
+                    n=1,
+                    temperature=temperature,
+                    max_tokens=max_tokens,
+                    seed=42 if seed is None else seed,
+                    **extra_kwargs,
+                )
+                if stream:
+                    output = await _aread_openai_stream(
+                        await client.chat.completions.create(
+                            **request,
+                            stream=True,
+                            stream_options={"include_usage": True},
+                        ),
+                        stop_at_json,
+                    )
+                else:
+                    response = await client.chat.completions.create(**request)
+                    output = response.choices[0].message.content
+                    if response.usage is not None:
+                        record_usage(
+                            response.usage.prompt_tokens,
+                            response.usage.completion_tokens,
+                            _openai_cached_tokens(response.usage),
+                        )
             break
         except openai.RateLimitError as e:
             print(type(e), e)
-            time.sleep(API_RETRY_SLEEP)
+            await asleep_before_retry(attempt, e, endpoint.limiter)
+        except (openai.InternalServerError, openai.APIConnectionError) as e:
+            print(type(e), e)
+            await asleep_before_retry(attempt, e)
         except openai.BadRequestError as e:
             print(type(e), e)
             break
-        except KeyError:
+        except KeyError as e:
             print(type(e), e)
             break
 
     return output
 
 
-def chat_completion_anthropic(model, messages, temperature, max_tokens, api_dict=None):
+async def achat_completion_anthropic(
+    model,
+    messages,
+    temperature,
+    max_tokens,
+    endpoints=None,
+    prompt_cache=False,
+    stream=False,
+    stop_at_json=False,
+):
     import anthropic
 
-    if api_dict:
-        api_key = api_dict["api_key"]
-    else:
-        api_key = os.environ["ANTHROPIC_API_KEY"]
+    if endpoints is None:
+        endpoints = EndpointPool([])
 
     sys_msg = ""
     if messages[0]["role"] == "system":
         sys_msg = messages[0]["content"]
         messages = messages[1:]
+    if prompt_cache:
+        sys_msg, messages = mark_anthropic_cache_breakpoints(sys_msg, messages)
 
+    request_tokens = estimate_request_tokens(messages, max_tokens)
     output = API_ERROR_OUTPUT
-    for _ in range(API_MAX_RETRY):
+    endpoint = None
+    for attempt in range(API_MAX_RETRY):
         try:
-            c = anthropic.Anthropic(api_key=api_key)
-            response = c.messages.create(
-                model=model,
-                messages=messages,
-                stop_sequences=[anthropic.HUMAN_PROMPT],
-                max_tokens=max_tokens,
-                temperature=temperature,
-                system=sys_msg,
-            )
-            output = response.content[0].text
+            # a retry goes to another endpoint if there is one
+            endpoint = endpoints.pick(exclude=[endpoint])
+            record_endpoint(endpoint.api_base)
+            if endpoint.limiter is not None:
+                await endpoint.limiter.aacquire(request_tokens)
+            with endpoints.request(endpoint):
+                client = get_async_client(
+                    "anthropic",
+                    api_base=endpoint.config.get("api_base"),
+                    api_key=endpoint.config.get("api_key")
+                    or os.environ["ANTHROPIC_API_KEY"],
+                )
+                request = dict(
+                    model=model,
+                    messages=messages,
+                    stop_sequences=[ANTHROPIC_HUMAN_PROMPT],
+                    max_tokens=max_tokens,
+                    system=sys_msg,
+                    # recent SDK versions no longer take `temperature` as an argument
+                    extra_body={"temperature": temperature},
+                )
+                if stream:
+                    output = await _aread_anthropic_stream(
+                        await client.messages.create(**request, stream=True),
+                        stop_at_json,
+                    )
+                else:
+                    response = await client.messages.create(**request)
+                    output = response.content[0].text
+                    # input_tokens only counts the tokens after the last cache breakpoint
+                    cache_read = (
+                        getattr(response.usage, "cache_read_input_tokens", None) or 0
+                    )
+                    cache_write = (
+                        getattr(response.usage, "cache_creation_input_tokens", None)
+                        or 0
+                    )
+                    record_usage(
+                        response.usage.input_tokens + cache_read + cache_write,
+                        response.usage.output_tokens,
+                        cache_read,
+                    )
             break
         except anthropic.APIError as e:
             print(type(e), e)
-            time.sleep(API_RETRY_SLEEP)
+            await asleep_before_retry(attempt, e, endpoint.limiter)
     return output
 
 
-def chat_completion_mistral(model, messages, temperature, max_tokens):
-    from mistralai.client import MistralClient
+async def achat_completion_mistral(
+    model, messages, temperature, max_tokens, limiter=None
+):
     from mistralai.models.chat_completion import ChatMessage
     from mistralai.exceptions import MistralException
 
-    api_key = os.environ["MISTRAL_API_KEY"]
-    client = MistralClient(api_key=api_key)
+    client = get_async_client("mistral", api_key=os.environ["MISTRAL_API_KEY"])
 
     prompts = [
         ChatMessage(role=message["role"], content=message["content"])
         for message in messages
     ]
 
+    request_tokens = estimate_request_tokens(messages, max_tokens)
     output = API_ERROR_OUTPUT
-    for _ in range(API_MAX_RETRY):
+    for attempt in range(API_MAX_RETRY):
+        if limiter is not None:
+            await limiter.aacquire(request_tokens)
         try:
-            chat_response = client.chat(
+            chat_response = await client.chat(
                 model=model,
                 messages=prompts,
                 temperature=temperature,
                 max_tokens=max_tokens,
             )
             output = chat_response.choices[0].message.content
+            if chat_response.usage is not None:
+                record_usage(
+                    chat_response.usage.prompt_tokens,
+                    chat_response.usage.completion_tokens,
+                )
             break
         except MistralException as e:
             print(type(e), e)
@@ -284,7 +1602,7 @@ def chat_completion_mistral(model, messages, temperature, max_tokens):
     return output
 
 
-def http_completion_gemini(model, message, temperature, max_tokens):
+async def ahttp_completion_gemini(model, message, temperature, max_tokens):
     api_key = os.environ["GEMINI_API_KEY"]
 
     safety_settings = [
@@ -296,7 +1614,7 @@ def http_completion_gemini(model, message, temperature, max_tokens):
 
     output = API_ERROR_OUTPUT
     try:
-        response = requests.post(
+        response = await get_async_client("gemini").post(
             f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent?key={api_key}",
             json={
                 "contents": [{"parts": [{"text": message}]}],
@@ -309,19 +1627,23 @@ def http_completion_gemini(model, message, temperature, max_tokens):
         )
     except Exception as e:
         print(f"**API REQUEST ERROR** Reason: {e}.")
+        return output
 
     if response.status_code != 200:
         print(f"**API REQUEST ERROR** Reason: status code {response.status_code}.")
+        return output
 
     output = response.json()["candidates"][0]["content"]["parts"][0]["text"]
 
     return output
 
 
-def chat_completion_cohere(model, messages, temperature, max_tokens):
+async def achat_completion_cohere(
+    model, messages, temperature, max_tokens, limiter=None
+):
     import cohere
 
-    co = cohere.Client(os.environ["COHERE_API_KEY"])
+    co = get_async_client("cohere", api_key=os.environ["COHERE_API_KEY"])
     assert len(messages) > 0
 
     template_map = {"system": "SYSTEM", "assistant": "CHATBOT", "user": "USER"}
@@ -338,10 +1660,13 @@ def chat_completion_cohere(model, messages, temperature, max_tokens):
     else:
         history = None
 
+    request_tokens = estimate_request_tokens(messages, max_tokens)
     output = API_ERROR_OUTPUT
-    for _ in range(API_MAX_RETRY):
+    for attempt in range(API_MAX_RETRY):
+        if limiter is not None:
+            await limiter.aacquire(request_tokens)
         try:
-            response = co.chat(
+            response = await co.chat(
                 message=prompt,
                 model=model,
                 temperature=temperature,
@@ -349,6 +1674,9 @@ def chat_completion_cohere(model, messages, temperature, max_tokens):
                 chat_history=history,
             )
             output = response.text
+            billed_units = getattr(response.meta, "billed_units", None)
+            if billed_units is not None:
+                record_usage(billed_units.input_tokens, billed_units.output_tokens)
             break
         except cohere.core.api_error.ApiError as e:
             print(type(e), e)